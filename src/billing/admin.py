@@ -0,0 +1,11 @@
+from django.contrib import admin
+from .models import StripeOutbox
+
+
+class StripeOutboxAdmin(admin.ModelAdmin):
+    list_display = ["kind", "object_id", "status", "attempts", "next_attempt_at"]
+    list_filter = ["kind", "status"]
+    readonly_fields = ["idempotency_key", "created", "completed"]
+
+
+admin.site.register(StripeOutbox, StripeOutboxAdmin)
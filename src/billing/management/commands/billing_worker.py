@@ -0,0 +1,43 @@
+import time
+from typing import Any
+from django.core.management.base import BaseCommand, CommandParser
+
+from billing import utils as billing_utils
+
+
+class Command(BaseCommand):
+    help = "Create the queued Stripe customers, products and prices."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--limit", default=None, type=int)
+        parser.add_argument("--max-attempts", default=8, type=int)
+        parser.add_argument(
+            "--backoff",
+            default=2.0,
+            type=float,
+            help="Seconds before the first retry, doubled on every failure",
+        )
+        parser.add_argument("--max-backoff", default=600.0, type=float)
+        parser.add_argument(
+            "--watch",
+            default=0,
+            type=float,
+            help="Keep running, checking for new jobs every N seconds",
+        )
+        return super().add_arguments(parser)
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        watch = options.get("watch")
+        while True:
+            count = billing_utils.process_outbox(
+                limit=options.get("limit"),
+                max_attempts=options.get("max_attempts"),
+                backoff=options.get("backoff"),
+                max_backoff=options.get("max_backoff"),
+                verbose=options.get("verbosity") > 1,
+            )
+            if count or not watch:
+                self.stdout.write(f"Created {count} Stripe objects.")
+            if not watch:
+                break
+            time.sleep(watch)
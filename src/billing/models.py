@@ -0,0 +1,73 @@
+import uuid
+
+from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+
+
+class OutboxKind(models.TextChoices):
+    CUSTOMER = "customer", "Customer"
+    PRODUCT = "product", "Product"
+    PRICE = "price", "Price"
+
+
+class OutboxStatus(models.TextChoices):
+    PENDING = "pending", "Pending"
+    DONE = "done", "Done"
+    FAILED = "failed", "Failed"
+
+
+class StripeOutbox(models.Model):
+    """
+    A Stripe object to create for a row of this database, written in the
+    same transaction as the row and drained by `manage.py billing_worker`.
+    """
+
+    kind = models.CharField(max_length=20, choices=OutboxKind.choices)
+    object_id = models.BigIntegerField()
+    # sent to Stripe, so retried requests never create the object twice
+    idempotency_key = models.UUIDField(default=uuid.uuid4, unique=True)
+    status = models.CharField(
+        max_length=20,
+        choices=OutboxStatus.choices,
+        default=OutboxStatus.PENDING,
+        db_index=True,
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    stripe_id = models.CharField(max_length=120, blank=True, null=True)
+    last_error = models.TextField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    completed = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ["id"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["kind", "object_id"],
+                condition=Q(status="pending"),
+                name="unique_pending_stripe_outbox",
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=["status", "next_attempt_at"], name="billing_outbox_due_idx"
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.kind} {self.object_id} ({self.status})"
+
+
+def enqueue(kind, object_id):
+    """
+    Queues the creation of the Stripe object of a row, once. Call it inside
+    the transaction that saves the row so both are committed together.
+
+    Returns:
+        StripeOutbox: The pending job.
+    """
+    job, _ = StripeOutbox.objects.get_or_create(
+        kind=kind, object_id=object_id, status=OutboxStatus.PENDING
+    )
+    return job
@@ -0,0 +1,86 @@
+from unittest import mock
+
+import stripe
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from billing import utils as billing_utils
+from billing.models import OutboxStatus, StripeOutbox
+from customers.models import Customer
+from subscriptions.models import Subscriptions, SubscriptionPrice
+
+User = get_user_model()
+
+
+def outage(*args, **kwargs):
+    raise stripe.APIConnectionError("Stripe is down")
+
+
+class StripeOutboxTestCase(TestCase):
+    @mock.patch("helpers.billing.create_customer", return_value="cus_1")
+    def test_customer_is_created_by_the_worker(self, create_customer):
+        user = User.objects.create(username="buyer")
+        customer = Customer.objects.create(
+            user=user, init_email="buyer@example.com", init_email_confirmed=True
+        )
+        # saving never calls Stripe
+        create_customer.assert_not_called()
+        job = StripeOutbox.objects.get()
+        customer.save()
+        self.assertEqual(StripeOutbox.objects.count(), 1)
+
+        self.assertEqual(billing_utils.process_outbox(), 1)
+        create_customer.assert_called_once_with(
+            email="buyer@example.com",
+            metadata={"user_id": user.id, "username": "buyer"},
+            idempotency_key=str(job.idempotency_key),
+        )
+        customer.refresh_from_db()
+        self.assertEqual(customer.stripe_id, "cus_1")
+        self.assertEqual(billing_utils.process_outbox(), 0)
+
+    def test_price_waits_for_its_product(self):
+        plan = Subscriptions.objects.create(name="Pro")
+        price = SubscriptionPrice.objects.create(subscription=plan)
+        with mock.patch("helpers.billing.create_product", side_effect=outage):
+            self.assertEqual(billing_utils.process_outbox(), 0)
+        product_job = StripeOutbox.objects.get(kind="product")
+        price_job = StripeOutbox.objects.get(kind="price")
+        self.assertEqual((product_job.attempts, price_job.attempts), (1, 1))
+        self.assertGreater(product_job.next_attempt_at, product_job.created)
+        self.assertIn("NotReady", price_job.last_error)
+
+        # retry right away
+        StripeOutbox.objects.update(next_attempt_at=product_job.created)
+        with mock.patch(
+            "helpers.billing.create_product", return_value="prod_1"
+        ), mock.patch("helpers.billing.create_price", return_value="price_1"):
+            self.assertEqual(billing_utils.process_outbox(), 2)
+        price.refresh_from_db()
+        self.assertEqual(price.stripe_id, "price_1")
+
+    def test_gives_up_after_max_attempts(self):
+        Subscriptions.objects.create(name="Pro")
+        job = StripeOutbox.objects.get()
+        with mock.patch("helpers.billing.create_product", side_effect=outage):
+            for _ in range(3):
+                StripeOutbox.objects.update(next_attempt_at=job.created)
+                billing_utils.process_outbox(max_attempts=3)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (OutboxStatus.FAILED, 3))
+        self.assertIn("Stripe is down", job.last_error)
+
+    def test_unexpected_error_does_not_block_the_queue(self):
+        Subscriptions.objects.create(name="Pro")
+        Subscriptions.objects.create(name="Basic")
+
+        def create_product(**kwargs):
+            if kwargs["name"] == "Pro":
+                raise KeyError("metadata")
+            return "prod_basic"
+
+        with mock.patch("helpers.billing.create_product", side_effect=create_product):
+            self.assertEqual(billing_utils.process_outbox(), 1)
+        job = StripeOutbox.objects.get(status=OutboxStatus.PENDING)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("KeyError", job.last_error)
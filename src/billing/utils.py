@@ -0,0 +1,168 @@
+import datetime
+import random
+
+import helpers.billing
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from billing.models import OutboxKind, OutboxStatus, StripeOutbox, enqueue
+from customers.models import Customer
+from subscriptions.models import SubscriptionPrice, Subscriptions
+
+class NotReady(Exception):
+    """The job needs a Stripe object that has not been created yet."""
+
+
+def without_stripe_id(model):
+    return model.objects.filter(Q(stripe_id__isnull=True) | Q(stripe_id=""))
+
+
+def create_customer(job):
+    obj = Customer.objects.select_related("user").filter(pk=job.object_id).first()
+    if obj is None or obj.stripe_id:
+        return obj and obj.stripe_id
+    stripe_id = helpers.billing.create_customer(
+        email=obj.init_email,
+        metadata={"user_id": obj.user.id, "username": obj.user.username},
+        idempotency_key=str(job.idempotency_key),
+    )
+    without_stripe_id(Customer).filter(pk=obj.pk).update(stripe_id=stripe_id)
+    return stripe_id
+
+
+def create_product(job):
+    obj = Subscriptions.objects.filter(pk=job.object_id).first()
+    if obj is None or obj.stripe_id:
+        return obj and obj.stripe_id
+    stripe_id = helpers.billing.create_product(
+        name=obj.name,
+        metadata={"subscription_plan_id": obj.pk},
+        idempotency_key=str(job.idempotency_key),
+    )
+    without_stripe_id(Subscriptions).filter(pk=obj.pk).update(stripe_id=stripe_id)
+    # the prices of the plan were waiting for its product
+    StripeOutbox.objects.filter(
+        kind=OutboxKind.PRICE,
+        status=OutboxStatus.PENDING,
+        object_id__in=obj.subscriptionprice_set.values("id"),
+    ).update(next_attempt_at=timezone.now())
+    return stripe_id
+
+
+def create_price(job):
+    obj = (
+        SubscriptionPrice.objects.select_related("subscription")
+        .filter(pk=job.object_id)
+        .first()
+    )
+    if obj is None or obj.stripe_id or obj.subscription is None:
+        return obj and obj.stripe_id
+    if not obj.product_stripe_id:
+        raise NotReady(f"Plan {obj.subscription_id} has no Stripe product yet.")
+    stripe_id = helpers.billing.create_price(
+        unit_amount=obj.stripe_price,
+        product=obj.product_stripe_id,
+        interval=obj.interval,
+        currency=obj.stripe_currency,
+        metadata={"subscription_plan_price_id": obj.pk},
+        idempotency_key=str(job.idempotency_key),
+    )
+    without_stripe_id(SubscriptionPrice).filter(pk=obj.pk).update(stripe_id=stripe_id)
+    return stripe_id
+
+
+HANDLERS = {
+    OutboxKind.CUSTOMER: create_customer,
+    OutboxKind.PRODUCT: create_product,
+    OutboxKind.PRICE: create_price,
+}
+
+
+def retry_delay(attempts, backoff=2.0, max_backoff=600.0):
+    """Exponential backoff with jitter, in seconds."""
+    delay = min(max_backoff, backoff * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def process_job(job, max_attempts=8, backoff=2.0, max_backoff=600.0):
+    """
+    Creates the Stripe object of a locked, pending outbox job and stores its
+    id on the row. Any error, including a price whose product is not in Stripe
+    yet, is recorded and retried later with exponential backoff until
+    `max_attempts`, then the job is marked failed.
+
+    Returns:
+        bool: True if the job is done.
+    """
+    now = timezone.now()
+    job.attempts += 1
+    try:
+        with transaction.atomic():
+            stripe_id = HANDLERS[job.kind](job)
+    except Exception as e:
+        # recorded, so a broken job can not block the ones after it
+        job.last_error = f"{type(e).__name__}: {e}"
+        if job.attempts >= max_attempts:
+            job.status = OutboxStatus.FAILED
+        delay = retry_delay(job.attempts, backoff=backoff, max_backoff=max_backoff)
+        job.next_attempt_at = now + datetime.timedelta(seconds=delay)
+        job.save(update_fields=["attempts", "last_error", "status", "next_attempt_at"])
+        if not isinstance(e, NotReady):
+            print("Failed to create Stripe", job, e)
+        return False
+    job.status = OutboxStatus.DONE
+    job.stripe_id = stripe_id
+    job.last_error = None
+    job.completed = now
+    job.save()
+    return True
+
+
+def process_outbox(limit=None, verbose=False, **options):
+    """
+    Drains the due outbox jobs in the order they were queued, each in its own
+    transaction with its row locked, so several workers can run at once.
+
+    Args:
+        **options: `max_attempts`, `backoff` and `max_backoff` of `process_job`.
+
+    Returns:
+        int: The number of jobs done.
+    """
+    due = StripeOutbox.objects.filter(
+        status=OutboxStatus.PENDING, next_attempt_at__lte=timezone.now()
+    )
+    ids = list(due.order_by("id").values_list("id", flat=True)[:limit])
+    count = 0
+    for job_id in ids:
+        with transaction.atomic():
+            job = (
+                StripeOutbox.objects.select_for_update(skip_locked=True)
+                .filter(id=job_id, status=OutboxStatus.PENDING)
+                .first()
+            )
+            if job is None:
+                continue
+            if process_job(job, **options):
+                count += 1
+                if verbose:
+                    print("Created Stripe", job.kind, job.stripe_id)
+    return count
+
+
+def ensure_customer_stripe_id(customer):
+    """
+    Returns the Stripe id of `customer`, creating it right away if the
+    worker has not yet, i.e. when the user checks out right after signing up.
+    None if Stripe failed, the job is then left to the worker.
+    """
+    if customer.stripe_id:
+        return customer.stripe_id
+    with transaction.atomic():
+        job = enqueue(OutboxKind.CUSTOMER, customer.pk)
+        job = StripeOutbox.objects.select_for_update().get(pk=job.pk)
+        if job.status == OutboxStatus.PENDING:
+            process_job(job)
+    customer.refresh_from_db(fields=["stripe_id"])
+    return customer.stripe_id
@@ -72,6 +72,7 @@ INSTALLED_APPS = [
     "subscriptions",
     "customers",
     "checkouts",
+    "billing",
     # third party apps
     "allauth_ui",
     "allauth",
@@ -89,8 +90,10 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "subscriptions.middleware.SubscriptionMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "allauth.account.middleware.AccountMiddleware",
+    "subscriptions.middleware.PlanGateMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 
@@ -136,6 +139,52 @@ if DATABASE_URL is not None:
         )
     }
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Use a shared backend (e.g. django.core.cache.backends.redis.RedisCache) in
+# production: plan and price changes reach the other processes through it, the
+# per-process default only suits a single process (check subscriptions.W001).
+CACHES = {
+    "default": {
+        "BACKEND": config(
+            "CACHE_BACKEND",
+            default="django.core.cache.backends.locmem.LocMemCache",
+        ),
+        "LOCATION": config("CACHE_LOCATION", default=""),
+    }
+}
+
+# Page visits are queued per worker and written in batches.
+# At most VISITS_BUFFER_MAX_PENDING visits per worker can be lost on a crash.
+VISITS_BUFFER_ENABLED = config("VISITS_BUFFER_ENABLED", cast=bool, default=True)
+VISITS_BUFFER_SIZE = config("VISITS_BUFFER_SIZE", cast=int, default=50)
+VISITS_BUFFER_MAX_AGE = config("VISITS_BUFFER_MAX_AGE", cast=float, default=10.0)
+VISITS_BUFFER_MAX_PENDING = config(
+    "VISITS_BUFFER_MAX_PENDING", cast=int, default=1000
+)
+# Visit totals are cached and incremented in place, the timeout bounds any drift.
+VISITS_COUNT_CACHE_TIMEOUT = config(
+    "VISITS_COUNT_CACHE_TIMEOUT", cast=int, default=60 * 60
+)
+
+# Permissions of a user (own, groups and plan), invalidated on changes.
+ENTITLEMENTS_CACHE_TIMEOUT = config(
+    "ENTITLEMENTS_CACHE_TIMEOUT", cast=int, default=60 * 60 * 24
+)
+
+# Rendered pricing grids, also invalidated on any plan or price change.
+PRICING_CACHE_TIMEOUT = config("PRICING_CACHE_TIMEOUT", cast=int, default=60 * 60 * 24)
+# Seconds browsers and the CDN reuse /api/pricing before revalidating it.
+PRICING_API_MAX_AGE = config("PRICING_API_MAX_AGE", cast=int, default=60)
+
+# Path prefixes restricted to plans with the listed subscriptions permissions,
+# i.e. {"/reports/": ["pro"]}, see subscriptions.middleware.PlanGateMiddleware.
+PLAN_GATED_PATHS = {}
+# Where subscribers without the required plan are sent.
+PLAN_REQUIRED_REDIRECT_URL = config(
+    "PLAN_REQUIRED_REDIRECT_URL", default="/pricing/month"
+)
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -193,8 +242,9 @@ STORAGES = {
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # Django All auth configs
 AUTHENTICATION_BACKENDS = [
-    # Needed to login by username in Django admin, regardless of `allauth`
-    "django.contrib.auth.backends.ModelBackend",
+    # Needed to login by username in Django admin, regardless of `allauth`.
+    # A ModelBackend serving permission checks from the entitlement cache.
+    "subscriptions.backends.EntitlementBackend",
     # `allauth` specific authentication methods, such as login by email
     "allauth.account.auth_backends.AuthenticationBackend",
 ]
@@ -18,6 +18,7 @@ urlpatterns = [
     ),
     path("accounts/", include("allauth.urls")),
     path("pricing/<str:interval>", subs_views.subscription_price_view, name="pricing"),
+    path("api/pricing", subs_views.pricing_api_view, name="pricing-api"),
     path(
         "checkout/sub-price/<int:price_id>",
         checkout_views.product_price_redirect_view,
@@ -33,6 +34,11 @@ urlpatterns = [
         checkout_views.checkout_finalized_view,
         name="stripe-checkout-end",
     ),
+    path(
+        "webhooks/stripe/",
+        checkout_views.stripe_webhook_view,
+        name="stripe-webhook",
+    ),
     # path("protected/", secret_view),
     # path("protected/user-only/", users_only_view),
     # path("protected/staff-only/", staff_only_view),
@@ -2,16 +2,15 @@ from django.shortcuts import render,HttpResponse
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
-from visits.models import PageVisits
+from visits.utils import get_path_visits, record_visit, visitor_id
 
 LOGIN_URL = settings.LOGIN_URL
 
 
 def home_page_view(request):
     print(LOGIN_URL)
-    queryset = PageVisits.objects.filter(path=request.path)
-    my_context = {"title": "Home", "count": queryset.count}
-    PageVisits.objects.create(path=request.path)
+    my_context = {"title": "Home", "count": get_path_visits(request.path)}
+    record_visit(request.path, visitor=visitor_id(request))
     return render(request, "home.html", context=my_context)
 
 
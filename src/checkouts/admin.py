@@ -1,3 +1,19 @@
 from django.contrib import admin
+from .models import FinalizedCheckout, StripeEvent
 
-# Register your models here.
+
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = ["event_id", "type", "created", "processed", "attempts"]
+    list_filter = ["type", "processed"]
+    readonly_fields = ["event_id", "type", "created", "payload", "received"]
+
+
+admin.site.register(StripeEvent, StripeEventAdmin)
+
+
+class FinalizedCheckoutAdmin(admin.ModelAdmin):
+    list_display = ["session_id", "user_subscription", "created"]
+    raw_id_fields = ["user_subscription"]
+
+
+admin.site.register(FinalizedCheckout, FinalizedCheckoutAdmin)
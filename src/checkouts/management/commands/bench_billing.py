@@ -0,0 +1,121 @@
+import time
+from typing import Any
+
+import helpers.billing
+import stripe
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import transaction
+from django.test import override_settings
+from helpers import stripe_cache, stripe_client
+from helpers.stripe_fake import FakeStripeClient
+
+from billing.utils import process_outbox
+from checkouts.utils import finalize_checkout_session
+from customers.models import Customer
+from subscriptions.models import Subscriptions, SubscriptionPrice
+from subscriptions import utils as subs_utils
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark checkout and subscription sync throughput against the fake "
+        "Stripe backend. Runs against a private in-memory cache and rolls "
+        "back everything written."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--users", default=200, type=int)
+        parser.add_argument("--workers", default=8, type=int)
+        parser.add_argument(
+            "--latency", default=0.05, type=float, help="Seconds per Stripe call"
+        )
+        parser.add_argument("--jitter", default=0.0, type=float)
+        parser.add_argument("--error-rate", default=0.0, type=float)
+        parser.add_argument("--seed", default=0, type=int)
+        return super().add_arguments(parser)
+
+    def report(self, label, count, elapsed):
+        self.stdout.write(
+            f"{label:<20} {count} in {elapsed:.2f}s ({count / elapsed:,.1f}/s)"
+        )
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        users = options.get("users")
+        workers = options.get("workers")
+        client = FakeStripeClient(
+            latency=options.get("latency"),
+            jitter=options.get("jitter"),
+            error_rate=options.get("error_rate"),
+            seed=options.get("seed"),
+        )
+        # the fake ids repeat from run to run, cached sessions and
+        # subscriptions must not outlive the run or reach a shared cache
+        private_cache = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "bench-billing",
+            }
+        }
+        previous_client = stripe.default_http_client
+        stripe_client.configure(http_client=client)
+        try:
+            with override_settings(CACHES=private_cache), transaction.atomic():
+                self.run(users, workers)
+                transaction.set_rollback(True)
+        finally:
+            stripe.default_http_client = previous_client
+
+    def run(self, users, workers):
+        plan = Subscriptions.objects.create(name="Bench plan")
+        price = SubscriptionPrice.objects.create(subscription=plan, price=9.99)
+        process_outbox()
+        price.refresh_from_db()
+        if price.stripe_id is None:
+            raise CommandError("The bench plan has no Stripe price.")
+
+        customers = []
+        for i in range(users):
+            user = User.objects.create(username=f"bench-billing-{i}")
+            stripe_id = helpers.billing.create_customer(
+                email=f"{user.username}@example.com"
+            )
+            customers.append(Customer.objects.create(user=user, stripe_id=stripe_id))
+
+        stripe_client.metrics.reset()
+        stripe_cache.stats.reset()
+        start = time.perf_counter()
+        session_ids = []
+        for customer in customers:
+            session = helpers.billing.start_checkout_session(
+                success_url="https://example.com/success",
+                cancel_url="https://example.com/cancel",
+                price_stripe_id=price.stripe_id,
+                customer_id=customer.stripe_id,
+                raw=True,
+            )
+            finalize_checkout_session(session.id)
+            session_ids.append(session.id)
+        self.report("checkout", users, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for session_id in session_ids:
+            finalize_checkout_session(session_id)
+        self.report("success page reload", users, time.perf_counter() - start)
+
+        user_ids = [customer.user_id for customer in customers]
+        for label, options in [
+            ("sync (1 worker)", {"workers": 1}),
+            (f"sync ({workers} workers)", {"workers": workers}),
+            ("sync (bulk)", {"bulk": True, "workers": workers}),
+        ]:
+            result = subs_utils.refresh_active_users_subscriptions(
+                user_ids=user_ids, **options
+            )
+            self.report(label, result.refreshed, result.elapsed)
+            if result.failed:
+                self.stdout.write(f"{'':<20} {result.failed} failed")
+        self.stdout.write(stripe_client.metrics.summary())
+        self.stdout.write(stripe_cache.stats.summary())
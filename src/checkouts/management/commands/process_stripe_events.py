@@ -0,0 +1,34 @@
+import time
+from typing import Any
+from django.core.management.base import BaseCommand, CommandParser
+
+from checkouts import utils as checkout_utils
+
+
+class Command(BaseCommand):
+    help = "Apply stored Stripe webhook events to the user subscriptions."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--limit", default=None, type=int)
+        parser.add_argument("--max-attempts", default=5, type=int)
+        parser.add_argument(
+            "--watch",
+            default=0,
+            type=float,
+            help="Keep running, checking for new events every N seconds",
+        )
+        return super().add_arguments(parser)
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        watch = options.get("watch")
+        while True:
+            count = checkout_utils.process_stripe_events(
+                limit=options.get("limit"),
+                max_attempts=options.get("max_attempts"),
+                verbose=options.get("verbosity") > 1,
+            )
+            if count or not watch:
+                self.stdout.write(f"Processed {count} Stripe events.")
+            if not watch:
+                break
+            time.sleep(watch)
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkouts', '0001_initial'),
+        ('subscriptions', '0021_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FinalizedCheckout',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(max_length=255, unique=True)),
+                ('subscription_existed', models.BooleanField(default=False, help_text='The checkout replaced an existing subscription')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('user_subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='subscriptions.usersubscription')),
+            ],
+        ),
+    ]
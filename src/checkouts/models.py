@@ -1,3 +1,44 @@
 from django.db import models
 
-# Create your models here.
+
+class StripeEvent(models.Model):
+    """
+    Stripe webhook event, stored once per Stripe event id and applied later by
+    `checkouts.utils.process_stripe_events` in the order Stripe created them.
+    """
+
+    event_id = models.CharField(max_length=120, unique=True)
+    type = models.CharField(max_length=120, db_index=True)
+    created = models.DateTimeField(help_text="When Stripe created the event")
+    payload = models.JSONField()
+    received = models.DateTimeField(auto_now_add=True)
+    processed = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = "Stripe Event"
+        verbose_name_plural = "Stripe Events"
+        ordering = ["created", "id"]
+
+    def __str__(self) -> str:
+        return f"{self.type} ({self.event_id})"
+
+
+class FinalizedCheckout(models.Model):
+    """
+    Checkout session already applied to a user subscription, so reloads of
+    the success page and the `checkout.session.completed` webhook skip Stripe.
+    """
+
+    session_id = models.CharField(max_length=255, unique=True)
+    user_subscription = models.ForeignKey(
+        "subscriptions.UserSubscription", on_delete=models.CASCADE
+    )
+    subscription_existed = models.BooleanField(
+        default=False, help_text="The checkout replaced an existing subscription"
+    )
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return self.session_id
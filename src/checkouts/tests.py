@@ -1,3 +1,253 @@
+import hashlib
+import hmac
+import json
+import time
+from io import StringIO
+from unittest import mock
+
+import stripe
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import transaction
 from django.test import TestCase
+from django.urls import reverse
+
+import helpers.billing
+from billing.utils import process_outbox
+from checkouts import utils as checkout_utils
+from checkouts.models import FinalizedCheckout, StripeEvent
+from customers.models import Customer
+from helpers import stripe_cache, stripe_client
+from helpers.stripe_fake import FakeStripeClient
+from subscriptions.models import SubscriptionPrice, Subscriptions, UserSubscription
+
+User = get_user_model()
+
+WEBHOOK_SECRET = "whsec_test_secret"
+
+
+def sign_payload(payload, secret=WEBHOOK_SECRET, timestamp=None):
+    """Builds a `Stripe-Signature` header the way Stripe signs webhooks."""
+    timestamp = timestamp or int(time.time())
+    signed = f"{timestamp}.{payload}".encode()
+    signature = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def subscription_data(status, sub_id="sub_123"):
+    now = int(time.time())
+    return {
+        "id": sub_id,
+        "object": "subscription",
+        "customer": "cus_123",
+        "status": status,
+        "current_period_start": now,
+        "current_period_end": now + 3600,
+        "cancel_at_period_end": status == "canceled",
+        "plan": None,
+    }
+
+
+def subscription_event(
+    event_id, created, status, sub_id="sub_123", type="customer.subscription.updated"
+):
+    return {
+        "id": event_id,
+        "object": "event",
+        "type": type,
+        "created": created,
+        "data": {"object": subscription_data(status, sub_id=sub_id)},
+    }
+
+
+@mock.patch.object(helpers.billing, "STRIPE_WEBHOOK_SECRET", WEBHOOK_SECRET)
+class StripeWebhookTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="buyer")
+        Customer.objects.create(user=self.user, stripe_id="cus_123")
+        UserSubscription.objects.create(
+            user=self.user, stripe_id="sub_123", status="active"
+        )
+        # the subscription as Stripe has it now
+        self.stripe_status = "active"
+        patcher = mock.patch.object(
+            helpers.billing, "get_subscription", side_effect=self.get_subscription
+        )
+        self.get_subscription_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_subscription(self, subscription_id, raw=False, cached=True):
+        data = subscription_data(self.stripe_status, sub_id=subscription_id)
+        return stripe.Subscription.construct_from(data, "sk_test")
+
+    def post_event(self, event, secret=WEBHOOK_SECRET, timestamp=None):
+        payload = json.dumps(event)
+        return self.client.post(
+            reverse("stripe-webhook"),
+            data=payload,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=sign_payload(
+                payload, secret=secret, timestamp=timestamp
+            ),
+        )
+
+    def test_events_are_stored_once(self):
+        event = subscription_event("evt_1", 100, "past_due")
+        self.assertEqual(self.post_event(event).status_code, 200)
+        self.assertEqual(self.post_event(event).status_code, 200)
+        self.assertEqual(StripeEvent.objects.count(), 1)
+
+    def test_invalid_signature_is_rejected(self):
+        event = subscription_event("evt_1", 100, "past_due")
+        response = self.post_event(event, secret="whsec_wrong")
+        self.assertEqual(response.status_code, 400)
+        # replayed after the tolerance
+        response = self.post_event(event, timestamp=int(time.time()) - 3600)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    def test_events_are_applied_in_created_order(self):
+        self.stripe_status = "canceled"
+        # received out of order
+        self.post_event(subscription_event("evt_2", 200, "canceled"))
+        self.post_event(subscription_event("evt_1", 100, "past_due"))
+        self.assertEqual(checkout_utils.process_stripe_events(), 2)
+        user_sub = UserSubscription.objects.get(user=self.user)
+        self.assertEqual(user_sub.status, "canceled")
+        self.assertTrue(user_sub.cancel_at_period_end)
+        self.assertEqual(checkout_utils.process_stripe_events(), 0)
+
+    def test_retried_event_does_not_undo_a_later_one(self):
+        self.post_event(subscription_event("evt_1", 100, "past_due"))
+        self.post_event(
+            subscription_event(
+                "evt_2", 200, "canceled", type="customer.subscription.deleted"
+            )
+        )
+        self.stripe_status = "canceled"
+        self.get_subscription_mock.side_effect = [
+            stripe.APIConnectionError("timeout"),
+            self.get_subscription("sub_123"),
+        ]
+        self.assertEqual(checkout_utils.process_stripe_events(), 1)
+        self.assertEqual(
+            UserSubscription.objects.get(user=self.user).status, "canceled"
+        )
+
+        # the updated event is retried after the deleted one was applied
+        self.get_subscription_mock.side_effect = self.get_subscription
+        self.assertEqual(checkout_utils.process_stripe_events(), 1)
+        self.assertEqual(
+            UserSubscription.objects.get(user=self.user).status, "canceled"
+        )
+        self.get_subscription_mock.assert_called_with(
+            "sub_123", raw=True, cached=False
+        )
+
+    def test_failing_event_does_not_block_the_queue(self):
+        self.post_event(subscription_event("evt_1", 100, "past_due"))
+        self.post_event(subscription_event("evt_2", 200, "canceled"))
+
+        def broken(sub_r):
+            if sub_r.status == "past_due":
+                raise KeyError("plan")
+            return True
+
+        with mock.patch.object(checkout_utils, "apply_subscription_event", broken):
+            self.assertEqual(checkout_utils.process_stripe_events(), 1)
+            self.assertEqual(checkout_utils.process_stripe_events(max_attempts=2), 0)
+        event = StripeEvent.objects.get(event_id="evt_1")
+        self.assertEqual(event.attempts, 2)
+        self.assertIn("KeyError", event.error)
+        self.assertIsNone(event.processed)
+        self.assertIsNotNone(StripeEvent.objects.get(event_id="evt_2").processed)
+
+
+class CheckoutFinalizedTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.previous_client = stripe.default_http_client
+        stripe_client.configure(http_client=FakeStripeClient())
+        self.plan = Subscriptions.objects.create(name="Pro")
+        price = SubscriptionPrice.objects.create(subscription=self.plan)
+        self.user = User.objects.create(username="buyer")
+        Customer.objects.create(
+            user=self.user, init_email="buyer@example.com", init_email_confirmed=True
+        )
+        process_outbox()
+        price.refresh_from_db()
+        self.session = helpers.billing.start_checkout_session(
+            price_stripe_id=price.stripe_id,
+            customer_id=Customer.objects.get(user=self.user).stripe_id,
+            raw=True,
+        )
+        stripe_client.metrics.reset()
+
+    def tearDown(self):
+        stripe.default_http_client = self.previous_client
+
+    def test_reload_is_served_from_the_record(self):
+        url = reverse("stripe-checkout-end") + f"?session_id={self.session.id}"
+        self.assertEqual(self.client.get(url).status_code, 200)
+        # the session is retrieved with its subscription in one request
+        calls = {k: v["calls"] for k, v in stripe_client.metrics.snapshot().items()}
+        self.assertEqual(calls, {"GET /v1/checkout/sessions/{id}": 1})
+        user_sub = UserSubscription.objects.get(user=self.user)
+        self.assertEqual(user_sub.subscription, self.plan)
+        self.assertEqual(user_sub.stripe_id, self.session.subscription)
+
+        stripe_client.metrics.reset()
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(stripe_client.metrics.snapshot(), {})
+        self.assertEqual(FinalizedCheckout.objects.count(), 1)
+
+    def test_replaced_subscription_is_cancelled_after_commit(self):
+        UserSubscription.objects.create(user=self.user, stripe_id="sub_old")
+        data = helpers.billing.get_checkout_customer_plan(self.session.id)
+        with mock.patch("helpers.billing.cancel_subscription") as cancel:
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(RuntimeError), transaction.atomic():
+                    checkout_utils.finalize_checkout(data)
+                    raise RuntimeError("rolled back")
+            cancel.assert_not_called()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                checkout_utils.finalize_checkout_session(self.session.id, data)
+            cancel.assert_called_once_with(
+                subscription_id="sub_old", reason="Auto ended new membership"
+            )
+
+
+class CheckoutRedirectTestCase(TestCase):
+    def test_stripe_failure_redirects_to_pricing(self):
+        plan = Subscriptions.objects.create(name="Pro")
+        price = SubscriptionPrice.objects.create(subscription=plan)
+        SubscriptionPrice.objects.filter(pk=price.pk).update(stripe_id="price_1")
+        user = User.objects.create(username="buyer")
+        Customer.objects.create(user=user, init_email="buyer@example.com")
+        self.client.force_login(user)
+        session = self.client.session
+        session["checkout_subscription_price_id"] = price.pk
+        session.save()
+        with mock.patch(
+            "helpers.billing.create_customer",
+            side_effect=stripe.APIConnectionError("Stripe is down"),
+        ), mock.patch("helpers.billing.start_checkout_session") as start:
+            response = self.client.get(reverse("stripe-checkout-start"))
+        pricing_url = reverse("pricing", kwargs={"interval": "month"})
+        self.assertRedirects(response, pricing_url, fetch_redirect_response=False)
+        start.assert_not_called()
+
 
-# Create your tests here.
+class BenchBillingTestCase(TestCase):
+    def test_bench_leaves_the_shared_cache_alone(self):
+        store = mock.Mock(wraps=stripe_cache.store)
+        with mock.patch.object(stripe_cache, "store", store):
+            call_command(
+                "bench_billing", users=2, workers=1, latency=0, stdout=StringIO()
+            )
+        keys = [stripe_cache.cache_key(*call.args[:2]) for call in store.call_args_list]
+        self.assertTrue(keys)
+        self.assertEqual(cache.get_many(keys), {})
+        self.assertFalse(User.objects.filter(username__startswith="bench").exists())
@@ -0,0 +1,254 @@
+import datetime
+import helpers.billing
+import stripe
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.db.models import Subquery
+from django.utils import timezone
+from helpers import stripe_cache
+
+from checkouts.models import FinalizedCheckout, StripeEvent
+from subscriptions.models import SubscriptionPrice, UserSubscription
+from subscriptions import utils as subs_utils
+
+User = get_user_model()
+
+SUBSCRIPTION_EVENTS = [
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+    "customer.subscription.paused",
+    "customer.subscription.resumed",
+]
+CHECKOUT_EVENTS = ["checkout.session.completed"]
+
+
+def cancel_replaced_subscription(stripe_id):
+    """Cancels the Stripe subscription a finalized checkout replaced."""
+    try:
+        helpers.billing.cancel_subscription(
+            subscription_id=stripe_id,
+            reason="Auto ended new membership",
+        )
+    except stripe.StripeError as e:
+        print("Failed to cancel replaced subscription", stripe_id, e)
+
+
+def finalize_checkout(checkout_data):
+    """
+    Applies a completed checkout to the user's subscription.
+
+    If the user already has a subscription, the row is updated with the new
+    plan and the previous Stripe subscription is cancelled after commit. The user, their
+    subscription and the plan of the paid price are loaded in one query.
+
+    Args:
+        checkout_data (dict): The data from `helpers.billing.get_checkout_customer_plan`.
+
+    Returns:
+        tuple: `(user_sub_obj, existed)`, `user_sub_obj` is None if the plan
+               or the user could not be found.
+    """
+    checkout_data = {**checkout_data}
+    customer_id = checkout_data.pop("customer_id")
+    plan_id = checkout_data.pop("sub_plan_id")
+    sub_stripe_id = checkout_data.pop("sub_stripe_id")
+    subscription_data = {**checkout_data}
+
+    plan_qs = (
+        SubscriptionPrice.objects.by_stripe_id(plan_id)
+        .filter(subscription__isnull=False)
+        .values("subscription_id")
+    )
+    user_obj = (
+        User.objects.filter(customer__stripe_id=customer_id)
+        .select_related("usersubscription")
+        .annotate(paid_plan_id=Subquery(plan_qs[:1]))
+        .first()
+    )
+    if user_obj is None or user_obj.paid_plan_id is None:
+        return None, False
+
+    updated_sub_options = {
+        "subscription_id": user_obj.paid_plan_id,
+        "stripe_id": sub_stripe_id,
+        "user_cancelled": False,
+        **subscription_data,
+    }
+    try:
+        user_sub_obj = user_obj.usersubscription
+    except UserSubscription.DoesNotExist:
+        user_sub_obj = UserSubscription.objects.create(
+            user=user_obj, **updated_sub_options
+        )
+        return user_sub_obj, False
+
+    # cancel the old subscription unless it is the one just paid for, once
+    # the new one is committed: a cancel can not be rolled back
+    old_sub_stripe_id = user_sub_obj.stripe_id
+    if old_sub_stripe_id is not None and old_sub_stripe_id != sub_stripe_id:
+        transaction.on_commit(
+            lambda: cancel_replaced_subscription(old_sub_stripe_id), robust=True
+        )
+    # assign new subscriptions
+    for k, v in updated_sub_options.items():
+        setattr(user_sub_obj, k, v)
+    user_sub_obj.save()
+    return user_sub_obj, True
+
+
+def finalize_checkout_session(session_id, checkout_data=None):
+    """
+    Finalizes a checkout session once. Sessions already finalized are served
+    from their `FinalizedCheckout` record without calling Stripe.
+
+    Args:
+        checkout_data (dict, optional): The session data when already known,
+                                        otherwise it is retrieved from Stripe.
+
+    Returns:
+        tuple: `(user_sub_obj, existed)` like `finalize_checkout`.
+    """
+    record = (
+        FinalizedCheckout.objects.select_related("user_subscription__subscription")
+        .filter(session_id=session_id)
+        .first()
+    )
+    if record is not None:
+        return record.user_subscription, record.subscription_existed
+    if checkout_data is None:
+        checkout_data = helpers.billing.get_checkout_customer_plan(session_id)
+    with transaction.atomic():
+        user_sub_obj, existed = finalize_checkout(checkout_data)
+        if user_sub_obj is not None:
+            FinalizedCheckout.objects.get_or_create(
+                session_id=session_id,
+                defaults={
+                    "user_subscription": user_sub_obj,
+                    "subscription_existed": existed,
+                },
+            )
+    return user_sub_obj, existed
+
+
+def store_stripe_event(event_data):
+    """
+    Persists a verified webhook event once per Stripe event id.
+
+    Returns:
+        bool: True if the event is new, False if it was already stored.
+    """
+    try:
+        with transaction.atomic():
+            StripeEvent.objects.create(
+                event_id=event_data["id"],
+                type=event_data["type"],
+                created=datetime.datetime.fromtimestamp(
+                    event_data["created"], tz=datetime.UTC
+                ),
+                payload=event_data,
+            )
+    except IntegrityError:
+        return False
+    return True
+
+
+def apply_subscription_event(sub_r):
+    """
+    Applies a `customer.subscription.*` event to the matching UserSubscription.
+
+    The event only says which subscription changed. Its current state is
+    retrieved from Stripe, so an event retried after newer ones, or created
+    in the same second, can not overwrite a later change with its payload.
+    """
+    sub_r = helpers.billing.get_subscription(sub_r.id, raw=True, cached=False)
+    stripe_cache.invalidate("customer_subscriptions", sub_r.customer)
+    user_sub_obj = UserSubscription.objects.by_stripe_id(sub_r.id).first()
+    if user_sub_obj is None:
+        # a subscription created before the checkout was finalized
+        user_sub_obj = (
+            UserSubscription.objects.filter(
+                user__customer__stripe_id=sub_r.customer, stripe_id__isnull=True
+            ).first()
+        )
+        if user_sub_obj is None:
+            return False
+        user_sub_obj.stripe_id = sub_r.id
+    sub_data = subs_utils.serialize_sync_data(sub_r)
+    plans_by_price_id = dict(
+        SubscriptionPrice.objects.by_stripe_id(sub_data["price_stripe_id"])
+        .order_by()
+        .values_list("stripe_id", "subscription_id")
+    )
+    subs_utils.apply_sync_data(user_sub_obj, sub_data, plans_by_price_id)
+    user_sub_obj.save()
+    return True
+
+
+def apply_checkout_event(session):
+    """Finalizes a completed checkout session, like the checkout success page does."""
+    if session.mode != "subscription" or not session.subscription:
+        return False
+    if FinalizedCheckout.objects.filter(session_id=session.id).exists():
+        return False
+    sub_r = helpers.billing.get_subscription(session.subscription, raw=True)
+    checkout_data = {
+        "customer_id": session.customer,
+        "sub_plan_id": sub_r.plan.id,
+        "sub_stripe_id": sub_r.id,
+        **helpers.billing.serialize_subscription_data(sub_r),
+    }
+    user_sub_obj, _ = finalize_checkout_session(session.id, checkout_data)
+    return user_sub_obj is not None
+
+
+def process_stripe_event(event):
+    event_object = helpers.billing.construct_event_object(event.payload)
+    if event.type in SUBSCRIPTION_EVENTS:
+        return apply_subscription_event(event_object)
+    if event.type in CHECKOUT_EVENTS:
+        return apply_checkout_event(event_object)
+    return False
+
+
+def process_stripe_events(limit=None, max_attempts=5, verbose=False):
+    """
+    Applies the stored, unprocessed Stripe events in the order Stripe created them.
+
+    Each event is applied in its own transaction with its row locked, so
+    several processors never apply the same event. An event whose handler
+    raises is rolled back and retried on the next run, up to `max_attempts`
+    times, after the events that follow it.
+
+    Returns:
+        int: The number of events processed.
+    """
+    qs = StripeEvent.objects.filter(processed__isnull=True, attempts__lt=max_attempts)
+    ids = list(qs.order_by("created", "id").values_list("id", flat=True)[:limit])
+    count = 0
+    for event_id in ids:
+        with transaction.atomic():
+            event = (
+                StripeEvent.objects.select_for_update(skip_locked=True)
+                .filter(id=event_id, processed__isnull=True)
+                .first()
+            )
+            if event is None:
+                continue
+            event.attempts += 1
+            try:
+                with transaction.atomic():
+                    applied = process_stripe_event(event)
+            except Exception as e:
+                # recorded, so a broken event can not block the ones after it
+                event.error = f"{type(e).__name__}: {e}"
+                event.save(update_fields=["attempts", "error"])
+                print("Failed to process", event, e)
+                continue
+            event.processed = timezone.now()
+            event.error = None
+            event.save(update_fields=["attempts", "error", "processed"])
+            count += 1
+            if verbose:
+                print("Processed", event, "" if applied else "(nothing to apply)")
+    return count
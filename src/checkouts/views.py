@@ -1,11 +1,16 @@
 import helpers.billing
+import stripe
 from django.contrib import messages
 from django.shortcuts import render, redirect
 from django.urls import reverse
-from django.http import HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
-from subscriptions.models import SubscriptionPrice, Subscriptions, UserSubscription
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from billing.utils import ensure_customer_stripe_id
+from checkouts.utils import finalize_checkout_session, store_stripe_event
+from subscriptions.models import SubscriptionPrice
 
 User = get_user_model()
 
@@ -24,13 +29,21 @@ def checkout_redirect_view(request):
         obj = SubscriptionPrice.objects.get(id=checkout_subscription_price_id)
     except:
         obj = None
+    pricing_url = reverse("pricing", kwargs={"interval": "month"})
     if checkout_subscription_price_id is None or obj is None:
-        return redirect(reverse("pricing"))
-
-    customer_stripe_id = request.user.customer.stripe_id
+        return redirect(pricing_url)
+    if not obj.stripe_id:
+        messages.error(request, "This plan is not available yet, try again soon.")
+        return redirect(pricing_url)
+
+    customer_stripe_id = ensure_customer_stripe_id(request.user.customer)
+    if not customer_stripe_id:
+        # Stripe failed, the outbox worker retries creating the customer
+        messages.error(request, "Checkout is not available right now, try again soon.")
+        return redirect(pricing_url)
     base_url = request.scheme + "://" + request.get_host()
     success_url = base_url + reverse("stripe-checkout-end")
-    cancel_url = base_url + reverse("pricing", kwargs={"interval": "month"})
+    cancel_url = base_url + pricing_url
 
     url = helpers.billing.start_checkout_session(
         customer_id=customer_stripe_id,
@@ -48,7 +61,7 @@ def checkout_finalized_view(request):
     This view retrieves the checkout session details using the session ID from the request,
     extracts customer and subscription information, and updates the user's subscription
     in the database. If the user already has a subscription, the previous one is canceled
-    and updated with the new plan.
+    and updated with the new plan. Reloads of an already finalized session do not call Stripe.
 
     Args:
         request (HttpRequest): The HTTP request object containing the session ID.
@@ -60,62 +73,14 @@ def checkout_finalized_view(request):
         HttpResponseBadRequest: If there is an issue with retrieving the subscription or user information.
     """
     session_id = request.GET.get("session_id")
-    checkout_data = helpers.billing.get_checkout_customer_plan(session_id)
-
-    # unpack the checkout data
-    customer_id = checkout_data.pop("customer_id")
-    plan_id = checkout_data.pop("sub_plan_id")
-    sub_stripe_id = checkout_data.pop("sub_stripe_id")
-    subscription_data = {**checkout_data}
-
-    try:
-        sub_obj = Subscriptions.objects.get(subscriptionprice__stripe_id=plan_id)
-    except:
-        sub_obj = None
+    user_sub_obj, user_sub_exists = finalize_checkout_session(session_id)
 
-    try:
-        user_obj = User.objects.get(customer__stripe_id=customer_id)
-    except:
-        user_obj = None
-
-    user_sub_exists = False
-    updated_sub_options = {
-        "subscription": sub_obj,
-        "stripe_id": sub_stripe_id,
-        "user_cancelled": False,
-        **subscription_data,
-    }
-    try:
-        user_sub_obj = UserSubscription.objects.get(user=user_obj)
-        user_sub_exists = True
-
-    except UserSubscription.DoesNotExist:
-        user_sub_obj = UserSubscription.objects.create(
-            user=user_obj, **updated_sub_options
-        )
-    except:
-        user_sub_obj = None
-
-    if None in [sub_obj, user_obj, user_sub_obj]:
+    if user_sub_obj is None:
         return HttpResponseBadRequest(
             "There was an error with your account, please contact us."
         )
 
     if user_sub_exists:
-        # cancel the old subscription
-        old_sub_stripe_id = user_sub_obj.stripe_id
-        # check if the new plan is similar to current plan
-        same_stripe_id = user_sub_obj.stripe_id == old_sub_stripe_id
-
-        if old_sub_stripe_id is not None and not same_stripe_id:
-            cancel_id = helpers.billing.cancel_subscription(
-                subscription_id=old_sub_stripe_id,
-                reason="Auto ended new membership",
-            )
-        # assign new subscriptions
-        for k, v in updated_sub_options.items():
-            setattr(user_sub_obj, k, v)
-        user_sub_obj.save()
         messages.success(request, "Success ! Thank you for joining us.")
         return redirect(user_sub_obj.get_absolute_url())
 
@@ -124,3 +89,23 @@ def checkout_finalized_view(request):
         "checkouts/success.html",
         {"obj": user_sub_obj},
     )
+
+
+@csrf_exempt
+@require_POST
+def stripe_webhook_view(request):
+    """
+    Receives Stripe webhook events.
+
+    The signature is verified and the event is stored once per event id, the
+    event itself is applied later by the `process_stripe_events` command so
+    Stripe gets its 200 response right away.
+    """
+    try:
+        event_data = helpers.billing.verify_webhook_event(
+            request.body, request.headers.get("Stripe-Signature")
+        )
+    except (ValueError, stripe.SignatureVerificationError):
+        return HttpResponseBadRequest("Invalid payload or signature")
+    store_stripe_event(event_data)
+    return HttpResponse(status=200)
@@ -0,0 +1,24 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:18
+
+import helpers.stripe_ids
+from django.db import migrations
+
+
+def dedupe_stripe_ids(apps, schema_editor):
+    # customers without an id get a new Stripe customer when saved, so
+    # duplicates are reported rather than cleared
+    Customer = apps.get_model("customers", "Customer")
+    helpers.stripe_ids.dedupe_stripe_ids(Customer, clear_duplicates=False)
+
+
+class Migration(migrations.Migration):
+    # the unique index is added by the next migration, as Postgres can not
+    # alter a table with pending updates in the same transaction
+
+    dependencies = [
+        ('customers', '0002_customer_init_email_customer_init_email_confirmed'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_stripe_ids, migrations.RunPython.noop),
+    ]
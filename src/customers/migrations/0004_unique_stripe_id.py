@@ -0,0 +1,19 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:18
+
+import helpers.stripe_ids
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0003_dedupe_stripe_ids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='customer',
+            name='stripe_id',
+            field=helpers.stripe_ids.StripeIdField(blank=True, max_length=120, null=True, unique=True),
+        ),
+    ]
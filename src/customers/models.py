@@ -1,6 +1,7 @@
-import helpers.billing
+from billing.models import OutboxKind, enqueue
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from helpers.stripe_ids import StripeIdField, StripeIdQuerySet
 from allauth.account.signals import (
     user_signed_up as allauth_user_signed_up,
     email_confirmed as allauth_email_confirmed,
@@ -11,27 +12,21 @@ User = settings.AUTH_USER_MODEL
 
 class Customer(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    stripe_id = models.CharField(max_length=120, null=True, blank=True)
+    stripe_id = StripeIdField()
     init_email = models.EmailField(blank=True, null=True)
     init_email_confirmed = models.BooleanField(default=False)
 
+    objects = StripeIdQuerySet.as_manager()
+
     def __str__(self) -> str:
         return self.user.username
 
     def save(self, *args, **kwargs):
-        if not self.stripe_id:
-            if self.init_email_confirmed and self.init_email:
-                email = self.init_email
-                if email is not None:
-                    stripe_id = helpers.billing.create_customer(
-                        email=email,
-                        metadata={
-                            "user_id": self.user.id,
-                            "username": self.user.username,
-                        },
-                    )
-                    self.stripe_id = stripe_id
-        super().save(*args, **kwargs)
+        # the Stripe customer is created by the billing worker
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if not self.stripe_id and self.init_email_confirmed and self.init_email:
+                enqueue(OutboxKind.CUSTOMER, self.pk)
 
 
 def allauth_user_signed_up_handler(request, user, *args, **kwargs):
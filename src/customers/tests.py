@@ -1,3 +1,63 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError
 from django.test import TestCase
 
-# Create your tests here.
+from billing.models import StripeOutbox
+from customers.models import Customer
+from helpers.stripe_ids import dedupe_stripe_ids
+
+User = get_user_model()
+
+
+class StripeIdTestCase(TestCase):
+    def create_customer(self, username, stripe_id):
+        user = User.objects.create(username=username)
+        return Customer.objects.create(user=user, stripe_id=stripe_id)
+
+    def test_stripe_ids_are_normalized(self):
+        customer = self.create_customer("a", " cus_Ab1 \n")
+        self.assertEqual(customer.stripe_id, "cus_Ab1")
+        # blank ids are stored as NULL, which the unique index allows twice
+        self.create_customer("b", "")
+        self.create_customer("c", None)
+        self.assertEqual(Customer.objects.filter(stripe_id__isnull=True).count(), 2)
+
+        self.assertEqual(Customer.objects.by_stripe_id(" cus_Ab1").get(), customer)
+        # Stripe ids are case sensitive
+        self.assertFalse(Customer.objects.by_stripe_id("cus_ab1").exists())
+        self.assertFalse(Customer.objects.by_stripe_id(["", None]).exists())
+
+    def test_stripe_ids_are_unique(self):
+        self.create_customer("a", "cus_1")
+        with self.assertRaises(IntegrityError):
+            self.create_customer("b", "cus_1 ")
+
+
+class DedupeStripeIdsTestCase(TestCase):
+    def historical_model(self, stripe_ids):
+        # the unique index forbids real duplicates, the rows are given as-is
+        model = mock.MagicMock(__name__="Subscriptions")
+        rows = [
+            SimpleNamespace(pk=pk, stripe_id=stripe_id)
+            for pk, stripe_id in enumerate(stripe_ids, start=1)
+        ]
+        model.objects.exclude.return_value.order_by.return_value.only.return_value = (
+            rows
+        )
+        return model, rows
+
+    def test_duplicates_are_cleared_on_newer_rows(self):
+        model, rows = self.historical_model(["sub_1", " sub_1", "sub_2", ""])
+        self.assertEqual(dedupe_stripe_ids(model), 1)
+        stripe_ids = [row.stripe_id for row in rows]
+        self.assertEqual(stripe_ids, ["sub_1", None, "sub_2", None])
+
+    def test_duplicates_are_reported_without_clearing(self):
+        model, _ = self.historical_model(["prod_1", "prod_1 ", "prod_2"])
+        with self.assertRaisesMessage(ValueError, "prod_1: [1, 2]"):
+            dedupe_stripe_ids(model, clear_duplicates=False)
+        model.objects.bulk_update.assert_not_called()
+        self.assertFalse(StripeOutbox.objects.exists())
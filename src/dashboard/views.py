@@ -1,4 +1,13 @@
 from django.shortcuts import render
 
+from visits.utils import get_total_visits, unique_visitors_summary
+
+
 def dashboard_view(request):
-    return render(request,"dashboard/main.html")
\ No newline at end of file
+    context = {}
+    if request.user.is_staff:
+        context["visitor_stats"] = {
+            "total_visits": get_total_visits(),
+            **unique_visitors_summary(),
+        }
+    return render(request, "dashboard/main.html", context)
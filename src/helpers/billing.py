@@ -1,13 +1,17 @@
+import json
 import stripe
 from decouple import config
-from . import date_utils
+from . import date_utils, stripe_cache, stripe_client
 
 
 DJANGO_DEBUG = config("DJANGO_DEBUG", default=True, cast=bool)
 STRIPE_API_KEY = config("STRIPE_API_KEY", cast=str, default=None)
+STRIPE_WEBHOOK_SECRET = config("STRIPE_WEBHOOK_SECRET", cast=str, default=None)
 stripe.api_key = STRIPE_API_KEY
 if "sk_test" in STRIPE_API_KEY and not DJANGO_DEBUG:
     raise ValueError("Invalid stripe key for production purposes")
+# every call below goes through the pooled, instrumented http client
+stripe_client.configure()
 
 
 def serialize_subscription_data(sub_r):
@@ -35,16 +39,27 @@ def serialize_subscription_data(sub_r):
     }
 
 
-def create_customer(name="", email="", metadata={}, raw=False):
-    response = stripe.Customer.create(name=name, email=email, metadata=metadata)
+def request_options(idempotency_key=None):
+    """Stripe reuses the response of the first request made with the same key."""
+    if idempotency_key is None:
+        return {}
+    return {"idempotency_key": idempotency_key}
+
+
+def create_customer(name="", email="", metadata={}, idempotency_key=None, raw=False):
+    response = stripe.Customer.create(
+        name=name, email=email, metadata=metadata, **request_options(idempotency_key)
+    )
     if raw:
         return response
     stripe_id = response.id
     return stripe_id
 
 
-def create_product(name="", metadata={}, raw=False):
-    response = stripe.Product.create(name=name, metadata=metadata)
+def create_product(name="", metadata={}, idempotency_key=None, raw=False):
+    response = stripe.Product.create(
+        name=name, metadata=metadata, **request_options(idempotency_key)
+    )
     if raw:
         return response
     stripe_id = response.id
@@ -57,6 +72,7 @@ def create_price(
     unit_amount="9999",
     interval="month",
     metadata={},
+    idempotency_key=None,
     raw=False,
 ):
     if product is None:
@@ -67,6 +83,7 @@ def create_price(
         product=product,
         recurring={"interval": interval},
         metadata=metadata,
+        **request_options(idempotency_key),
     )
 
     if raw:
@@ -97,22 +114,75 @@ def start_checkout_session(
     return response.url
 
 
-def get_checkout_session(session_id, raw=False):
-    response = stripe.checkout.Session.retrieve(id=session_id)
+def get_checkout_session(session_id, raw=False, cached=True, expand=None):
+    """
+    Retrieves a checkout session, `expand` (i.e. `["subscription"]`) returns
+    the listed related objects within the session instead of their ids.
+    """
+    cache_id = ":".join([session_id, *expand]) if expand else session_id
+    # open sessions can still be completed, only finished ones are cached
+    response = stripe_cache.get_or_fetch(
+        "checkout.session",
+        cache_id,
+        lambda: stripe.checkout.Session.retrieve(id=session_id, expand=expand or []),
+        cached=cached,
+        cacheable=lambda r: r.status in ("complete", "expired"),
+    )
     if raw:
         return response
     return response.id
 
 
-def get_subscription(subscription_id, raw=False):
-    response = stripe.Subscription.retrieve(id=subscription_id)
+def get_subscription(subscription_id, raw=False, cached=True):
+    """
+    Retrieves a subscription, served from the cache for up to
+    `STRIPE_SUBSCRIPTION_CACHE_TIMEOUT` seconds. `cached=False` always asks
+    Stripe and refreshes the cached copy.
+    """
+    response = stripe_cache.get_or_fetch(
+        "subscription",
+        subscription_id,
+        lambda: stripe.Subscription.retrieve(id=subscription_id),
+        cached=cached,
+    )
     if raw:
         return response
     return serialize_subscription_data(response)
 
 
-def get_customer_active_subscriptions(customer_stripe_id):
-    response = stripe.Subscription.list(customer=customer_stripe_id, status="active")
+def list_subscriptions(
+    status="all", current_period_end=None, created=None, customer=None, limit=100
+):
+    """
+    Streams subscriptions from Stripe, fetching `limit` (max 100) per page.
+
+    Args:
+        status (str): Stripe status filter, `all` includes canceled subscriptions.
+        current_period_end (dict, optional): Range filter i.e. `{"gte": 1733011200}`.
+        created (dict, optional): Range filter on the creation timestamp.
+        customer (str, optional): Only subscriptions of this customer.
+
+    Yields:
+        stripe.Subscription: Raw subscription responses, page after page.
+    """
+    params = {"status": status, "limit": limit}
+    if current_period_end:
+        params["current_period_end"] = current_period_end
+    if created:
+        params["created"] = created
+    if customer:
+        params["customer"] = customer
+    response = stripe.Subscription.list(**params)
+    yield from response.auto_paging_iter()
+
+
+def get_customer_active_subscriptions(customer_stripe_id, cached=True):
+    response = stripe_cache.get_or_fetch(
+        "customer_subscriptions",
+        customer_stripe_id,
+        lambda: stripe.Subscription.list(customer=customer_stripe_id, status="active"),
+        cached=cached,
+    )
     return response
 
 
@@ -131,6 +201,9 @@ def cancel_subscription(
             subscription_id,
             cancellation_details={"comment": reason, "feedback": feedback},
         )
+    # the response is the updated subscription
+    stripe_cache.store("subscription", subscription_id, response)
+    stripe_cache.invalidate("customer_subscriptions", response.customer)
 
     if raw:
         return response
@@ -141,10 +214,10 @@ def get_checkout_customer_plan(session_id=""):
     """
     Retrieves the subscription details for a customer based on a Stripe Checkout session.
 
-    This function first fetches the checkout session using the provided `session_id`. Then, it retrieves
-    the subscription associated with the session and extracts details such as the customer ID, subscription
-    plan ID, and subscription start and end dates. The function also converts timestamp values into datetime
-    objects for easier handling in the Django model.
+    This function fetches the checkout session using the provided `session_id`, with the subscription
+    associated with the session expanded so a single Stripe request is made, and extracts details such as
+    the customer ID, subscription plan ID, and subscription start and end dates. The function also converts
+    timestamp values into datetime objects for easier handling in the Django model.
 
     Args:
         session_id (str): The Stripe Checkout session ID. If not provided, an empty string is used, which may
@@ -178,11 +251,13 @@ def get_checkout_customer_plan(session_id=""):
          }
     """
 
-    checkout_r = get_checkout_session(session_id, raw=True)
+    checkout_r = get_checkout_session(session_id, raw=True, expand=["subscription"])
     customer_id = checkout_r.customer
 
-    sub_stripe_id = checkout_r.subscription
-    sub_r = get_subscription(sub_stripe_id, raw=True)
+    sub_r = checkout_r.subscription
+    if isinstance(sub_r, str):
+        sub_r = get_subscription(sub_r, raw=True)
+    sub_stripe_id = sub_r.id
     sub_plan = sub_r.plan
 
     serialized_sub_data = serialize_subscription_data(sub_r)
@@ -195,3 +270,35 @@ def get_checkout_customer_plan(session_id=""):
         **serialized_sub_data,
     }
     return data
+
+
+def verify_webhook_event(payload, sig_header):
+    """
+    Verifies the `Stripe-Signature` header of a webhook request.
+
+    Returns:
+        dict: The decoded event.
+
+    Raises:
+        stripe.SignatureVerificationError: If the signature is missing, invalid or too old.
+        ValueError: If the payload is not valid JSON.
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode("utf-8")
+    stripe.WebhookSignature.verify_header(
+        payload,
+        sig_header,
+        STRIPE_WEBHOOK_SECRET,
+        tolerance=stripe.Webhook.DEFAULT_TOLERANCE,
+    )
+    return json.loads(payload)
+
+
+def construct_event_object(event_data):
+    """Turns the `data.object` of a stored event into a Stripe object."""
+    data_object = event_data["data"]["object"]
+    if data_object.get("object") == "checkout.session":
+        return stripe.checkout.Session.construct_from(data_object, stripe.api_key)
+    if data_object.get("object") == "subscription":
+        return stripe.Subscription.construct_from(data_object, stripe.api_key)
+    return stripe.StripeObject.construct_from(data_object, stripe.api_key)
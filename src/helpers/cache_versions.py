@@ -0,0 +1,30 @@
+import time
+
+from django.core.cache import cache
+
+
+def initial_version():
+    # never reuses the number of a version evicted from the cache
+    return time.time_ns()
+
+
+def get_version(key):
+    """
+    Returns the version stored at `key`, creating it on first use. Cached
+    data tagged with an older version is stale.
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, initial_version(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key):
+    """Makes everything tagged with the current version at `key` stale."""
+    if not cache.add(key, initial_version(), timeout=None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # evicted between add and incr
+            cache.add(key, initial_version(), timeout=None)
@@ -0,0 +1,109 @@
+import json
+import threading
+
+import stripe
+from decouple import config
+from django.core.cache import cache
+
+# seconds each kind of Stripe object is served from the cache, 0 disables it
+TIMEOUTS = {
+    "subscription": config("STRIPE_SUBSCRIPTION_CACHE_TIMEOUT", cast=int, default=60),
+    "checkout.session": config(
+        "STRIPE_CHECKOUT_SESSION_CACHE_TIMEOUT", cast=int, default=60 * 60
+    ),
+    "customer_subscriptions": config(
+        "STRIPE_CUSTOMER_SUBSCRIPTIONS_CACHE_TIMEOUT", cast=int, default=60
+    ),
+}
+CLASSES = {
+    "subscription": stripe.Subscription,
+    "checkout.session": stripe.checkout.Session,
+    "customer_subscriptions": stripe.ListObject,
+}
+
+
+class StripeCacheStats:
+    """Thread safe per kind hit and miss counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._kinds = {}
+
+    def record(self, kind, hit):
+        with self._lock:
+            stats = self._kinds.setdefault(kind, {"hits": 0, "misses": 0})
+            stats["hits" if hit else "misses"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {kind: dict(stats) for kind, stats in self._kinds.items()}
+
+    def reset(self):
+        with self._lock:
+            self._kinds = {}
+
+    def summary(self):
+        """Human readable, one line per kind."""
+        lines = []
+        for kind, stats in sorted(self.snapshot().items()):
+            total = stats["hits"] + stats["misses"]
+            lines.append(
+                f"cache {kind}: {stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['hits'] / total:.0%} hit rate)"
+            )
+        return "\n".join(lines)
+
+
+stats = StripeCacheStats()
+
+
+def cache_key(kind, object_id):
+    return f"stripe:{kind}:{object_id}"
+
+
+def lookup(kind, object_id):
+    """
+    Returns:
+        stripe.StripeObject: The cached object, or None on a miss.
+    """
+    if not TIMEOUTS[kind] or not object_id:
+        return None
+    data = cache.get(cache_key(kind, object_id))
+    stats.record(kind, hit=data is not None)
+    if data is None:
+        return None
+    return CLASSES[kind].construct_from(data, stripe.api_key)
+
+
+def store(kind, object_id, response):
+    """
+    Caches a Stripe response for the TTL of its kind. Only the plain data is
+    stored, never the API key attached to the response.
+    """
+    if not TIMEOUTS[kind] or not object_id:
+        return
+    cache.set(cache_key(kind, object_id), json.loads(str(response)), TIMEOUTS[kind])
+
+
+def invalidate(kind, object_id):
+    if object_id:
+        cache.delete(cache_key(kind, object_id))
+
+
+def get_or_fetch(kind, object_id, fetch, cached=True, cacheable=None):
+    """
+    Read through: returns the cached object, or calls `fetch()` and caches
+    its response. With `cached=False` Stripe is always called and the cache
+    refreshed with the response.
+
+    Args:
+        cacheable (callable, optional): Only responses it returns True for are cached.
+    """
+    if cached:
+        response = lookup(kind, object_id)
+        if response is not None:
+            return response
+    response = fetch()
+    if cacheable is None or cacheable(response):
+        store(kind, object_id, response)
+    return response
@@ -0,0 +1,144 @@
+import re
+import threading
+import time
+
+import requests
+import stripe
+from decouple import config
+from requests.adapters import HTTPAdapter
+
+STRIPE_CONNECT_TIMEOUT = config("STRIPE_CONNECT_TIMEOUT", cast=float, default=5.0)
+STRIPE_READ_TIMEOUT = config("STRIPE_READ_TIMEOUT", cast=float, default=30.0)
+STRIPE_POOL_SIZE = config("STRIPE_POOL_SIZE", cast=int, default=10)
+STRIPE_MAX_NETWORK_RETRIES = config("STRIPE_MAX_NETWORK_RETRIES", cast=int, default=2)
+# `fake` serves every call from the in process `helpers.stripe_fake`
+STRIPE_BACKEND = config("STRIPE_BACKEND", default="stripe")
+
+# object ids look like `cus_Q1w2E3`, `sub_1Abc`, `cs_test_a1B2`
+OBJECT_ID_PATTERN = re.compile(r"/[a-z]+_(?:test_|live_)?[a-z]*[A-Z0-9][A-Za-z0-9]*")
+
+
+def endpoint_name(method, url):
+    """
+    Returns a low cardinality name for a Stripe request,
+    i.e. `GET /v1/subscriptions/{id}`.
+    """
+    path = url.split("://", 1)[-1]
+    path = path[path.find("/") :].split("?", 1)[0]
+    path = OBJECT_ID_PATTERN.sub("/{id}", path)
+    return f"{method.upper()} {path}"
+
+
+class StripeMetrics:
+    """Thread safe per endpoint call, error and latency counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, seconds, error=False):
+        with self._lock:
+            stats = self._endpoints.setdefault(
+                endpoint,
+                {"calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0},
+            )
+            stats["calls"] += 1
+            stats["errors"] += int(error)
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Maps each endpoint to its `calls`, `errors`, `total_seconds`,
+                  `max_seconds` and `avg_seconds`.
+        """
+        with self._lock:
+            data = {name: dict(stats) for name, stats in self._endpoints.items()}
+        for stats in data.values():
+            stats["avg_seconds"] = stats["total_seconds"] / stats["calls"]
+        return data
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+
+    def summary(self):
+        """Human readable, one line per endpoint."""
+        lines = []
+        for name, stats in sorted(self.snapshot().items()):
+            lines.append(
+                f"{name}: {stats['calls']} calls, {stats['errors']} errors, "
+                f"avg {stats['avg_seconds'] * 1000:.0f}ms, "
+                f"max {stats['max_seconds'] * 1000:.0f}ms"
+            )
+        return "\n".join(lines)
+
+
+metrics = StripeMetrics()
+
+
+class InstrumentedRequestsClient(stripe.RequestsClient):
+    """Stripe HTTP client that records every request in `metrics`."""
+
+    def __init__(self, *args, metrics=metrics, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics
+
+    def request(self, method, url, headers, post_data=None):
+        endpoint = endpoint_name(method, url)
+        start = time.perf_counter()
+        error = True
+        try:
+            content, status_code, response_headers = super().request(
+                method, url, headers, post_data
+            )
+            error = status_code >= 400
+            return content, status_code, response_headers
+        finally:
+            self.metrics.record(endpoint, time.perf_counter() - start, error=error)
+
+
+def build_session(pool_size=STRIPE_POOL_SIZE):
+    """
+    Returns a `requests.Session` whose connection pool keeps up to `pool_size`
+    connections to Stripe alive, so TLS handshakes happen once per connection.
+    Retries are left to the stripe library (`stripe.max_network_retries`).
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def build_http_client(
+    connect_timeout=STRIPE_CONNECT_TIMEOUT,
+    read_timeout=STRIPE_READ_TIMEOUT,
+    pool_size=STRIPE_POOL_SIZE,
+):
+    return InstrumentedRequestsClient(
+        timeout=(connect_timeout, read_timeout),
+        session=build_session(pool_size=pool_size),
+    )
+
+
+def configure(
+    http_client=None,
+    max_network_retries=STRIPE_MAX_NETWORK_RETRIES,
+    backend=STRIPE_BACKEND,
+):
+    """
+    Installs `http_client` as the client used by every `stripe.*` API call
+    of this process. Defaults to a pooled, instrumented client, or to a
+    `FakeStripeClient` when `backend` is `fake`.
+    """
+    if http_client is None and backend == "fake":
+        from .stripe_fake import FakeStripeClient
+
+        http_client = FakeStripeClient()
+    if http_client is None:
+        http_client = build_http_client()
+    stripe.default_http_client = http_client
+    stripe.max_network_retries = max_network_retries
+    return http_client
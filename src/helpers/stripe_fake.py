@@ -0,0 +1,316 @@
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+import stripe
+from decouple import config
+
+from . import stripe_client
+
+STRIPE_FAKE_LATENCY = config("STRIPE_FAKE_LATENCY", cast=float, default=0.0)
+STRIPE_FAKE_JITTER = config("STRIPE_FAKE_JITTER", cast=float, default=0.0)
+STRIPE_FAKE_ERROR_RATE = config("STRIPE_FAKE_ERROR_RATE", cast=float, default=0.0)
+STRIPE_FAKE_SEED = config("STRIPE_FAKE_SEED", cast=int, default=0)
+
+PERIOD_SECONDS = {
+    "day": 86400,
+    "week": 7 * 86400,
+    "month": 30 * 86400,
+    "year": 365 * 86400,
+}
+KEY_PATTERN = re.compile(r"[^\[\]]+")
+
+
+def decode_params(pairs):
+    """
+    Rebuilds the nested params Stripe form encodes,
+    i.e. `line_items[0][price]=price_1` into `{"line_items": [{"price": "price_1"}]}`.
+    """
+    params = {}
+    for key, value in pairs:
+        parts = KEY_PATTERN.findall(key)
+        node = params
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+
+    def listify(node):
+        if not isinstance(node, dict):
+            return node
+        node = {k: listify(v) for k, v in node.items()}
+        if node and all(k.isdigit() for k in node):
+            return [node[k] for k in sorted(node, key=int)]
+        return node
+
+    return listify(params)
+
+
+def in_range(value, bounds):
+    """Applies a Stripe range filter like `{"gte": "1733011200"}`."""
+    if not isinstance(bounds, dict):
+        return value == int(bounds)
+    checks = {
+        "gt": lambda a, b: a > b,
+        "gte": lambda a, b: a >= b,
+        "lt": lambda a, b: a < b,
+        "lte": lambda a, b: a <= b,
+    }
+    return all(checks[op](value, int(bound)) for op, bound in bounds.items())
+
+
+class FakeStripeError(Exception):
+    def __init__(self, status_code, message, error_type="invalid_request_error"):
+        super().__init__(message)
+        self.status_code = status_code
+        self.error_type = error_type
+
+
+class FakeStripeClient(stripe.HTTPClient):
+    """
+    In process stand in for the Stripe API, installed with
+    `stripe_client.configure(backend="fake")` (or `STRIPE_BACKEND=fake`).
+
+    Implements the customer, product, price, checkout session and
+    subscription endpoints used by `helpers.billing`, keeping the objects in
+    memory. Checkout sessions are paid as soon as they are created, so the
+    subscription of a session exists right away.
+
+    Every request sleeps `latency` seconds (plus up to `jitter`) and fails
+    with a 500 at `error_rate`, drawn from a `seed`ed generator so runs are
+    reproducible. Requests are recorded in `stripe_client.metrics` like the
+    real client does.
+    """
+
+    name = "fake"
+
+    def __init__(
+        self,
+        latency=STRIPE_FAKE_LATENCY,
+        jitter=STRIPE_FAKE_JITTER,
+        error_rate=STRIPE_FAKE_ERROR_RATE,
+        seed=STRIPE_FAKE_SEED,
+        metrics=stripe_client.metrics,
+    ):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.metrics = metrics
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+        self.reset()
+
+    def reset(self):
+        """Forgets every stored object."""
+        with self._lock:
+            self.objects = {}
+            self._counter = 0
+
+    def request(self, method, url, headers, post_data=None):
+        endpoint = stripe_client.endpoint_name(method, url)
+        start = time.perf_counter()
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            fail = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            status_code = 500
+            content = self.error_body("api_error", "Injected failure.")
+        else:
+            status_code, content = self.dispatch(method.lower(), url, post_data)
+        self.metrics.record(
+            endpoint, time.perf_counter() - start, error=status_code >= 400
+        )
+        headers = {"Request-Id": f"req_fake{next(self._request_ids):08d}"}
+        return content, status_code, headers
+
+    def close(self):
+        pass
+
+    def error_body(self, error_type, message):
+        return json.dumps({"error": {"type": error_type, "message": message}})
+
+    def dispatch(self, method, url, post_data):
+        parts = urlsplit(url)
+        query = parse_qsl(parts.query, keep_blank_values=True)
+        form = parse_qsl(post_data or "", keep_blank_values=True)
+        params = decode_params(query + form)
+        segments = parts.path.strip("/").split("/")[1:]  # drop the `v1`
+        if segments[:1] == ["checkout"]:
+            segments = ["checkout." + segments[1], *segments[2:]]
+        resource, object_id = segments[0], (segments[1:] or [None])[0]
+        action = (segments[2:] or [None])[0]
+        handler = getattr(self, f"{method}_{resource.replace('.', '_')}", None)
+        if handler is None:
+            message = f"Unrecognized request URL ({method.upper()}: {parts.path})."
+            return 404, self.error_body("invalid_request_error", message)
+        try:
+            with self._lock:
+                body = handler(params, object_id, action)
+                if params.get("expand"):
+                    body = self.expand(body, params["expand"])
+                # serialized under the lock, stored objects can change after it
+                return 200, json.dumps(body)
+        except FakeStripeError as e:
+            return e.status_code, self.error_body(e.error_type, str(e))
+
+    def expand(self, obj, paths):
+        """Replaces the ids at the dotted `paths` by their objects, like `expand`."""
+        obj = dict(obj)
+        for path in paths:
+            field, _, rest = path.partition(".")
+            value = obj.get(field)
+            if isinstance(value, str) and value in self.objects:
+                value = self.objects[value]
+            if isinstance(value, dict):
+                obj[field] = self.expand(value, [rest] if rest else [])
+        return obj
+
+    def create(self, prefix, obj):
+        self._counter += 1
+        obj = {
+            "id": f"{prefix}_fake{self._counter:08d}",
+            "created": int(time.time()),
+            "livemode": False,
+            "metadata": {},
+            **obj,
+        }
+        self.objects[obj["id"]] = obj
+        return obj
+
+    def get(self, object_id, kind):
+        obj = self.objects.get(object_id)
+        if obj is None or obj["object"] != kind:
+            raise FakeStripeError(404, f"No such {kind}: '{object_id}'")
+        return obj
+
+    # customers, products and prices
+
+    def post_customers(self, params, object_id, action):
+        if object_id:
+            obj = self.get(object_id, "customer")
+            obj.update(params)
+            return obj
+        return self.create("cus", {"object": "customer", **params})
+
+    def get_customers(self, params, object_id, action):
+        return self.get(object_id, "customer")
+
+    def post_products(self, params, object_id, action):
+        return self.create("prod", {"object": "product", "active": True, **params})
+
+    def post_prices(self, params, object_id, action):
+        self.get(params.get("product"), "product")
+        params["unit_amount"] = int(params.get("unit_amount", 0))
+        return self.create("price", {"object": "price", "active": True, **params})
+
+    # checkout sessions
+
+    def post_checkout_sessions(self, params, object_id, action):
+        customer = self.get(params.get("customer"), "customer")
+        price_id = params["line_items"][0]["price"]
+        subscription = self.create_subscription(customer["id"], price_id)
+        session = self.create(
+            "cs_test",
+            {
+                "object": "checkout.session",
+                "customer": customer["id"],
+                "mode": params.get("mode", "subscription"),
+                "status": "complete",
+                "payment_status": "paid",
+                "subscription": subscription["id"],
+                "success_url": params.get("success_url"),
+                "cancel_url": params.get("cancel_url"),
+            },
+        )
+        session["url"] = f"https://checkout.stripe.test/c/pay/{session['id']}"
+        return session
+
+    def get_checkout_sessions(self, params, object_id, action):
+        return self.get(object_id, "checkout.session")
+
+    # subscriptions
+
+    def create_subscription(self, customer_id, price_id):
+        price = self.get(price_id, "price")
+        interval = price.get("recurring", {}).get("interval", "month")
+        now = int(time.time())
+        period_end = now + PERIOD_SECONDS.get(interval, PERIOD_SECONDS["month"])
+        plan = {**price, "object": "plan", "interval": interval}
+        item = {"object": "subscription_item", "price": price}
+        return self.create(
+            "sub",
+            {
+                "object": "subscription",
+                "customer": customer_id,
+                "status": "active",
+                "current_period_start": now,
+                "current_period_end": period_end,
+                "cancel_at_period_end": False,
+                "canceled_at": None,
+                "cancellation_details": {},
+                "plan": plan,
+                "items": {"object": "list", "data": [item]},
+            },
+        )
+
+    def post_subscriptions(self, params, object_id, action):
+        if object_id is None:
+            items = params.get("items") or [{}]
+            return self.create_subscription(
+                params.get("customer"), items[0].get("price")
+            )
+        obj = self.get(object_id, "subscription")
+        if "cancel_at_period_end" in params:
+            obj["cancel_at_period_end"] = params["cancel_at_period_end"] == "true"
+        if "cancellation_details" in params:
+            obj["cancellation_details"] = params["cancellation_details"]
+        if "metadata" in params:
+            obj["metadata"] = params["metadata"]
+        return obj
+
+    def delete_subscriptions(self, params, object_id, action):
+        obj = self.get(object_id, "subscription")
+        obj["status"] = "canceled"
+        obj["canceled_at"] = int(time.time())
+        obj["cancellation_details"] = params.get("cancellation_details", {})
+        return obj
+
+    def get_subscriptions(self, params, object_id, action):
+        if object_id:
+            return self.get(object_id, "subscription")
+        status = params.get("status")
+        subs = []
+        # newest first, like Stripe
+        for obj in reversed(self.objects.values()):
+            if obj["object"] != "subscription":
+                continue
+            if status != "all" and obj["status"] != (status or obj["status"]):
+                continue
+            if status is None and obj["status"] == "canceled":
+                continue
+            if params.get("customer") not in (None, obj["customer"]):
+                continue
+            if not all(
+                in_range(obj[field], params[field])
+                for field in ["created", "current_period_end"]
+                if field in params
+            ):
+                continue
+            subs.append(obj)
+        if params.get("starting_after"):
+            ids = [obj["id"] for obj in subs]
+            subs = subs[ids.index(params["starting_after"]) + 1 :]
+        limit = int(params.get("limit", 10))
+        return {
+            "object": "list",
+            "url": "/v1/subscriptions",
+            "has_more": len(subs) > limit,
+            "data": subs[:limit],
+        }
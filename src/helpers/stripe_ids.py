@@ -0,0 +1,95 @@
+from django.db import models
+
+
+def normalize_stripe_id(value):
+    """
+    Stripe ids are case sensitive, so only the surrounding whitespace is
+    dropped and blank ids become None, which the unique index allows many
+    times.
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+class StripeIdField(models.CharField):
+    """
+    A unique, nullable Stripe id, normalized on save and in lookups so
+    exact matches are enough and always use the index.
+    """
+
+    description = "Stripe object id"
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("max_length", 120)
+        kwargs.setdefault("null", True)
+        kwargs.setdefault("blank", True)
+        kwargs.setdefault("unique", True)
+        super().__init__(*args, **kwargs)
+
+    def get_prep_value(self, value):
+        return normalize_stripe_id(super().get_prep_value(value))
+
+    def pre_save(self, model_instance, add):
+        value = normalize_stripe_id(getattr(model_instance, self.attname))
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+class StripeIdQuerySet(models.QuerySet):
+    def by_stripe_id(self, stripe_id):
+        """
+        Filters on one or more Stripe ids, with an exact lookup on the
+        unique index.
+
+        Args:
+            stripe_id (str, list): The Stripe id(s) to filter by.
+
+        Returns:
+            QuerySet: The objects with one of the ids, none for blank ids.
+        """
+        if stripe_id is None or isinstance(stripe_id, str):
+            stripe_id = [stripe_id]
+        ids = {normalize_stripe_id(value) for value in stripe_id} - {None}
+        return self.filter(stripe_id__in=sorted(ids))
+
+
+def dedupe_stripe_ids(model, clear_duplicates=True):
+    """
+    Normalizes the stripe ids of `model` and keeps each id on its oldest
+    row only, the newer duplicates get None. Meant for the migrations that
+    add the unique index, with the historical model.
+
+    Customers, plans and prices create their Stripe object when saved
+    without an id, so a cleared duplicate would quietly get a new customer,
+    product or price in Stripe on its next save. Their duplicates are
+    reported with `clear_duplicates=False` instead, before anything is
+    written, to be merged by hand.
+
+    Raises:
+        ValueError: For duplicate ids, with `clear_duplicates=False`.
+
+    Returns:
+        int: The number of rows whose duplicate id was cleared.
+    """
+    seen = {}
+    changed = []
+    duplicates = {}
+    for obj in model.objects.exclude(stripe_id=None).order_by("pk").only("stripe_id"):
+        stripe_id = normalize_stripe_id(obj.stripe_id)
+        if stripe_id in seen:
+            duplicates.setdefault(stripe_id, [seen[stripe_id]]).append(obj.pk)
+            stripe_id = None
+        elif stripe_id is not None:
+            seen[stripe_id] = obj.pk
+        if stripe_id != obj.stripe_id:
+            obj.stripe_id = stripe_id
+            changed.append(obj)
+    if duplicates and not clear_duplicates:
+        rows = "; ".join(f"{key}: {pks}" for key, pks in duplicates.items())
+        raise ValueError(
+            f"{model.__name__} rows share Stripe ids, merge them first ({rows})"
+        )
+    model.objects.bulk_update(changed, ["stripe_id"], batch_size=1000)
+    return sum(len(pks) - 1 for pks in duplicates.values())
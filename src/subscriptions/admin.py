@@ -1,5 +1,11 @@
 from django.contrib import admin
-from .models import Subscriptions, UserSubscription, SubscriptionPrice
+from .models import (
+    Subscriptions,
+    UserSubscription,
+    SubscriptionPrice,
+    SubscriptionSnapshot,
+    SyncCheckpoint,
+)
 
 
 class SubscriptionPriceAdmin(admin.TabularInline):
@@ -17,3 +23,26 @@ class SubscriptionAdmin(admin.ModelAdmin):
 
 admin.site.register(Subscriptions, SubscriptionAdmin)
 admin.site.register(UserSubscription)
+
+
+class SyncCheckpointAdmin(admin.ModelAdmin):
+    list_display = [
+        "__str__",
+        "last_user_id",
+        "refreshed",
+        "total",
+        "updated",
+        "finished",
+    ]
+    readonly_fields = ["updated"]
+
+
+admin.site.register(SyncCheckpoint, SyncCheckpointAdmin)
+
+
+class SubscriptionSnapshotAdmin(admin.ModelAdmin):
+    list_display = ["user", "plan_id", "status", "current_period_end", "updated"]
+    readonly_fields = [field.name for field in SubscriptionSnapshot._meta.fields]
+
+
+admin.site.register(SubscriptionSnapshot, SubscriptionSnapshotAdmin)
@@ -0,0 +1,32 @@
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Permission
+
+from subscriptions import entitlements
+
+
+class EntitlementBackend(ModelBackend):
+    """
+    `ModelBackend` whose permissions are the user's entitlements: the
+    permissions Django grants (their own and their groups') plus those of
+    their plan, kept in the shared cache so `has_perm` costs one cache read.
+    """
+
+    def get_plan_permissions(self, user_obj):
+        perms = Permission.objects.filter(
+            subscriptions__usersubscription__user_id=user_obj.pk
+        ).values_list("content_type__app_label", "codename")
+        return {f"{app_label}.{codename}" for app_label, codename in perms}
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, "_perm_cache"):
+            # also read by the other ModelBackend subclasses (allauth)
+            user_obj._perm_cache = entitlements.get_permissions(
+                user_obj,
+                lambda: {
+                    *super(EntitlementBackend, self).get_all_permissions(user_obj),
+                    *self.get_plan_permissions(user_obj),
+                },
+            )
+        return user_obj._perm_cache
@@ -0,0 +1,17 @@
+from helpers import cache_versions
+
+VERSION_KEY = "catalog:version"
+
+
+def get_version():
+    """
+    Returns the current catalog version. Anything rendered or computed from
+    the plans and their prices (i.e. the pricing page) is stale once it
+    changes.
+    """
+    return cache_versions.get_version(VERSION_KEY)
+
+
+def bump_version():
+    """Invalidates everything built from the catalog."""
+    cache_versions.bump_version(VERSION_KEY)
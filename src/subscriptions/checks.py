@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core import checks
+
+LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    The entitlement and catalog versions are bumped in the default cache, and
+    every process drops its memoized plans and prices when they change. A
+    per-process cache never shows a bump to the other workers, which then
+    serve stale plans and permissions until they restart.
+    """
+    if settings.DEBUG:
+        return []
+    backend = settings.CACHES["default"]["BACKEND"]
+    if backend not in LOCAL_CACHE_BACKENDS:
+        return []
+    return [
+        checks.Warning(
+            f"The default cache {backend} is not shared between processes.",
+            hint=(
+                "Set CACHE_BACKEND and CACHE_LOCATION to a shared cache, e.g. "
+                "django.core.cache.backends.redis.RedisCache, or plan and "
+                "permission changes only reach the process that made them."
+            ),
+            id="subscriptions.W001",
+        )
+    ]
@@ -0,0 +1,98 @@
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth.views import redirect_to_login
+from django.core.exceptions import ImproperlyConfigured
+from django.shortcuts import redirect
+
+from subscriptions.models import ENTITLEMENT_BITS, get_entitlement_table
+
+
+def entitlement_mask(codenames):
+    """
+    Compiles permission codenames, with or without the `subscriptions.`
+    prefix, into one mask of `ENTITLEMENT_BITS`.
+
+    Raises:
+        ImproperlyConfigured: For a permission missing from SUBSCRIPTIONS_PERMS.
+    """
+    mask = 0
+    for codename in codenames:
+        codename = codename.removeprefix("subscriptions.")
+        if codename not in ENTITLEMENT_BITS:
+            raise ImproperlyConfigured(
+                f"Unknown entitlement {codename!r}, see SUBSCRIPTIONS_PERMS."
+            )
+        mask |= ENTITLEMENT_BITS[codename]
+    return mask
+
+
+def has_entitlements(snapshot, mask):
+    """True if the subscription is active and its plan grants every bit of `mask`."""
+    return snapshot.is_active_status and snapshot.entitlements & mask == mask
+
+
+def is_on_plan(snapshot, names):
+    """True if the subscription is active and on one of the plans `names`."""
+    if not snapshot.is_active_status:
+        return False
+    plans = get_entitlement_table()[1]
+    return any(snapshot.plan_id in plans.get(name.lower(), ()) for name in names)
+
+
+def deny(request):
+    """
+    Sends anonymous users to the login page and subscribers without the
+    required plan to the pricing page.
+    """
+    if not request.user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    messages.info(request, "Upgrade your plan to access this page.")
+    return redirect(settings.PLAN_REQUIRED_REDIRECT_URL)
+
+
+def requires_entitlement(*codenames):
+    """
+    Restricts a view to active subscribers whose plan has all the given
+    `subscriptions` permissions, checked against `request.subscription`
+    with a single bit test.
+
+    Usage:
+        @requires_entitlement("pro")
+        def pro_view(request): ...
+    """
+    mask = entitlement_mask(codenames)
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if not has_entitlements(request.subscription, mask):
+                return deny(request)
+            return view_func(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def requires_plan(*names):
+    """
+    Restricts a view to active subscribers of one of the plans `names`,
+    matched case insensitively.
+
+    Usage:
+        @requires_plan("Pro", "Enterprise")
+        def pro_view(request): ...
+    """
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if not is_on_plan(request.subscription, names):
+                return deny(request)
+            return view_func(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.core.cache import cache
+from helpers import cache_versions
+
+VERSION_KEY = "entitlements:version"
+
+
+def user_key(user_id):
+    return f"entitlements:user:{user_id}"
+
+
+def get_version():
+    """
+    Returns the current global version. Anything computed from the plans
+    (entitlements, `models.get_plan_groups`) is stale once it changes.
+    """
+    return cache_versions.get_version(VERSION_KEY)
+
+
+def bump_version():
+    """
+    Invalidates the entitlements of every user, i.e. after the permissions
+    or groups of a plan changed.
+    """
+    cache_versions.bump_version(VERSION_KEY)
+
+
+def invalidate_users(user_ids):
+    """Invalidates the entitlements of the given users only."""
+    cache.delete_many([user_key(user_id) for user_id in user_ids])
+
+
+def get_permissions(user, compute):
+    """
+    Returns the entitlements of `user` from the cache, with a single
+    `get_many` of the user entry and the global version, calling
+    `compute()` and caching its result on a miss.
+
+    Returns:
+        frozenset: `app_label.codename` permission strings.
+    """
+    key = user_key(user.pk)
+    found = cache.get_many([key, VERSION_KEY])
+    version = found.get(VERSION_KEY)
+    if version is None:
+        version = get_version()
+    entry = found.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    perms = frozenset(compute())
+    cache.set(key, (version, perms), settings.ENTITLEMENTS_CACHE_TIMEOUT)
+    return perms
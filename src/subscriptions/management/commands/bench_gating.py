@@ -0,0 +1,80 @@
+import time
+from typing import Any
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+from django.test import RequestFactory, override_settings
+
+from subscriptions.decorators import (
+    entitlement_mask,
+    has_entitlements,
+    requires_entitlement,
+)
+from subscriptions.models import Subscriptions, UserSubscription, get_user_snapshot
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark plan gating checks per second, against has_perm. "
+        "Runs against a private in-memory cache and rolls back everything "
+        "written, the shared cache and the database are left untouched."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--checks", default=100_000, type=int)
+        return super().add_arguments(parser)
+
+    def report(self, label, count, elapsed):
+        self.stdout.write(
+            f"{label:<24} {count} in {elapsed:.2f}s ({count / elapsed:,.0f}/s)"
+        )
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        # the bench plan bumps the entitlement and catalog versions, which
+        # would invalidate the entitlements and prices of every worker
+        private_cache = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "bench-gating",
+            }
+        }
+        with override_settings(CACHES=private_cache), transaction.atomic():
+            self.run(options.get("checks"))
+            transaction.set_rollback(True)
+
+    def run(self, checks):
+        plan = Subscriptions.objects.create(name="Bench plan", stripe_id="prod_bench")
+        plan.permissions.add(Permission.objects.get(codename="pro"))
+        user = User.objects.create(username="bench-gating")
+        UserSubscription.objects.create(user=user, subscription=plan, status="active")
+
+        snapshot = get_user_snapshot(user)
+        mask = entitlement_mask(["pro"])
+        start = time.perf_counter()
+        for _ in range(checks):
+            has_entitlements(snapshot, mask)
+        self.report("bit test", checks, time.perf_counter() - start)
+
+        view = requires_entitlement("pro")(lambda request: None)
+        request = RequestFactory().get("/")
+        request.user = user
+        request.subscription = snapshot
+        start = time.perf_counter()
+        for _ in range(checks):
+            view(request)
+        self.report("requires_entitlement", checks, time.perf_counter() - start)
+
+        # a new user object per check, like a new request
+        start = time.perf_counter()
+        for _ in range(checks):
+            User(pk=user.pk, is_active=True).has_perm("subscriptions.pro")
+        self.report("has_perm (new request)", checks, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(checks):
+            user.has_perm("subscriptions.pro")
+        self.report("has_perm (same request)", checks, time.perf_counter() - start)
@@ -0,0 +1,38 @@
+from typing import Any
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from subscriptions import utils as subs_utils
+
+
+class Command(BaseCommand):
+    help = "Set the groups of many users to match their plans, in bulk."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--user", dest="user_ids", type=int, nargs="+")
+        parser.add_argument(
+            "--plan",
+            dest="plan_ids",
+            type=int,
+            nargs="+",
+            help="Everyone on these plans",
+        )
+        parser.add_argument("--all", action="store_true", default=False)
+        parser.add_argument("--batch-size", default=1000, type=int)
+        parser.add_argument("--dry-run", action="store_true", default=False)
+        return super().add_arguments(parser)
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        user_ids = options.get("user_ids")
+        plan_ids = options.get("plan_ids")
+        if user_ids is None and plan_ids is None and not options.get("all"):
+            raise CommandError("Pass --user, --plan or --all.")
+        users, added, removed = subs_utils.recompute_user_groups(
+            user_ids=user_ids,
+            plan_ids=plan_ids,
+            batch_size=options.get("batch_size"),
+            dry_run=options.get("dry_run"),
+        )
+        prefix = "Would change" if options.get("dry_run") else "Changed"
+        self.stdout.write(
+            f"{prefix} the groups of {users} users: {added} added, {removed} removed"
+        )
@@ -1,10 +1,27 @@
 from typing import Any
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandParser
 
 from subscriptions import utils as subs_utils
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help="Only print the permissions that would be granted or revoked",
+        )
+        return super().add_arguments(parser)
 
     def handle(self, *args: Any, **options: Any) -> str | None:
-        subs_utils.sync_subs_group_perms()
+        dry_run = options.get("dry_run")
+        added, removed = subs_utils.sync_subs_group_perms(dry_run=dry_run)
+        for group, perm in added:
+            self.stdout.write(f"+ {group}: {perm}")
+        for group, perm in removed:
+            self.stdout.write(f"- {group}: {perm}")
+        grant, revoke = ("Would grant", "revoke") if dry_run else ("Granted", "revoked")
+        self.stdout.write(
+            f"{grant} {len(added)} and {revoke} {len(removed)} group permissions"
+        )
@@ -1,6 +1,9 @@
+import datetime
 import helpers.billing
 from typing import Any
-from django.core.management.base import BaseCommand, CommandParser
+from django.utils import timezone
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from helpers import stripe_client
 
 from subscriptions import utils as subs_utils
 
@@ -12,26 +15,136 @@ class Command(BaseCommand):
         parser.add_argument("--days-left", default=0, type=int)
         parser.add_argument("--days-ago", default=0, type=int)
         parser.add_argument("--clear-dangling", action="store_true", default=False)
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help="With --clear-dangling, only print what would be cancelled",
+        )
+        parser.add_argument(
+            "--workers", default=1, type=int, help="Concurrent Stripe requests"
+        )
+        parser.add_argument(
+            "--rate",
+            default=25.0,
+            type=float,
+            help="Maximum Stripe requests per second (0 for no limit)",
+        )
+        parser.add_argument(
+            "--bulk",
+            action="store_true",
+            default=False,
+            help="List subscriptions 100 per request instead of one request per row",
+        )
+        parser.add_argument(
+            "--status", default="all", help="Stripe status filter for --bulk"
+        )
+        parser.add_argument(
+            "--created-days",
+            default=0,
+            type=int,
+            help="Only list subscriptions created in the last N days with --bulk",
+        )
+        parser.add_argument(
+            "--shard",
+            default="0/1",
+            help="Only sync slice i of N (0 <= i < N), partitioned by user id",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            default=False,
+            help="Continue the shard after its last checkpoint",
+        )
+        parser.add_argument(
+            "--summary",
+            action="store_true",
+            default=False,
+            help="Report the progress of every shard and exit",
+        )
+        parser.add_argument(
+            "--batch-size", default=500, type=int, help="Subscriptions read per page"
+        )
         return super().add_arguments(parser)
 
+    def parse_shard(self, value):
+        try:
+            shard, shards = (int(part) for part in value.split("/"))
+        except ValueError:
+            raise CommandError(f"--shard must look like i/N, got {value!r}")
+        if not 0 <= shard < shards:
+            raise CommandError(f"--shard i/N needs 0 <= i < N, got {value!r}")
+        return shard, shards
+
+    def print_summary(self):
+        progress = subs_utils.sync_progress()
+        if progress is None:
+            print("No sync has run yet.")
+            return
+        for obj in progress["shards"]:
+            state = "finished" if obj.finished else f"at user {obj.last_user_id}"
+            print(
+                f"shard {obj}: {state}, {obj.refreshed + obj.failed}/{obj.total}, "
+                f"{obj.failed} failed, {obj.changed} changed, updated {obj.updated}"
+            )
+        print(
+            f"{progress['finished']}/{len(progress['shards'])} shards finished, "
+            f"{progress['refreshed'] + progress['failed']}/{progress['total']} "
+            f"subscriptions, {progress['failed']} failed, {progress['changed']} changed"
+        )
+
     def handle(self, *args: Any, **options: Any) -> str | None:
         days_left = options.get("days_left")
         days_ago = options.get("days_ago")
         day_start = options.get("day_start")
         day_end = options.get("day_end")
         clear_dangling = options.get("clear_dangling")
+        workers = options.get("workers")
+        rate = options.get("rate")
+        bulk = options.get("bulk")
+        status = options.get("status")
+        created_days = options.get("created_days")
+        shard, shards = self.parse_shard(options.get("shard"))
+        resume = options.get("resume")
+        batch_size = options.get("batch_size")
+        if options.get("summary"):
+            self.print_summary()
+            return
+        created = None
+        if created_days > 0:
+            since = timezone.now() - datetime.timedelta(days=created_days)
+            created = {"gte": int(since.timestamp())}
         if clear_dangling:
+            dry_run = options.get("dry_run")
             print("Clearing all dangling active (not in use) subscriptions ...")
-            subs_utils.clear_dangling_subs()
-            print("Cleared all dangling active subscriptions !!!")
+            dangling = subs_utils.clear_dangling_subs(
+                dry_run=dry_run, workers=workers, rate=rate
+            )
+            if dry_run:
+                print(f"Found {len(dangling)} dangling active subscriptions.")
+            else:
+                print(f"Cleared {len(dangling)} dangling active subscriptions !!!")
+            print(stripe_client.metrics.summary())
         else:
-            print("Refreshing(syncing) active subs...")
-            done = subs_utils.refresh_active_users_subscriptions(
+            print(f"Refreshing(syncing) active subs of shard {shard}/{shards}...")
+            done, checkpoint = subs_utils.sync_shard(
+                shard=shard,
+                shards=shards,
+                resume=resume,
+                batch_size=batch_size,
                 active_only=True,
                 verbose=True,
                 days_ago=days_ago,
                 days_left=days_left,
                 day_start=day_start,
                 day_end=day_end,
+                workers=workers,
+                rate=rate,
+                bulk=bulk,
+                status=status,
+                created=created,
             )
             print("Done !!!" if done else "Failed :(")
+            print(f"Synced {done}")
+            print(f"Checkpoint {checkpoint} saved at user {checkpoint.last_user_id}")
+            print(stripe_client.metrics.summary())
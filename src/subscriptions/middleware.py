@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.functional import SimpleLazyObject
+
+from subscriptions.decorators import deny, entitlement_mask, has_entitlements
+from subscriptions.models import get_user_snapshot
+
+
+class SubscriptionMiddleware:
+    """
+    Sets `request.subscription` to the user's SubscriptionSnapshot, loaded
+    with one query the first time a view or template reads it.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.subscription = SimpleLazyObject(
+            lambda: get_user_snapshot(request.user)
+        )
+        return self.get_response(request)
+
+
+class PlanGateMiddleware:
+    """
+    Restricts every path under the prefixes of `settings.PLAN_GATED_PATHS`
+    to the subscribers with the listed entitlements, like
+    `requires_entitlement`. The longest matching prefix wins.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        gates = getattr(settings, "PLAN_GATED_PATHS", {})
+        if not gates:
+            raise MiddlewareNotUsed
+        self.gates = [
+            (prefix, entitlement_mask(gates[prefix]))
+            for prefix in sorted(gates, key=len, reverse=True)
+        ]
+
+    def __call__(self, request):
+        for prefix, mask in self.gates:
+            if request.path_info.startswith(prefix):
+                if not has_entitlements(request.subscription, mask):
+                    return deny(request)
+                break
+        return self.get_response(request)
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:04
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0020_usersubscription_cancel_at_period_end'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='sync_user_subs', max_length=120)),
+                ('shard', models.PositiveIntegerField(default=0)),
+                ('shards', models.PositiveIntegerField(default=1)),
+                ('last_user_id', models.BigIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(default=0, help_text='Subscriptions in the shard when the run started')),
+                ('refreshed', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('changed', models.PositiveIntegerField(default=0)),
+                ('started', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['name', 'shards', 'shard'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='synccheckpoint',
+            constraint=models.UniqueConstraint(fields=('name', 'shard', 'shards'), name='unique_sync_checkpoint'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:13
+
+from django.db import migrations, models
+
+
+def parse_features(apps, schema_editor):
+    Subscriptions = apps.get_model("subscriptions", "Subscriptions")
+    batch = []
+    for obj in Subscriptions.objects.exclude(features=None).exclude(features=""):
+        obj.features_list = [x.strip() for x in obj.features.splitlines()]
+        batch.append(obj)
+    Subscriptions.objects.bulk_update(batch, ["features_list"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0021_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriptions',
+            name='features_list',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+        migrations.RunPython(parse_features, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:15
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0022_subscriptions_features_list'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='usersubscription',
+            index=models.Index(fields=['current_period_end', 'id'], name='subs_usersub_period_end_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usersubscription',
+            index=models.Index(fields=['status', 'current_period_end'], name='subs_usersub_status_end_idx'),
+        ),
+    ]
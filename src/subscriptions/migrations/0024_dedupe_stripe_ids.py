@@ -0,0 +1,29 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:18
+
+import helpers.stripe_ids
+from django.db import migrations
+
+
+def dedupe_stripe_ids(apps, schema_editor):
+    # plans and prices without an id get a new Stripe object when saved, so
+    # their duplicates are reported rather than cleared
+    for model_name in ["Subscriptions", "SubscriptionPrice"]:
+        model = apps.get_model("subscriptions", model_name)
+        helpers.stripe_ids.dedupe_stripe_ids(model, clear_duplicates=False)
+    UserSubscription = apps.get_model("subscriptions", "UserSubscription")
+    cleared = helpers.stripe_ids.dedupe_stripe_ids(UserSubscription)
+    if cleared:
+        print(f"\n  Cleared {cleared} duplicate UserSubscription stripe ids")
+
+
+class Migration(migrations.Migration):
+    # the unique index is added by the next migration, as Postgres can not
+    # alter a table with pending updates in the same transaction
+
+    dependencies = [
+        ('subscriptions', '0023_usersubscription_period_end_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_stripe_ids, migrations.RunPython.noop),
+    ]
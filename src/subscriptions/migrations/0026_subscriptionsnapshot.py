@@ -0,0 +1,58 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# ENTITLEMENT_BITS when this migration was written, later models must not
+# change what it stores
+ENTITLEMENT_BITS = {"advanced": 1, "pro": 2, "basic": 4, "basic_ai": 8}
+
+
+def create_snapshots(apps, schema_editor):
+    Subscriptions = apps.get_model("subscriptions", "Subscriptions")
+    UserSubscription = apps.get_model("subscriptions", "UserSubscription")
+    SubscriptionSnapshot = apps.get_model("subscriptions", "SubscriptionSnapshot")
+    masks = {}
+    for plan_id, codename in Subscriptions.objects.filter(
+        permissions__content_type__app_label="subscriptions"
+    ).values_list("id", "permissions__codename"):
+        masks[plan_id] = masks.get(plan_id, 0) | ENTITLEMENT_BITS.get(codename, 0)
+    batch = []
+    for obj in UserSubscription.objects.iterator(chunk_size=2000):
+        batch.append(
+            SubscriptionSnapshot(
+                user_id=obj.user_id,
+                plan_id=obj.subscription_id,
+                status=obj.status,
+                current_period_end=obj.current_period_end,
+                entitlements=masks.get(obj.subscription_id, 0),
+            )
+        )
+        if len(batch) >= 2000:
+            SubscriptionSnapshot.objects.bulk_create(batch)
+            batch = []
+    SubscriptionSnapshot.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('subscriptions', '0025_unique_stripe_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriptionSnapshot',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='subscription_snapshot', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('plan_id', models.BigIntegerField(blank=True, null=True)),
+                ('status', models.CharField(blank=True, choices=[('active', 'Active'), ('trailing', 'Trailing'), ('incomplete', 'Incomplete'), ('incomplete_expired', 'Incomplete Expired'), ('past_due', 'Past Due'), ('canceled', 'Canceled'), ('unpaid', 'Unpaid'), ('paused', 'Paused')], max_length=120, null=True)),
+                ('current_period_end', models.DateTimeField(blank=True, null=True)),
+                ('entitlements', models.BigIntegerField(default=0, help_text='ENTITLEMENT_BITS of the plan permissions')),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(create_snapshots, migrations.RunPython.noop),
+    ]
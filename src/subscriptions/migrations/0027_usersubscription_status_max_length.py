@@ -0,0 +1,18 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0026_subscriptionsnapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='usersubscription',
+            name='status',
+            field=models.CharField(blank=True, choices=[('active', 'Active'), ('trailing', 'Trailing'), ('incomplete', 'Incomplete'), ('incomplete_expired', 'Incomplete Expired'), ('past_due', 'Past Due'), ('canceled', 'Canceled'), ('unpaid', 'Unpaid'), ('paused', 'Paused')], max_length=120, null=True),
+        ),
+    ]
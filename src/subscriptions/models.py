@@ -1,15 +1,19 @@
-import helpers.billing
 import datetime
-from django.db import models
-from django.db.models import Q
+from billing.models import OutboxKind, enqueue
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group, Permission
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.conf import settings
 from django.urls import reverse
 from django.utils import timezone
+from helpers.stripe_ids import StripeIdField, StripeIdQuerySet
+from subscriptions import catalog, entitlements
 
 User = settings.AUTH_USER_MODEL
 ALLOW_CUSTOM_GROUPS = True
+MISSING = object()
 SUBSCRIPTIONS_PERMS = [
     (
         "advanced",
@@ -19,6 +23,11 @@ SUBSCRIPTIONS_PERMS = [
     ("basic", "Basic perm"),
     ("basic_ai", "Basic AI perm"),
 ]
+# one bit per plan permission, in the order of SUBSCRIPTIONS_PERMS so stored
+# masks stay valid as long as new permissions are only appended
+ENTITLEMENT_BITS = {
+    codename: 1 << bit for bit, (codename, _) in enumerate(SUBSCRIPTIONS_PERMS)
+}
 
 
 class Subscriptions(models.Model):
@@ -38,7 +47,7 @@ class Subscriptions(models.Model):
             "codename__in": [x[0] for x in SUBSCRIPTIONS_PERMS],
         },
     )
-    stripe_id = models.CharField(max_length=120, null=True, blank=True)
+    stripe_id = StripeIdField()
     order = models.IntegerField(default=-1, help_text="Ordering on Django Pricing Page")
     featured = models.BooleanField(
         default=True, help_text="Featured on Django pricing page"
@@ -50,20 +59,31 @@ class Subscriptions(models.Model):
         blank=True,
         null=True,
     )
+    # `features` split once on save instead of on every pricing page render
+    features_list = models.JSONField(default=list, blank=True, editable=False)
+
+    objects = StripeIdQuerySet.as_manager()
+
+    @staticmethod
+    def parse_features(features):
+        if not features:
+            return []
+        return [x.strip() for x in features.splitlines()]
 
     @property
     def get_features_list(self):
-        if not self.features:
-            return []
-        return [x.strip() for x in self.features.splitlines()]
+        return self.features_list
 
     def save(self, *args, **kwargs):
-        if not self.stripe_id:
-            stripe_id = helpers.billing.create_product(
-                name=self.name, metadata={"subscription_plan_id": self.pk}
-            )
-            self.stripe_id = stripe_id
-        super().save(*args, **kwargs)
+        self.features_list = self.parse_features(self.features)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "features" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "features_list"}
+        # the Stripe product is created by the billing worker
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if not self.stripe_id:
+                enqueue(OutboxKind.PRODUCT, self.pk)
 
     class Meta:
         # custom permissions
@@ -88,7 +108,7 @@ class SubscriptionPrice(models.Model):
     subscription = models.ForeignKey(
         Subscriptions, on_delete=models.SET_NULL, null=True
     )
-    stripe_id = models.CharField(max_length=120, null=True, blank=True)
+    stripe_id = StripeIdField()
     interval = models.CharField(
         max_length=120, default=IntervalChoices.MONTHLY, choices=IntervalChoices.choices
     )
@@ -100,6 +120,8 @@ class SubscriptionPrice(models.Model):
     updated = models.DateTimeField(auto_now=True)
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    objects = StripeIdQuerySet.as_manager()
+
     @property
     def display_features_list(self):
         if not self.subscription:
@@ -138,16 +160,12 @@ class SubscriptionPrice(models.Model):
         return "usd"
 
     def save(self, *args, **kwargs):
-        if self.product_stripe_id is not None and not self.stripe_id:
-            stripe_id = helpers.billing.create_price(
-                unit_amount=self.stripe_price,
-                product=self.product_stripe_id,
-                interval=self.interval,
-                currency=self.stripe_currency,
-                metadata={"subscription_plan_price_id": self.pk},
-            )
-            self.stripe_id = stripe_id
-        super().save(*args, **kwargs)
+        # the Stripe price is created by the billing worker, once the
+        # product of the plan exists
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if self.subscription_id is not None and not self.stripe_id:
+                enqueue(OutboxKind.PRICE, self.pk)
         # only one price for both monthly and annually must be valid
         # other prices must be inactive(non-featured)
         if self.featured and self.subscription:
@@ -155,10 +173,12 @@ class SubscriptionPrice(models.Model):
                 subscription=self.subscription, interval=self.interval
             ).exclude(id=self.id)
             # make other prices in same interval(monthly or yearly) and same subscription plan "false"
-            qs.update(featured=False)
+            if qs.update(featured=False):
+                catalog.bump_version()
 
     def __str__(self) -> str:
-        return self.product_stripe_id
+        # the product id is empty until the billing worker created it
+        return self.product_stripe_id or self.display_sub_name
 
     class Meta:
         ordering = ["subscription__order", "order", "featured", "-updated"]
@@ -175,7 +195,11 @@ class SubscriptionStatus(models.TextChoices):
     PAUSED = "paused", "Paused"
 
 
-class UserSubscriptionQuerySet(models.QuerySet):
+# columns `scan_expiring` loads by default
+SCAN_FIELDS = ["id", "user_id", "stripe_id", "status", "current_period_end"]
+
+
+class UserSubscriptionQuerySet(StripeIdQuerySet):
     def by_range(self, days_start=7, days_end=120):
         """
         Filters subscriptions based on whether their `current_period_end`
@@ -270,22 +294,80 @@ class UserSubscriptionQuerySet(models.QuerySet):
         Filters subscriptions based on one or more user IDs.
 
         Args:
-            user_ids (list, int, str, optional): The user ID(s) to filter by.
-                                                  Can be a list of IDs or a single ID.
+            user_ids (list, int, str, QuerySet, optional): The user ID(s) to filter
+                by. Can be a list of IDs, a single ID, or a queryset of user ids
+                for sets too large for an `IN` list.
 
         Returns:
             QuerySet: A queryset of subscriptions where the user_id matches one
                       of the provided IDs. If no valid `user_ids` is provided,
                       it returns the original queryset.
         """
-        if isinstance(user_ids, list):
+        if isinstance(user_ids, models.QuerySet):
+            # a subquery, however many users it matches
             return self.filter(user_id__in=user_ids)
+        if isinstance(user_ids, (list, tuple, set)):
+            return self.filter(user_id__in=sorted(set(user_ids)))
         elif isinstance(user_ids, int) or isinstance(user_ids, str):
-            return self.filter(user_id__in=[user_ids])
+            return self.filter(user_id=user_ids)
         return self
 
+    def by_shard(self, shard=0, shards=1):
+        """
+        Filters subscriptions to one of `shards` slices partitioned by user id.
+
+        Args:
+            shard (int): Zero based index of the slice, below `shards`.
+            shards (int): Number of slices.
+
+        Returns:
+            QuerySet: A queryset of subscriptions whose `user_id % shards`
+                      equals `shard`.
+        """
+        if shards <= 1:
+            return self
+        return self.alias(user_shard=F("user_id") % shards).filter(user_shard=shard)
+
+    def scan_expiring(
+        self, start, end, chunk_size=1000, fields=SCAN_FIELDS, statuses=None
+    ):
+        """
+        Streams the subscriptions whose `current_period_end` falls between
+        `start` and `end`, in chunks ordered by `(current_period_end, id)`.
+        Each chunk is read after the last row of the previous one, so no
+        chunk needs an OFFSET and every read is a range scan of an index.
+
+        Args:
+            fields (list): The only columns loaded.
+            statuses (list, optional): Only subscriptions in these statuses.
 
-class UserSubscriptionManager(models.Manager):
+        Yields:
+            list: Up to `chunk_size` subscriptions per chunk.
+        """
+        qs = self.filter(current_period_end__gte=start, current_period_end__lte=end)
+        if statuses is not None:
+            qs = qs.filter(status__in=statuses)
+        qs = qs.only(*fields).order_by("current_period_end", "id")
+        last = None
+        while True:
+            chunk_qs = qs
+            if last is not None:
+                chunk_qs = qs.filter(
+                    Q(current_period_end__gt=last.current_period_end)
+                    | Q(current_period_end=last.current_period_end, id__gt=last.id)
+                )
+            chunk = list(chunk_qs[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            last = chunk[-1]
+
+
+class UserSubscriptionManager(
+    models.Manager.from_queryset(UserSubscriptionQuerySet)
+):
     def get_queryset(self) -> models.QuerySet:
         return UserSubscriptionQuerySet(self.model, using=self._db)
 
@@ -296,7 +378,7 @@ class UserSubscription(models.Model):
     subscription = models.ForeignKey(
         Subscriptions, on_delete=models.SET_NULL, null=True, blank=True
     )
-    stripe_id = models.CharField(max_length=120, null=True, blank=True)
+    stripe_id = StripeIdField()
     active = models.BooleanField(default=True)
     user_cancelled = models.BooleanField(default=False)
     original_period_start = models.DateTimeField(
@@ -318,6 +400,19 @@ class UserSubscription(models.Model):
 
     objects = UserSubscriptionManager()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the plan as loaded to tell whether a save changed it
+        instance._loaded_subscription_id = instance.__dict__.get("subscription_id")
+        return instance
+
+    @property
+    def subscription_changed(self):
+        """True if the plan differs from the one loaded from or saved to the database."""
+        loaded = getattr(self, "_loaded_subscription_id", MISSING)
+        return self.subscription_id != loaded
+
     def serialize(self):
         """Return dict of current period start, end and the status of the subscription."""
         return {
@@ -346,7 +441,8 @@ class UserSubscription(models.Model):
     def save(self, *args, **kwargs):
         if self.original_period_start is None and self.current_period_start is not None:
             self.original_period_start = self.current_period_start
-        return super().save(*args, **kwargs)
+        super().save(*args, **kwargs)
+        self._loaded_subscription_id = self.subscription_id
 
     def __str__(self) -> str:
         subscription_data = " - "
@@ -359,6 +455,95 @@ class UserSubscription(models.Model):
 
         return self.user.username + subscription_data
 
+    class Meta:
+        indexes = [
+            # by_range, by_days_left, by_days_ago and scan_expiring
+            models.Index(
+                fields=["current_period_end", "id"], name="subs_usersub_period_end_idx"
+            ),
+            # the same windows with by_active_trialing
+            models.Index(
+                fields=["status", "current_period_end"],
+                name="subs_usersub_status_end_idx",
+            ),
+        ]
+
+
+class SubscriptionSnapshot(models.Model):
+    """
+    The subscription of a user, denormalized on one row keyed by user so
+    gating a view never joins the plan, its groups or its permissions.
+    Written by `store_snapshots` whenever the UserSubscription changes.
+    """
+
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="subscription_snapshot",
+    )
+    plan_id = models.BigIntegerField(null=True, blank=True)
+    status = models.CharField(
+        max_length=120, null=True, blank=True, choices=SubscriptionStatus.choices
+    )
+    current_period_end = models.DateTimeField(null=True, blank=True)
+    entitlements = models.BigIntegerField(
+        default=0, help_text="ENTITLEMENT_BITS of the plan permissions"
+    )
+    updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def is_active_status(self):
+        return self.status in [SubscriptionStatus.ACTIVE, SubscriptionStatus.TRAILING]
+
+    def has_entitlement(self, codename):
+        """True if the plan grants the `subscriptions.<codename>` permission."""
+        return bool(self.entitlements & ENTITLEMENT_BITS.get(codename, 0))
+
+    def __str__(self) -> str:
+        return f"{self.user_id} - {self.plan_id} ({self.status})"
+
+
+def store_snapshots(user_subs):
+    """
+    Writes the snapshots of the given UserSubscription objects with a
+    single upsert, without reading anything but the plan masks.
+    """
+    masks = get_plan_masks()
+    snapshots = [
+        SubscriptionSnapshot(
+            user_id=obj.user_id,
+            plan_id=obj.subscription_id,
+            status=obj.status,
+            current_period_end=obj.current_period_end,
+            entitlements=masks.get(obj.subscription_id, 0),
+        )
+        for obj in user_subs
+    ]
+    SubscriptionSnapshot.objects.bulk_create(
+        snapshots,
+        update_conflicts=True,
+        unique_fields=["user"],
+        update_fields=[
+            "plan_id",
+            "status",
+            "current_period_end",
+            "entitlements",
+            "updated",
+        ],
+    )
+
+
+def get_user_snapshot(user):
+    """
+    Returns the snapshot of `user`, an empty unsaved one for anonymous users
+    and users that never subscribed.
+    """
+    if not user.is_authenticated:
+        return SubscriptionSnapshot()
+    snapshot = SubscriptionSnapshot.objects.filter(user_id=user.pk).first()
+    return snapshot or SubscriptionSnapshot(user_id=user.pk)
+
 
 def user_sub_post_save(sender, instance, *args, **kwargs):
     """
@@ -366,6 +551,7 @@ def user_sub_post_save(sender, instance, *args, **kwargs):
 
     This function is triggered every time a UserSubscription instance is saved.
     It manages the user's group memberships based on the subscription associated with the UserSubscription.
+    Saves that do not change the subscription (plan) of an existing UserSubscription are skipped.
 
     It performs the following tasks:
     1. Retrieves the user and the subscription associated with the UserSubscription instance.
@@ -394,32 +580,232 @@ def user_sub_post_save(sender, instance, *args, **kwargs):
           excluding groups from other active subscriptions the user is not currently subscribed to.
         - If ALLOW_CUSTOM_GROUPS is False, the user's groups are entirely replaced by the subscription's groups.
     """
-    user_sub_instance = instance
-    user = user_sub_instance.user
-    subscription_obj = user_sub_instance.subscription
-    groups_ids = []
-    if subscription_obj is not None:
-        groups = subscription_obj.groups.all()
-        groups_ids = groups.values_list("id", flat=True)
+    store_snapshots([instance])
+    if kwargs.get("created") or instance.subscription_changed:
+        update_user_groups(instance)
+
+
+# groups of every plan, reloaded when the entitlement version changes
+_plan_groups = {"version": None, "groups": {}, "active": set()}
+
+
+def get_plan_groups():
+    """
+    Returns the group ids of every plan, memoized in the process until a
+    plan or its groups change (see `entitlements.bump_version`).
+
+    Returns:
+        tuple: `(groups_by_plan_id, active_plan_ids)`, the groups are sets.
+    """
+    version = entitlements.get_version()
+    if _plan_groups["version"] != version:
+        groups, active = {}, set()
+        for plan_id, plan_active, group_id in Subscriptions.objects.values_list(
+            "id", "active", "groups__id"
+        ).order_by():
+            plan_groups = groups.setdefault(plan_id, set())
+            if group_id is not None:
+                plan_groups.add(group_id)
+            if plan_active:
+                active.add(plan_id)
+        _plan_groups.update(version=version, groups=groups, active=active)
+    return _plan_groups["groups"], _plan_groups["active"]
+
+
+# the compiled entitlement table, reloaded when the entitlement version changes
+_entitlement_table = {"version": None, "masks": {}, "plans": {}}
+
+
+def get_entitlement_table():
+    """
+    Compiles `SUBSCRIPTIONS_PERMS` and the permissions of every plan into
+    integer masks with one query, memoized in the process like
+    `get_plan_groups`.
+
+    Returns:
+        tuple: `(masks, plans)`, the `ENTITLEMENT_BITS` of each plan by plan
+               id and the plan ids by lowercased plan name.
+    """
+    version = entitlements.get_version()
+    if _entitlement_table["version"] != version:
+        masks, plans = {}, {}
+        for plan_id, name, app_label, codename in Subscriptions.objects.values_list(
+            "id",
+            "name",
+            "permissions__content_type__app_label",
+            "permissions__codename",
+        ).order_by():
+            plans.setdefault(name.lower(), set()).add(plan_id)
+            masks.setdefault(plan_id, 0)
+            if app_label == "subscriptions":
+                masks[plan_id] |= ENTITLEMENT_BITS.get(codename, 0)
+        _entitlement_table.update(version=version, masks=masks, plans=plans)
+    return _entitlement_table["masks"], _entitlement_table["plans"]
+
+
+def get_plan_masks():
+    """
+    Returns:
+        dict: The `ENTITLEMENT_BITS` of each plan, by plan id.
+    """
+    return get_entitlement_table()[0]
+
+
+def get_user_group_ids(plan_id, current_groups):
+    """
+    Returns the group ids a user on the plan `plan_id` should be in.
+
+    With ALLOW_CUSTOM_GROUPS the user keeps the `current_groups` that do not
+    belong to another active plan, otherwise they only get the plan groups.
+    """
+    groups_by_plan, active_plans = get_plan_groups()
+    plan_groups = groups_by_plan.get(plan_id, set())
     if not ALLOW_CUSTOM_GROUPS:
-        user.groups.set(groups)
-    else:
-        groups_ids_set = set(groups_ids)
+        return set(plan_groups)
+    other_plans_groups = set()
+    for other_plan_id in active_plans - {plan_id}:
+        other_plans_groups |= groups_by_plan[other_plan_id]
+    return plan_groups | (set(current_groups) - other_plans_groups)
 
-        subs_qs = Subscriptions.objects.filter(active=True)
-        if subscription_obj is not None:
-            subs_qs = subs_qs.exclude(id=subscription_obj.id)
-        subs_groups = subs_qs.values_list("groups__id", flat=True)
-        subs_groups_set = set(subs_groups)
 
-        current_groups = user.groups.all().values_list("id", flat=True)
-        current_groups_set = set(current_groups) - subs_groups_set
+def update_user_groups(user_sub_instance):
+    """
+    Updates the groups of the subscription's user to match its plan,
+    see `user_sub_post_save`. Also used by code paths that write
+    UserSubscription rows without `save()`.
 
-        final_group_ids = groups_ids_set | current_groups_set
-        user.groups.set(final_group_ids)
+    Only the difference with the user's current groups is added or removed.
+    """
+    user = user_sub_instance.user
+    current_groups = set(user.groups.values_list("id", flat=True))
+    final_group_ids = get_user_group_ids(
+        user_sub_instance.subscription_id, current_groups
+    )
+    if final_group_ids - current_groups:
+        user.groups.add(*(final_group_ids - current_groups))
+    if current_groups - final_group_ids:
+        user.groups.remove(*(current_groups - final_group_ids))
+    # the plan permissions are part of the entitlements too
+    entitlements.invalidate_users([user.id])
 
 
 post_save.connect(
     user_sub_post_save,
     sender=UserSubscription,
 )
+
+
+def bump_entitlements_version(sender, *args, action=None, **kwargs):
+    """Plans or group permissions changed, every user may be affected."""
+    if action is None or action.startswith("post_"):
+        entitlements.bump_version()
+
+
+def invalidate_user_entitlements(sender, instance, *args, **kwargs):
+    """
+    A user, their subscription, groups or permissions changed. From the
+    reverse side of a relation (i.e. `group.user_set.add(...)`) `pk_set`
+    holds the users.
+    """
+    action = kwargs.get("action")
+    if action is not None and not action.startswith("post_"):
+        return
+    if not kwargs.get("reverse"):
+        entitlements.invalidate_users([getattr(instance, "user_id", instance.pk)])
+    elif kwargs.get("pk_set"):
+        entitlements.invalidate_users(kwargs["pk_set"])
+    else:
+        entitlements.bump_version()
+
+
+def refresh_plan_snapshots(sender, instance, *args, action=None, **kwargs):
+    """
+    The permissions of plans changed, or a plan was deleted: rewrites the
+    entitlements of their subscribers' snapshots, one update per plan.
+    """
+    if action is not None and not action.startswith("post_"):
+        return
+    if action is None:
+        # deleted, the subscriptions were set to no plan
+        SubscriptionSnapshot.objects.filter(plan_id=instance.pk).update(
+            plan_id=None, entitlements=0
+        )
+        return
+    plan_ids = kwargs.get("pk_set") if kwargs.get("reverse") else [instance.pk]
+    if plan_ids is None:
+        # cleared from the permission side
+        plan_ids = SubscriptionSnapshot.objects.exclude(plan_id=None).values_list(
+            "plan_id", flat=True
+        ).distinct()
+    masks = get_plan_masks()
+    for plan_id in set(plan_ids):
+        SubscriptionSnapshot.objects.filter(plan_id=plan_id).update(
+            entitlements=masks.get(plan_id, 0)
+        )
+
+
+def delete_user_snapshot(sender, instance, *args, **kwargs):
+    SubscriptionSnapshot.objects.filter(user_id=instance.user_id).delete()
+
+
+def bump_catalog_version(sender, *args, **kwargs):
+    """A plan or a price changed, the pricing page must be rendered again."""
+    catalog.bump_version()
+
+
+for model in [Subscriptions, SubscriptionPrice]:
+    post_save.connect(bump_catalog_version, sender=model)
+    post_delete.connect(bump_catalog_version, sender=model)
+
+post_save.connect(bump_entitlements_version, sender=Subscriptions)
+post_delete.connect(bump_entitlements_version, sender=Subscriptions)
+for through in [
+    Subscriptions.permissions.through,
+    Subscriptions.groups.through,
+    Group.permissions.through,
+]:
+    m2m_changed.connect(bump_entitlements_version, sender=through)
+# after the version bump, so the plan masks are reloaded
+post_delete.connect(refresh_plan_snapshots, sender=Subscriptions)
+m2m_changed.connect(refresh_plan_snapshots, sender=Subscriptions.permissions.through)
+
+post_save.connect(invalidate_user_entitlements, sender=User)
+post_delete.connect(invalidate_user_entitlements, sender=UserSubscription)
+post_delete.connect(delete_user_snapshot, sender=UserSubscription)
+for through in [
+    get_user_model().groups.through,
+    get_user_model().user_permissions.through,
+]:
+    m2m_changed.connect(invalidate_user_entitlements, sender=through)
+
+
+class SyncCheckpoint(models.Model):
+    """
+    Progress of one shard of a subscription sync, so an interrupted run
+    can resume after the last user id it finished.
+    """
+
+    name = models.CharField(max_length=120, default="sync_user_subs")
+    shard = models.PositiveIntegerField(default=0)
+    shards = models.PositiveIntegerField(default=1)
+    last_user_id = models.BigIntegerField(default=0)
+    total = models.PositiveIntegerField(
+        default=0, help_text="Subscriptions in the shard when the run started"
+    )
+    refreshed = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    changed = models.PositiveIntegerField(default=0)
+    started = models.DateTimeField(default=timezone.now)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ["name", "shards", "shard"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["name", "shard", "shards"], name="unique_sync_checkpoint"
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.name} {self.shard}/{self.shards}"
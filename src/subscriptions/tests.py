@@ -1,3 +1,625 @@
-from django.test import TestCase
+import datetime
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import helpers.billing
+import stripe
+from decouple import config
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser, Group, Permission
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.test import RequestFactory, TestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from billing.utils import process_outbox
+from customers.models import Customer
+from helpers import stripe_cache, stripe_client
+from helpers.stripe_fake import FakeStripeClient
+from subscriptions import catalog, entitlements, utils as subs_utils
+from subscriptions.checks import LOCAL_CACHE_BACKENDS, check_shared_cache
+from subscriptions.decorators import requires_entitlement, requires_plan
+from subscriptions.models import (
+    Subscriptions,
+    SubscriptionPrice,
+    SyncCheckpoint,
+    SubscriptionSnapshot,
+    UserSubscription,
+    get_plan_groups,
+    get_user_snapshot,
+    store_snapshots,
+)
+
+User = get_user_model()
+
+
+NOW = int(timezone.now().timestamp())
+
+
+def fake_subscription(stripe_id, raw=True, cached=True, status="active", plan=None):
+    return SimpleNamespace(
+        id=stripe_id,
+        status=status,
+        current_period_start=NOW,
+        current_period_end=NOW + 30 * 24 * 3600,
+        cancel_at_period_end=stripe_id.endswith("9"),
+        plan=plan,
+    )
+
+
+class RefreshSubscriptionsTestCase(TestCase):
+    def setUp(self):
+        for i in range(20):
+            user = User.objects.create(username=f"user-{i}")
+            UserSubscription.objects.create(
+                user=user, stripe_id=f"sub_{i}", status="active"
+            )
+
+    @mock.patch("helpers.billing.get_subscription", side_effect=fake_subscription)
+    def test_concurrent_refresh(self, get_subscription):
+        result = subs_utils.refresh_active_users_subscriptions(workers=4, rate=0)
+        self.assertTrue(result)
+        self.assertEqual(result.refreshed, 20)
+        self.assertEqual(get_subscription.call_count, 20)
+        self.assertEqual(
+            UserSubscription.objects.filter(cancel_at_period_end=True).count(), 2
+        )
+
+    def test_failures_are_reported(self):
+        def flaky(stripe_id, raw=False, cached=True):
+            if stripe_id == "sub_3":
+                raise stripe.InvalidRequestError("No such subscription", "id")
+            return fake_subscription(stripe_id)
+
+        with mock.patch("helpers.billing.get_subscription", side_effect=flaky):
+            result = subs_utils.refresh_active_users_subscriptions(workers=4)
+        self.assertFalse(result)
+        self.assertEqual(result.failed, 1)
+        self.assertEqual(result.refreshed, 19)
+
+    def test_bulk_refresh_lists_subscriptions(self):
+        listed = [
+            fake_subscription(f"sub_{i}", status="past_due") for i in range(19)
+        ] + [SimpleNamespace(id="sub_unknown")]
+        with mock.patch(
+            "helpers.billing.list_subscriptions", return_value=iter(listed)
+        ) as list_subscriptions, mock.patch(
+            "helpers.billing.get_subscription", side_effect=fake_subscription
+        ) as get_subscription:
+            result = subs_utils.refresh_active_users_subscriptions(bulk=True)
+        self.assertTrue(result)
+        list_subscriptions.assert_called_once()
+        # the row missing from the listing is fetched on its own
+        get_subscription.assert_called_once_with("sub_19", raw=True, cached=False)
+        self.assertEqual(UserSubscription.objects.filter(status="past_due").count(), 19)
+
+    @mock.patch("helpers.billing.get_subscription", side_effect=fake_subscription)
+    def test_only_changed_rows_are_written(self, get_subscription):
+        first = subs_utils.refresh_active_users_subscriptions(workers=4)
+        self.assertEqual((first.changed, first.written), (20, 20))
+        with self.assertNumQueries(3):
+            # count, rows and prices, nothing is written
+            second = subs_utils.refresh_active_users_subscriptions()
+        self.assertEqual((second.refreshed, second.changed, second.written), (20, 0, 0))
+        UserSubscription.objects.filter(stripe_id="sub_5").update(status="past_due")
+        third = subs_utils.refresh_active_users_subscriptions(active_only=False)
+        self.assertEqual((third.changed, third.written), (1, 1))
+        self.assertEqual(UserSubscription.objects.filter(status="active").count(), 20)
+
+    def test_plan_change_updates_groups(self):
+        group = Group.objects.create(name="pro")
+        plan = Subscriptions.objects.create(name="Pro", stripe_id="prod_pro")
+        plan.groups.add(group)
+        SubscriptionPrice.objects.create(
+            subscription=plan, stripe_id="price_pro", featured=False
+        )
+
+        def upgraded(stripe_id, raw=True, cached=True):
+            price = SimpleNamespace(id="price_pro") if stripe_id == "sub_1" else None
+            return fake_subscription(stripe_id, plan=price)
+
+        with mock.patch("helpers.billing.get_subscription", side_effect=upgraded):
+            subs_utils.refresh_active_users_subscriptions()
+        user_sub = UserSubscription.objects.get(stripe_id="sub_1")
+        self.assertEqual(user_sub.subscription, plan)
+        self.assertEqual(list(user_sub.user.groups.all()), [group])
+
+    def test_plan_change_invalidates_entitlements(self):
+        cache.clear()
+        pro = Subscriptions.objects.create(name="Pro", stripe_id="prod_pro")
+        pro.permissions.add(Permission.objects.get(codename="pro"))
+        basic = Subscriptions.objects.create(name="Basic", stripe_id="prod_basic")
+        basic.permissions.add(Permission.objects.get(codename="basic"))
+        SubscriptionPrice.objects.create(subscription=basic, stripe_id="price_basic")
+        user_sub = UserSubscription.objects.get(stripe_id="sub_1")
+        user_sub.subscription = pro
+        user_sub.save()
+        user = User.objects.get(pk=user_sub.user_id)
+        self.assertTrue(user.has_perm("subscriptions.pro"))
+
+        def downgraded(stripe_id, raw=True, cached=True):
+            price = SimpleNamespace(id="price_basic") if stripe_id == "sub_1" else None
+            return fake_subscription(stripe_id, plan=price)
+
+        # neither plan has groups, so no membership changes
+        with mock.patch("helpers.billing.get_subscription", side_effect=downgraded):
+            subs_utils.refresh_active_users_subscriptions()
+        user = User.objects.get(pk=user_sub.user_id)
+        self.assertFalse(user.has_perm("subscriptions.pro"))
+        self.assertTrue(user.has_perm("subscriptions.basic"))
+
+    @mock.patch("helpers.billing.get_subscription", side_effect=fake_subscription)
+    def test_shards_cover_every_row(self, get_subscription):
+        refreshed = 0
+        for shard in range(3):
+            result, _ = subs_utils.sync_shard(shard=shard, shards=3, batch_size=4)
+            refreshed += result.refreshed
+        self.assertEqual(refreshed, 20)
+        self.assertEqual(get_subscription.call_count, 20)
+        progress = subs_utils.sync_progress()
+        self.assertEqual((progress["finished"], progress["total"]), (3, 20))
+
+    def test_resume_after_crash(self):
+        qs = UserSubscription.objects.order_by("user_id")
+        user_ids = list(qs.values_list("user_id", flat=True))
+
+        def crashing(stripe_id, raw=True, cached=True):
+            if stripe_id == "sub_12":
+                raise RuntimeError("worker killed")
+            return fake_subscription(stripe_id)
+
+        with mock.patch("helpers.billing.get_subscription", side_effect=crashing):
+            with self.assertRaises(RuntimeError):
+                subs_utils.sync_shard(batch_size=5)
+        checkpoint = SyncCheckpoint.objects.get()
+        # the first two pages were written before the crash
+        self.assertEqual(checkpoint.last_user_id, user_ids[9])
+        self.assertEqual(checkpoint.refreshed, 10)
+        self.assertIsNone(checkpoint.finished)
+
+        with mock.patch(
+            "helpers.billing.get_subscription", side_effect=fake_subscription
+        ) as get_subscription:
+            result, checkpoint = subs_utils.sync_shard(resume=True, batch_size=5)
+        self.assertEqual(get_subscription.call_count, 10)
+        self.assertEqual((checkpoint.refreshed, checkpoint.total), (20, 20))
+        self.assertIsNotNone(checkpoint.finished)
+
+
+class ClearDanglingSubsTestCase(TestCase):
+    def setUp(self):
+        user = User.objects.create(username="known")
+        Customer.objects.create(user=user, stripe_id="cus_known")
+        UserSubscription.objects.create(user=user, stripe_id="sub_kept")
+        self.listed = [
+            SimpleNamespace(id="sub_kept", customer="cus_known"),
+            SimpleNamespace(id="sub_dangling", customer="cus_known"),
+            SimpleNamespace(id="sub_other", customer="cus_not_ours"),
+        ]
+
+    def test_dry_run_cancels_nothing(self):
+        with mock.patch(
+            "helpers.billing.list_subscriptions", return_value=iter(self.listed)
+        ), mock.patch("helpers.billing.cancel_subscription") as cancel:
+            dangling = subs_utils.clear_dangling_subs(dry_run=True, verbose=False)
+        self.assertEqual(dangling, ["sub_dangling"])
+        cancel.assert_not_called()
+
+    def test_cancels_dangling(self):
+        with mock.patch(
+            "helpers.billing.list_subscriptions", return_value=iter(self.listed)
+        ), mock.patch("helpers.billing.cancel_subscription") as cancel:
+            with self.assertNumQueries(2):
+                subs_utils.clear_dangling_subs(verbose=False)
+        cancel.assert_called_once_with(
+            "sub_dangling",
+            reason="Dangling active subscriptions",
+            cancel_at_period_end=False,
+        )
+
+
+class FakeStripeBackendTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.previous_client = stripe.default_http_client
+        self.fake = stripe_client.configure(http_client=FakeStripeClient())
+        self.plan = Subscriptions.objects.create(name="Pro")
+        self.price = SubscriptionPrice.objects.create(subscription=self.plan)
+        process_outbox()
+        self.price.refresh_from_db()
+        for i in range(3):
+            user = User.objects.create(username=f"fake-{i}")
+            customer_id = helpers.billing.create_customer(email=f"fake-{i}@x.com")
+            session = helpers.billing.start_checkout_session(
+                price_stripe_id=self.price.stripe_id, customer_id=customer_id, raw=True
+            )
+            UserSubscription.objects.create(
+                user=user, stripe_id=session.subscription, status="active"
+            )
+
+    def tearDown(self):
+        stripe.default_http_client = self.previous_client
+
+    def test_bulk_sync_against_fake(self):
+        cancelled = UserSubscription.objects.first().stripe_id
+        helpers.billing.cancel_subscription(cancelled)
+        result = subs_utils.refresh_active_users_subscriptions(bulk=True)
+        self.assertEqual((result.refreshed, result.changed), (3, 3))
+        self.assertEqual(
+            UserSubscription.objects.get(stripe_id=cancelled).status, "canceled"
+        )
+        self.assertEqual(
+            UserSubscription.objects.filter(subscription=self.plan).count(), 3
+        )
+
+    def test_injected_errors_are_reported(self):
+        self.fake.error_rate = 1.0
+        with mock.patch.object(stripe, "max_network_retries", 0):
+            result = subs_utils.refresh_active_users_subscriptions()
+        self.assertEqual((result.refreshed, result.failed), (0, 3))
+
+    def test_reads_are_cached_until_cancelled(self):
+        stripe_id = UserSubscription.objects.first().stripe_id
+        stripe_cache.stats.reset()
+        for _ in range(3):
+            helpers.billing.get_subscription(stripe_id)
+        self.assertEqual(
+            stripe_cache.stats.snapshot()["subscription"], {"hits": 2, "misses": 1}
+        )
+        helpers.billing.cancel_subscription(stripe_id)
+        # the cancellation response replaces the cached copy
+        sub_data = helpers.billing.get_subscription(stripe_id)
+        self.assertEqual(sub_data["status"], "canceled")
+        self.assertEqual(stripe_cache.stats.snapshot()["subscription"]["hits"], 3)
+
+
+class EntitlementsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.pro = Permission.objects.get(codename="pro")
+        self.plan = Subscriptions.objects.create(name="Pro", stripe_id="prod_pro")
+        self.plan.permissions.add(self.pro)
+        self.user = User.objects.create(username="member")
+        UserSubscription.objects.create(user=self.user, subscription=self.plan)
+
+    def has_pro(self):
+        # a new object per check, like a new request
+        return User.objects.get(pk=self.user.pk).has_perm("subscriptions.pro")
+
+    def test_checks_are_served_from_the_cache(self):
+        self.assertTrue(self.has_pro())
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm("subscriptions.pro"))
+            self.assertFalse(user.has_perm("subscriptions.advanced"))
+
+    def test_plan_changes_bump_the_version(self):
+        self.assertTrue(self.has_pro())
+        self.plan.permissions.remove(self.pro)
+        self.assertFalse(self.has_pro())
+
+    def test_subscription_changes_invalidate_the_user(self):
+        self.assertTrue(self.has_pro())
+        user_sub = UserSubscription.objects.get(user=self.user)
+        user_sub.subscription = Subscriptions.objects.create(
+            name="Basic", stripe_id="prod_basic"
+        )
+        user_sub.save()
+        self.assertFalse(self.has_pro())
+
+    def test_sync_group_perms_writes_only_the_difference(self):
+        group = Group.objects.create(name="pro")
+        group.permissions.add(Permission.objects.get(codename="advanced"))
+        self.plan.groups.add(group)
+        expected = (
+            [("pro", "subscriptions.pro")],
+            [("pro", "subscriptions.advanced")],
+        )
+        self.assertEqual(subs_utils.sync_subs_group_perms(dry_run=True), expected)
+        self.assertEqual(group.permissions.get().codename, "advanced")
+
+        version = entitlements.get_version()
+        self.assertEqual(subs_utils.sync_subs_group_perms(), expected)
+        self.assertEqual(group.permissions.get().codename, "pro")
+        self.assertNotEqual(entitlements.get_version(), version)
+        with self.assertNumQueries(2):
+            self.assertEqual(subs_utils.sync_subs_group_perms(), ([], []))
+
+    def test_check_requires_a_shared_cache(self):
+        locmem = {"default": {"BACKEND": LOCAL_CACHE_BACKENDS[0]}}
+        redis = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache"}}
+        with override_settings(CACHES=locmem, DEBUG=False):
+            ids = [error.id for error in check_shared_cache(None)]
+            self.assertEqual(ids, ["subscriptions.W001"])
+        with override_settings(CACHES=locmem, DEBUG=True):
+            self.assertEqual(check_shared_cache(None), [])
+        with override_settings(CACHES=redis, DEBUG=False):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class UserGroupsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.custom = Group.objects.create(name="custom")
+        self.basic_group = Group.objects.create(name="basic")
+        self.pro_group = Group.objects.create(name="pro")
+        self.basic = Subscriptions.objects.create(name="Basic", stripe_id="prod_b")
+        self.basic.groups.add(self.basic_group)
+        self.pro = Subscriptions.objects.create(name="Pro", stripe_id="prod_p")
+        self.pro.groups.add(self.pro_group)
+        self.user = User.objects.create(username="member")
+        self.user.groups.add(self.custom)
+        UserSubscription.objects.create(user=self.user, subscription=self.basic)
+
+    def groups(self):
+        return set(self.user.groups.values_list("name", flat=True))
+
+    def test_plan_change_swaps_plan_groups(self):
+        self.assertEqual(self.groups(), {"custom", "basic"})
+        user_sub = UserSubscription.objects.get(user=self.user)
+        user_sub.subscription = self.pro
+        user_sub.save()
+        self.assertEqual(self.groups(), {"custom", "pro"})
+
+    def test_saves_without_plan_change_skip_groups(self):
+        user_sub = UserSubscription.objects.get(user=self.user)
+        user_sub.current_period_end = timezone.now()
+        # the update and the snapshot upsert, no group queries
+        with self.assertNumQueries(2):
+            user_sub.save()
+
+    def test_replaces_groups_without_custom_groups(self):
+        user_sub = UserSubscription.objects.get(user=self.user)
+        user_sub.subscription = None
+        with mock.patch("subscriptions.models.ALLOW_CUSTOM_GROUPS", False):
+            user_sub.save()
+        self.assertEqual(self.groups(), set())
+
+    def test_recompute_user_groups_in_bulk(self):
+        users = [User.objects.create(username=f"member-{i}") for i in range(5)]
+        UserSubscription.objects.bulk_create(
+            [UserSubscription(user=user, subscription=self.basic) for user in users]
+        )
+        # moving everyone at once skips the post_save signals
+        UserSubscription.objects.update(subscription=self.pro)
+        get_plan_groups()
+        with self.assertNumQueries(4):
+            result = subs_utils.recompute_user_groups(plan_ids=[self.pro.id])
+        self.assertEqual(result, (6, 6, 1))
+        self.assertEqual(self.groups(), {"custom", "pro"})
+        self.assertEqual(set(users[0].groups.values_list("name", flat=True)), {"pro"})
+        self.assertEqual(subs_utils.recompute_user_groups(), (0, 0, 0))
+
+
+class SubscriptionSnapshotTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.plan = Subscriptions.objects.create(name="Pro", stripe_id="prod_pro")
+        self.plan.permissions.add(Permission.objects.get(codename="pro"))
+        self.user = User.objects.create(username="member")
+        UserSubscription.objects.create(
+            user=self.user, subscription=self.plan, status="active"
+        )
+
+    def snapshot(self):
+        return SubscriptionSnapshot.objects.get(user=self.user)
+
+    def test_snapshot_follows_the_subscription_and_plan(self):
+        snapshot = self.snapshot()
+        self.assertEqual((snapshot.plan_id, snapshot.status), (self.plan.id, "active"))
+        self.assertTrue(snapshot.has_entitlement("pro"))
+        self.assertFalse(snapshot.has_entitlement("advanced"))
+
+        self.plan.permissions.add(Permission.objects.get(codename="advanced"))
+        self.assertTrue(self.snapshot().has_entitlement("advanced"))
+
+        self.plan.delete()
+        snapshot = self.snapshot()
+        self.assertEqual((snapshot.plan_id, snapshot.entitlements), (None, 0))
+
+    def test_request_subscription_is_loaded_lazily(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("user_subscription"))
+        request = response.wsgi_request
+        with self.assertNumQueries(1):
+            self.assertTrue(request.subscription.has_entitlement("pro"))
+            self.assertTrue(request.subscription.is_active_status)
+
+    def test_billing_page_does_not_write_on_get(self):
+        user = User.objects.create(username="visitor")
+        self.client.force_login(user)
+        response = self.client.get(reverse("user_subscription"))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(UserSubscription.objects.filter(user=user).exists())
+        self.assertEqual(response.wsgi_request.subscription.entitlements, 0)
+
+
+class PlanGatingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.plan = Subscriptions.objects.create(name="Pro", stripe_id="prod_pro")
+        self.plan.permissions.add(Permission.objects.get(codename="pro"))
+        self.user = User.objects.create(username="member")
+        UserSubscription.objects.create(
+            user=self.user, subscription=self.plan, status="active"
+        )
+
+    def get(self, view, user):
+        request = RequestFactory().get("/reports/")
+        request.user = user
+        request.subscription = get_user_snapshot(user)
+        request._messages = mock.MagicMock()
+        return view(request)
+
+    def test_requires_entitlement(self):
+        view = requires_entitlement("subscriptions.pro")(lambda request: "ok")
+        self.assertEqual(self.get(view, self.user), "ok")
+        response = self.get(view, User.objects.create(username="free"))
+        self.assertEqual(response.url, "/pricing/month")
+        response = self.get(view, AnonymousUser())
+        self.assertTrue(response.url.startswith("/accounts/login/"))
+
+        advanced_view = requires_entitlement("pro", "advanced")(lambda request: "ok")
+        self.assertEqual(self.get(advanced_view, self.user).status_code, 302)
+        with self.assertRaises(ImproperlyConfigured):
+            requires_entitlement("unknown")
+
+    def test_requires_plan(self):
+        view = requires_plan("PRO", "Enterprise")(lambda request: "ok")
+        self.assertEqual(self.get(view, self.user), "ok")
+        UserSubscription.objects.filter(user=self.user).update(status="canceled")
+        store_snapshots(UserSubscription.objects.filter(user=self.user))
+        self.assertEqual(self.get(view, self.user).status_code, 302)
+
+    def test_bench_leaves_the_shared_cache_alone(self):
+        versions = entitlements.get_version(), catalog.get_version()
+        call_command("bench_gating", checks=10, stdout=StringIO())
+        self.assertEqual((entitlements.get_version(), catalog.get_version()), versions)
+        self.assertFalse(Subscriptions.objects.filter(stripe_id="prod_bench").exists())
+
+    @override_settings(PLAN_GATED_PATHS={"/profiles/": ["pro"]})
+    def test_gated_paths(self):
+        self.client.force_login(User.objects.create(username="free"))
+        response = self.client.get("/profiles/")
+        self.assertRedirects(response, "/pricing/month", fetch_redirect_response=False)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get("/profiles/").status_code, 200)
+
+
+class PricingViewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        for i in range(3):
+            plan = Subscriptions.objects.create(
+                name=f"plan {i}", features="Storage\nSupport", stripe_id=f"prod_{i}"
+            )
+            SubscriptionPrice.objects.create(subscription=plan, stripe_id=f"price_{i}")
+        self.url = reverse("pricing", kwargs={"interval": "month"})
+
+    def get_pricing(self, url=None, **headers):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url or self.url, **headers)
+        queries = [q["sql"] for q in ctx.captured_queries if "subscription" in q["sql"]]
+        return response, queries
+
+    def test_price_grid_is_rendered_once_per_catalog_version(self):
+        response, queries = self.get_pricing()
+        self.assertContains(response, "Plan 2")
+        self.assertContains(response, "Support")
+        self.assertEqual(len(queries), 1)
+
+        response, queries = self.get_pricing()
+        self.assertContains(response, "Plan 2")
+        self.assertEqual(queries, [])
+
+        plan = Subscriptions.objects.get(name="plan 2")
+        plan.name = "enterprise"
+        plan.save()
+        response, queries = self.get_pricing()
+        self.assertContains(response, "Enterprise")
+        self.assertNotContains(response, "Plan 2")
+
+    def test_pricing_api_revalidates_with_etag(self):
+        url = reverse("pricing-api")
+        response = self.client.get(url)
+        data = response.json()
+        self.assertEqual(len(data["plans"]), 3)
+        self.assertEqual(data["plans"][0]["features"], ["Storage", "Support"])
+        self.assertEqual(len(data["prices"]["month"]), 3)
+        self.assertEqual(data["prices"]["year"], [])
+        self.assertIn("max-age", response["Cache-Control"])
+        etag = response["ETag"]
+
+        response, queries = self.get_pricing(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(queries, [])
+
+        # the ETag only changes with the content
+        price = SubscriptionPrice.objects.filter(interval="month").first()
+        price.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        price.price = 19
+        price.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+@tag("slow")
+@skipUnless(config("RUN_SLOW_TESTS", cast=bool, default=False), "RUN_SLOW_TESTS=1")
+class UserSubscriptionIndexTestCase(TestCase):
+    # enough rows for the planner to prefer the indexes over a table scan
+    rows = 1_000_000
+
+    @classmethod
+    def setUpTestData(cls):
+        if connection.vendor == "postgresql":
+            period_end = "now() + (n % 730 - 365) * interval '1 day'"
+        else:
+            period_end = "datetime('now', (n % 730 - 365) || ' days')"
+        user_table = User._meta.db_table
+        sub_table = UserSubscription._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {user_table} (password, is_superuser, username,
+                    first_name, last_name, email, is_staff, is_active, date_joined)
+                WITH RECURSIVE seq(n) AS (
+                    SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < %s
+                )
+                SELECT '', false, 'scan-' || n, '', '', '', false, true,
+                    {period_end}
+                FROM seq
+                """,
+                [cls.rows],
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO {sub_table} (user_id, active, user_cancelled,
+                    cancel_at_period_end, current_period_end, status)
+                SELECT id, true, false, false, date_joined,
+                    CASE id % 4 WHEN 0 THEN 'canceled' ELSE 'active' END
+                FROM {user_table} WHERE username LIKE %s
+                """,
+                ["scan-%"],
+            )
+            cursor.execute("ANALYZE")
+
+    def assertUsesIndex(self, qs, index_name):
+        self.assertIn(index_name, qs.explain())
+
+    def test_windows_use_the_period_end_indexes(self):
+        qs = UserSubscription.objects.all()
+        self.assertUsesIndex(qs.by_days_left(7), "subs_usersub_period_end_idx")
+        self.assertUsesIndex(
+            qs.by_range(7, 30).by_active_trialing(), "subs_usersub_status_end_idx"
+        )
+        # the chunks of scan_expiring after the first one
+        last = qs.by_days_ago(3).order_by("current_period_end", "id").first()
+        chunk_qs = qs.filter(
+            Q(current_period_end__gt=last.current_period_end)
+            | Q(current_period_end=last.current_period_end, id__gt=last.id),
+            current_period_end__lte=timezone.now(),
+        ).order_by("current_period_end", "id")
+        self.assertUsesIndex(chunk_qs[:1000], "subs_usersub_period_end_idx")
+
+    def test_scan_expiring_in_chunks(self):
+        start = timezone.now()
+        end = start + datetime.timedelta(days=10)
+        qs = UserSubscription.objects.all()
+        chunks = list(qs.scan_expiring(start, end, chunk_size=1000))
+        rows = [obj for chunk in chunks for obj in chunk]
+        expected = qs.filter(current_period_end__gte=start, current_period_end__lte=end)
+        self.assertEqual(len(rows), expected.count())
+        self.assertEqual(len(rows), len({obj.id for obj in rows}))
+        self.assertTrue(all(len(chunk) == 1000 for chunk in chunks[:-1]))
+        self.assertEqual(
+            [(o.current_period_end, o.id) for o in rows],
+            sorted((o.current_period_end, o.id) for o in rows),
+        )
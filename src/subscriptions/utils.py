@@ -1,7 +1,201 @@
+import hashlib
 import helpers.billing
-from django.db.models import Q
+import json
+import stripe
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+from helpers.rate_limit import RateLimiter
 from customers.models import Customer
-from subscriptions.models import UserSubscription, Subscriptions, SubscriptionStatus
+from subscriptions import catalog, entitlements
+from subscriptions.models import (
+    UserSubscription,
+    Subscriptions,
+    SubscriptionPrice,
+    SubscriptionStatus,
+    SyncCheckpoint,
+    get_user_group_ids,
+    store_snapshots,
+)
+
+User = get_user_model()
+
+
+SYNC_FIELDS = [
+    "current_period_start",
+    "current_period_end",
+    "status",
+    "cancel_at_period_end",
+]
+
+
+class SyncResult:
+    """
+    Outcome of a subscription sync. Truthy when every scanned subscription
+    was refreshed from Stripe.
+    """
+
+    def __init__(self):
+        self.scanned = 0
+        self.refreshed = 0
+        self.failed = 0
+        self.changed = 0
+        self.written = 0
+        self.elapsed = 0.0
+        self._started = time.perf_counter()
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self._started
+        return self
+
+    @property
+    def ok(self):
+        return self.refreshed == self.scanned
+
+    @property
+    def rate(self):
+        """Refreshed subscriptions per second."""
+        return self.refreshed / self.elapsed if self.elapsed else 0.0
+
+    def __bool__(self):
+        return self.ok
+
+    def __str__(self) -> str:
+        return (
+            f"scanned {self.scanned}, refreshed {self.refreshed}, "
+            f"failed {self.failed}, changed {self.changed}, "
+            f"written {self.written} in {self.elapsed:.1f}s ({self.rate:.1f}/s)"
+        )
+
+
+def serialize_sync_data(sub_r):
+    """Serialized subscription data plus the Stripe id of its price (plan)."""
+    plan = getattr(sub_r, "plan", None)
+    return {
+        **helpers.billing.serialize_subscription_data(sub_r),
+        "price_stripe_id": plan.id if plan else None,
+    }
+
+
+def apply_sync_data(obj, sub_data, plans_by_price_id):
+    """
+    Copies Stripe data onto `obj` without saving it.
+
+    Args:
+        plans_by_price_id (dict): Maps price Stripe ids to `Subscriptions` ids.
+
+    Returns:
+        set: The names of the fields whose value changed.
+    """
+    changed = set()
+    for field in SYNC_FIELDS:
+        value = sub_data[field]
+        if getattr(obj, field) != value:
+            setattr(obj, field, value)
+            changed.add(field)
+    if obj.original_period_start is None and obj.current_period_start is not None:
+        obj.original_period_start = obj.current_period_start
+        changed.add("original_period_start")
+    plan_id = plans_by_price_id.get(sub_data.get("price_stripe_id"))
+    if plan_id is not None and plan_id != obj.subscription_id:
+        obj.subscription_id = plan_id
+        changed.add("subscription")
+    return changed
+
+
+def fetch_stripe_subscriptions(objs, workers=1, rate=None):
+    """
+    Fetches the Stripe subscription of every `UserSubscription` in `objs`.
+
+    With `workers` > 1 the Stripe calls run on a bounded thread pool while the
+    results are yielded to the calling thread, so database writes stay on it.
+    `rate` caps the number of Stripe calls per second across all workers.
+
+    Yields:
+        tuple: `(obj, sub_data, error)` in completion order, where `error` is
+               the `stripe.StripeError` raised for that subscription, if any.
+    """
+    limiter = RateLimiter(rate=rate)
+
+    def fetch(stripe_id):
+        limiter.acquire()
+        sub_r = helpers.billing.get_subscription(stripe_id, raw=True, cached=False)
+        return serialize_sync_data(sub_r)
+
+    def result(obj, future):
+        try:
+            return obj, future.result(), None
+        except stripe.StripeError as e:
+            return obj, None, e
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = {}
+        for obj in objs:
+            pending[executor.submit(fetch, obj.stripe_id)] = obj
+            # keep a bounded number of calls in flight
+            if len(pending) >= max(1, workers) * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield result(pending.pop(future), future)
+        for future in as_completed(list(pending)):
+            yield result(pending.pop(future), future)
+
+
+def list_stripe_subscriptions(
+    objs, status="all", created=None, narrow=False, workers=1, rate=None
+):
+    """
+    Matches subscriptions streamed from `stripe.Subscription.list` to the
+    `UserSubscription` rows in `objs` through a `stripe_id` map.
+
+    With `narrow` the listing is limited to the `current_period_end` range of
+    `objs`, so filtered syncs only page through the matching part of the account.
+
+    Yields:
+        tuple: `(obj, sub_data, error)` like `fetch_stripe_subscriptions`, for
+               the rows Stripe returned, then for the remaining rows fetched
+               one by one (i.e. subscriptions renewed out of the range).
+    """
+    objs_by_stripe_id = {obj.stripe_id: obj for obj in objs}
+    bounds = objs.aggregate(
+        gte=Min("current_period_end"), lte=Max("current_period_end")
+    )
+    current_period_end = None
+    if narrow and None not in bounds.values():
+        current_period_end = {k: int(v.timestamp()) for k, v in bounds.items()}
+    for sub_r in helpers.billing.list_subscriptions(
+        status=status, current_period_end=current_period_end, created=created
+    ):
+        obj = objs_by_stripe_id.pop(sub_r.id, None)
+        if obj is not None:
+            yield obj, serialize_sync_data(sub_r), None
+    yield from fetch_stripe_subscriptions(
+        objs_by_stripe_id.values(), workers=workers, rate=rate
+    )
+
+
+def keyset_pages(qs, page_size=500, after=None):
+    """
+    Iterates `qs` in pages ordered by `user_id`, each page filtered on the
+    last user id of the previous one, so no page needs an OFFSET and the
+    queryset is never loaded as a whole.
+
+    Yields:
+        list: Up to `page_size` objects per page.
+    """
+    qs = qs.order_by("user_id")
+    while True:
+        page_qs = qs if after is None else qs.filter(user_id__gt=after)
+        page = list(page_qs[:page_size])
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        after = page[-1].user_id
 
 
 def refresh_active_users_subscriptions(
@@ -11,8 +205,42 @@ def refresh_active_users_subscriptions(
     days_left=0,
     day_start=0,
     day_end=0,
+    workers=1,
+    rate=None,
+    bulk=False,
+    status="all",
+    created=None,
+    batch_size=500,
+    shard=0,
+    shards=1,
+    after=None,
+    on_page=None,
     verbose=False,
 ):
+    """
+    Refreshes the matching `UserSubscription` rows from Stripe.
+
+    Args:
+        workers (int): Number of concurrent Stripe calls.
+        rate (float, optional): Maximum Stripe calls per second.
+        bulk (bool): Stream `stripe.Subscription.list` (100 per call) instead
+                     of retrieving every subscription on its own.
+        status (str): Stripe status filter of the bulk listing.
+        created (dict, optional): Stripe `created` range filter of the bulk listing.
+        batch_size (int): Rows read per page, and changed rows written per `bulk_update`.
+        shard (int), shards (int): Only sync the slice `user_id % shards == shard`.
+        after (int, optional): Only sync users with a greater id.
+        on_page (callable, optional): Called with `(last_user_id, result)` once
+                                      the rows up to `last_user_id` are written.
+                                      In bulk mode it is only called at the end.
+
+    Only rows whose data differ from Stripe are written, with `bulk_update`
+    on the changed columns, so the per row `save()` and its signal are skipped.
+
+    Returns:
+        SyncResult: Counts and throughput of the sync, truthy when every
+                    subscription was refreshed.
+    """
     qs = UserSubscription.objects.all()
     if active_only:
         qs = qs.by_active_trialing()
@@ -27,60 +255,383 @@ def refresh_active_users_subscriptions(
     if day_start > 0 and day_end > 0:
         qs = qs.by_range(days_start=day_start, days_end=day_end)
 
-    complete_count = 0
-    qs_count = qs.count()
-    for obj in qs:
-        if verbose:
-            print("Updating user", obj.user, obj.subscription, obj.current_period_end)
-        if obj.stripe_id:
-            sub_data = helpers.billing.get_subscription(obj.stripe_id)
-            for k, v in sub_data.items():
-                setattr(obj, k, v)
-            complete_count += 1
-            obj.save()
-    return complete_count == qs_count
-
-
-def clear_dangling_subs():
-    """
-    This command synchronizes customer subscriptions with their corresponding
-    UserSubscription records in the database. It checks for any dangling active
-    subscriptions in Stripe (subscriptions that don't have a corresponding
-    UserSubscription) and cancels them with the reason 'Dangling active subscriptions'.
-    The cancellation can be immediate and does not wait for the subscription to end at the
-    end of the billing period or it isn't
-    """
-    qs = Customer.objects.filter(stripe_id__isnull=False)
-    for customer_obj in qs:
-        user = customer_obj.user
-        customer_stripe_id = customer_obj.stripe_id
-        subs = helpers.billing.get_customer_active_subscriptions(customer_stripe_id)
-        for sub in subs:
-            existing_user_subs_qs = UserSubscription.objects.filter(
-                stripe_id__iexact=f"{sub.id.strip()}"
+    qs = qs.by_shard(shard=shard, shards=shards)
+    if after is not None:
+        qs = qs.filter(user_id__gt=after)
+
+    result = SyncResult()
+    result.scanned = qs.count()
+    objs = qs.exclude(stripe_id__isnull=True).exclude(stripe_id="")
+    objs = objs.select_related("user")
+
+    plans_by_price_id = dict(
+        SubscriptionPrice.objects.filter(
+            stripe_id__isnull=False, subscription__isnull=False
+        )
+        .order_by()
+        .values_list("stripe_id", "subscription_id")
+    )
+    changed_objs = []
+    changed_fields = set()
+    plan_changed_objs = []
+
+    def write_changes():
+        if changed_objs:
+            result.written += UserSubscription.objects.bulk_update(
+                changed_objs, fields=sorted(changed_fields)
             )
-            if existing_user_subs_qs.exists():
+            store_snapshots(changed_objs)
+        changed_objs.clear()
+        changed_fields.clear()
+        # bulk_update skips the post_save signal, so only the users whose
+        # plan changed get their groups recomputed
+        if plan_changed_objs:
+            user_ids = [obj.user_id for obj in plan_changed_objs]
+            recompute_user_groups(user_ids=user_ids)
+            # the plan permissions changed even if the groups did not
+            entitlements.invalidate_users(user_ids)
+        plan_changed_objs.clear()
+
+    def apply(fetched):
+        for obj, sub_data, error in fetched:
+            if error is not None:
+                result.failed += 1
+                print("Failed to refresh", obj.user, error)
+                continue
+            result.refreshed += 1
+            fields = apply_sync_data(obj, sub_data, plans_by_price_id)
+            if not fields:
                 continue
-            helpers.billing.cancel_subscription(
-                sub.id,
-                reason="Dangling active subscriptions",
-                cancel_at_period_end=False,
+            if verbose:
+                print("Updating user", obj.user, sorted(fields), obj.current_period_end)
+            result.changed += 1
+            changed_objs.append(obj)
+            changed_fields.update(fields)
+            if "subscription" in fields:
+                plan_changed_objs.append(obj)
+            if len(changed_objs) >= batch_size:
+                write_changes()
+        write_changes()
+
+    if bulk:
+        apply(
+            list_stripe_subscriptions(
+                objs,
+                status=status,
+                created=created,
+                narrow=any([days_ago, days_left, day_start and day_end]),
+                workers=workers,
+                rate=rate,
             )
+        )
+        last_user_id = objs.aggregate(last=Max("user_id"))["last"]
+        if on_page is not None and last_user_id is not None:
+            on_page(last_user_id, result)
+    else:
+        for page in keyset_pages(objs, page_size=batch_size):
+            apply(fetch_stripe_subscriptions(page, workers=workers, rate=rate))
+            if on_page is not None:
+                on_page(page[-1].user_id, result)
+    return result.finish()
+
+
+def sync_shard(shard=0, shards=1, resume=False, name="sync_user_subs", **options):
+    """
+    Runs `refresh_active_users_subscriptions` on one shard, recording its
+    progress in a `SyncCheckpoint` after every page.
+
+    Args:
+        resume (bool): Continue after the checkpoint of an unfinished run
+                       instead of starting over.
+        **options: Passed to `refresh_active_users_subscriptions`.
+
+    Returns:
+        tuple: `(result, checkpoint)`.
+    """
+    checkpoint, _ = SyncCheckpoint.objects.get_or_create(
+        name=name, shard=shard, shards=shards
+    )
+    fresh = not resume or checkpoint.finished is not None
+    if fresh:
+        checkpoint.last_user_id = 0
+        checkpoint.refreshed = checkpoint.failed = checkpoint.changed = 0
+        checkpoint.started = timezone.now()
+        checkpoint.finished = None
+    done = {"refreshed": 0, "failed": 0, "changed": 0}
+
+    def save_checkpoint(last_user_id, result):
+        if fresh:
+            checkpoint.total = result.scanned
+        checkpoint.last_user_id = last_user_id
+        for field, previous in done.items():
+            value = getattr(result, field)
+            setattr(checkpoint, field, getattr(checkpoint, field) + value - previous)
+            done[field] = value
+        checkpoint.save()
+
+    result = refresh_active_users_subscriptions(
+        shard=shard,
+        shards=shards,
+        after=checkpoint.last_user_id,
+        on_page=save_checkpoint,
+        **options,
+    )
+    save_checkpoint(checkpoint.last_user_id, result)
+    checkpoint.finished = timezone.now()
+    checkpoint.save()
+    return result, checkpoint
+
+
+def sync_progress(name="sync_user_subs"):
+    """
+    Merges the checkpoints of every shard of the latest sharded run.
+
+    Returns:
+        dict: `shards` (the checkpoints), `finished` (number of finished
+              shards) and the summed `total`, `refreshed`, `failed`
+              and `changed` counts, or None if nothing ran yet.
+    """
+    latest = SyncCheckpoint.objects.filter(name=name).order_by("-updated").first()
+    if latest is None:
+        return None
+    checkpoints = list(SyncCheckpoint.objects.filter(name=name, shards=latest.shards))
+    progress = {
+        "shards": checkpoints,
+        "finished": sum(obj.finished is not None for obj in checkpoints),
+    }
+    for field in ["total", "refreshed", "failed", "changed"]:
+        progress[field] = sum(getattr(obj, field) for obj in checkpoints)
+    return progress
+
+
+def recompute_user_groups(
+    user_ids=None, plan_ids=None, batch_size=1000, dry_run=False
+):
+    """
+    Sets the groups of many users to match their plans, like
+    `update_user_groups` does for one user, reading and writing the
+    `User.groups` through table in bulk.
+
+    Each batch of `batch_size` users costs a constant number of queries:
+    one for the subscriptions, one for the current memberships, one insert
+    and one delete.
+
+    Args:
+        user_ids (list, optional): Only these users.
+        plan_ids (list, optional): Only the users on these plans.
+        dry_run (bool): Only count the changes.
+
+    Returns:
+        tuple: `(users, added, removed)`, the number of users whose groups
+               changed and of memberships added and removed.
+    """
+    Membership = User.groups.through
+    qs = UserSubscription.objects.all()
+    if user_ids is not None:
+        qs = qs.filter(user_id__in=user_ids)
+    if plan_ids is not None:
+        qs = qs.filter(subscription_id__in=plan_ids)
+    qs = qs.only("user_id", "subscription_id")
+
+    changed_users, added, removed = 0, 0, 0
+    for page in keyset_pages(qs, page_size=batch_size):
+        plans = {obj.user_id: obj.subscription_id for obj in page}
+        current = {user_id: {} for user_id in plans}
+        for row_id, user_id, group_id in Membership.objects.filter(
+            user_id__in=plans
+        ).values_list("id", "user_id", "group_id"):
+            current[user_id][group_id] = row_id
+
+        to_add, to_remove, users = [], [], []
+        for user_id, plan_id in plans.items():
+            final_group_ids = get_user_group_ids(plan_id, current[user_id])
+            new_groups = final_group_ids - current[user_id].keys()
+            old_groups = current[user_id].keys() - final_group_ids
+            to_add += [Membership(user_id=user_id, group_id=g) for g in new_groups]
+            to_remove += [current[user_id][g] for g in old_groups]
+            if new_groups or old_groups:
+                users.append(user_id)
+
+        changed_users += len(users)
+        added += len(to_add)
+        removed += len(to_remove)
+        if dry_run:
+            continue
+        if to_add:
+            Membership.objects.bulk_create(to_add, ignore_conflicts=True)
+        if to_remove:
+            Membership.objects.filter(id__in=to_remove).delete()
+        # the bulk writes skip the m2m_changed signals
+        entitlements.invalidate_users(users)
+    return changed_users, added, removed
 
 
-def sync_subs_group_perms():
+def clear_dangling_subs(dry_run=False, workers=4, rate=None, verbose=True):
     """
-    Synchronizes group permissions with subscription permissions.
-    This command iterates over all active subscriptions, and for each
-    subscription, it sets the permissions of its associated groups to
-    match the permissions associated with the subscription. This ensures
-    that the groups have the same set of permissions as the subscription,
-    keeping the system in sync.
+    Cancels active Stripe subscriptions of our customers that have no
+    corresponding UserSubscription, with the reason 'Dangling active subscriptions'.
+    The cancellation is immediate and does not wait for the end of the
+    billing period.
+
+    All active subscriptions are streamed from Stripe once and compared with
+    every known `UserSubscription.stripe_id`, loaded in a single query.
+
+    Args:
+        dry_run (bool): Only print the subscriptions that would be cancelled.
+        workers (int): Number of concurrent cancellations.
+        rate (float, optional): Maximum Stripe calls per second.
+
+    Returns:
+        list: Stripe ids of the dangling subscriptions.
+    """
+    customer_ids = set(
+        Customer.objects.filter(stripe_id__isnull=False).values_list(
+            "stripe_id", flat=True
+        )
+    )
+    # stored ids are normalized, so they compare exactly with Stripe's
+    known_ids = set(
+        UserSubscription.objects.filter(stripe_id__isnull=False).values_list(
+            "stripe_id", flat=True
+        )
+    )
+    dangling = []
+    for sub in helpers.billing.list_subscriptions(status="active"):
+        if sub.customer not in customer_ids:
+            continue
+        if sub.id in known_ids:
+            continue
+        dangling.append(sub.id)
+        if verbose:
+            prefix = "Would cancel" if dry_run else "Cancelling"
+            print(prefix, sub.id, "of customer", sub.customer)
+    if dry_run:
+        return dangling
+
+    limiter = RateLimiter(rate=rate)
+
+    def cancel(stripe_id):
+        limiter.acquire()
+        return helpers.billing.cancel_subscription(
+            stripe_id,
+            reason="Dangling active subscriptions",
+            cancel_at_period_end=False,
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(cancel, stripe_id): stripe_id for stripe_id in dangling}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except stripe.StripeError as e:
+                print("Failed to cancel", futures[future], e)
+    return dangling
+
+
+def sync_subs_group_perms(dry_run=False):
+    """
+    Synchronizes group permissions with subscription permissions: the groups
+    of the active subscriptions get exactly the permissions of their
+    subscriptions (of all of them, for a group shared by several plans).
+
+    The desired and the existing (group, permission) pairs are read with one
+    query each, and only the difference is written, with one bulk insert and
+    one delete.
+
+    Args:
+        dry_run (bool): Only compute the difference.
+
+    Returns:
+        tuple: `(added, removed)`, lists of `(group name, "app_label.codename")`.
     """
-    qs = Subscriptions.objects.filter(active=True)
+    Grant = Group.permissions.through
+    desired, group_names, perm_names = {}, {}, {}
+    rows = Subscriptions.objects.filter(active=True, groups__isnull=False).values_list(
+        "groups__id",
+        "groups__name",
+        "permissions__id",
+        "permissions__content_type__app_label",
+        "permissions__codename",
+    )
+    for group_id, group_name, perm_id, app_label, codename in rows:
+        group_names[group_id] = group_name
+        desired.setdefault(group_id, set())
+        if perm_id is not None:
+            desired[group_id].add(perm_id)
+            perm_names[perm_id] = f"{app_label}.{codename}"
+
+    existing = {}
+    rows = Grant.objects.filter(group_id__in=desired).values_list(
+        "id",
+        "group_id",
+        "permission_id",
+        "permission__content_type__app_label",
+        "permission__codename",
+    )
+    for row_id, group_id, perm_id, app_label, codename in rows:
+        existing[group_id, perm_id] = row_id
+        perm_names[perm_id] = f"{app_label}.{codename}"
+
+    wanted = {(g, p) for g, perm_ids in desired.items() for p in perm_ids}
+    to_add = sorted(wanted - existing.keys())
+    to_remove = sorted(existing.keys() - wanted)
+    if not dry_run and (to_add or to_remove):
+        Grant.objects.bulk_create(
+            [Grant(group_id=g, permission_id=p) for g, p in to_add],
+            ignore_conflicts=True,
+        )
+        Grant.objects.filter(id__in=[existing[pair] for pair in to_remove]).delete()
+        entitlements.bump_version()
+    return (
+        [(group_names[g], perm_names[p]) for g, p in to_add],
+        [(group_names[g], perm_names[p]) for g, p in to_remove],
+    )
+
+
+# pricing catalog payload, rebuilt when the catalog version changes
+_pricing_snapshot = {"version": None, "snapshot": (b"", "")}
+
+
+def build_pricing_payload():
+    """
+    Returns the featured prices of both intervals and their plans, each
+    plan listed once.
+    """
+    plans = {}
+    prices = {choice: [] for choice in SubscriptionPrice.IntervalChoices.values}
+    qs = SubscriptionPrice.objects.filter(featured=True).select_related("subscription")
     for obj in qs:
-        sub_perms = obj.permissions.all()
-        for group in obj.groups.all():
-            group.permissions.set(sub_perms)
-            # for perm in obj.permissions.all():
-            #     group.permissions.add(perm)
+        plan = obj.subscription
+        if plan is not None and plan.id not in plans:
+            plans[plan.id] = {
+                "id": plan.id,
+                "name": obj.display_sub_name,
+                "subtitle": plan.subtitle or "",
+                "features": plan.get_features_list,
+            }
+        prices.setdefault(obj.interval, []).append(
+            {
+                "id": obj.id,
+                "plan": obj.subscription_id,
+                "price": str(obj.price),
+                "checkout_url": obj.get_checkout_url,
+            }
+        )
+    return {"plans": list(plans.values()), "prices": prices}
+
+
+def get_pricing_snapshot():
+    """
+    Returns the pricing catalog as compact JSON and its strong ETag,
+    memoized in the process until a plan or price changes (see
+    `catalog.bump_version`).
+
+    Returns:
+        tuple: `(body, etag)`, the body as bytes.
+    """
+    version = catalog.get_version()
+    if _pricing_snapshot["version"] != version:
+        body = json.dumps(build_pricing_payload(), separators=(",", ":")).encode()
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        _pricing_snapshot.update(version=version, snapshot=(body, etag))
+    return _pricing_snapshot["snapshot"]
@@ -1,15 +1,33 @@
 import helpers.billing
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.http import HttpResponse
 from django.shortcuts import render, redirect
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_safe
 from subscriptions.models import SubscriptionPrice, UserSubscription
-from subscriptions import utils as sub_utils
+from subscriptions import catalog, utils as sub_utils
+
+
+def get_user_subscription(request):
+    """
+    Returns the subscription of the user, an unsaved one on a GET when the
+    user never subscribed, so showing the page never writes.
+    """
+    if request.method == "POST":
+        return UserSubscription.objects.get_or_create(user=request.user)[0]
+    user_sub_obj = (
+        UserSubscription.objects.filter(user=request.user)
+        .select_related("subscription")
+        .first()
+    )
+    return user_sub_obj or UserSubscription(user=request.user)
 
 
 @login_required
 def user_subscription_view(request):
-    user_sub_obj, created = UserSubscription.objects.get_or_create(user=request.user)
-    sub_data = user_sub_obj.serialize()
+    user_sub_obj = get_user_subscription(request)
     if request.method == "POST":
         # refresh subscription
         finished_refresh = sub_utils.refresh_active_users_subscriptions(
@@ -33,8 +51,7 @@ def user_subscription_view(request):
 
 @login_required
 def user_subscription_cancel_view(request):
-    user_sub_obj, created = UserSubscription.objects.get_or_create(user=request.user)
-    sub_data = user_sub_obj.serialize()
+    user_sub_obj = get_user_subscription(request)
     if request.method == "POST":
         # refresh subscription
         if user_sub_obj.stripe_id and user_sub_obj.is_active_status:
@@ -61,12 +78,31 @@ def subscription_price_view(request, interval="month"):
     inv_month = SubscriptionPrice.IntervalChoices.MONTHLY
     inv_year = SubscriptionPrice.IntervalChoices.YEARLY
 
-    qs = SubscriptionPrice.objects.filter(featured=True)
-    object_list = qs.filter(interval=inv_month)
-    if interval == inv_year:
-        object_list = qs.filter(interval=inv_year)
+    if interval != inv_year:
+        interval = inv_month
+    # lazy, only evaluated when the cached price grid has to be rendered again
+    object_list = SubscriptionPrice.objects.filter(
+        featured=True, interval=interval
+    ).select_related("subscription")
     return render(
         request,
         "subscriptions/pricing.html",
-        {"object_list": object_list},
+        {
+            "object_list": object_list,
+            "interval": interval,
+            "catalog_version": catalog.get_version(),
+            "cache_timeout": settings.PRICING_CACHE_TIMEOUT,
+        },
     )
+
+
+def pricing_etag(request):
+    return sub_utils.get_pricing_snapshot()[1]
+
+
+@require_safe
+@cache_control(public=True, max_age=settings.PRICING_API_MAX_AGE)
+@condition(etag_func=pricing_etag)
+def pricing_api_view(request):
+    body = sub_utils.get_pricing_snapshot()[0]
+    return HttpResponse(body, content_type="application/json")
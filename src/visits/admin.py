@@ -1,4 +1,20 @@
 from django.contrib import admin
-from .models import PageVisits
+from .models import PageVisits, PageVisitRollup, VisitorSketch
 # Register your models here.
-admin.site.register(PageVisits)
\ No newline at end of file
+admin.site.register(PageVisits)
+
+
+class PageVisitRollupAdmin(admin.ModelAdmin):
+    list_display = ["path", "bucket", "count"]
+    readonly_fields = ["path", "bucket", "count"]
+
+
+admin.site.register(PageVisitRollup, PageVisitRollupAdmin)
+
+
+class VisitorSketchAdmin(admin.ModelAdmin):
+    list_display = ["path", "day", "updated"]
+    exclude = ["registers"]
+
+
+admin.site.register(VisitorSketch, VisitorSketchAdmin)
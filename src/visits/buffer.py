@@ -0,0 +1,126 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.db import DatabaseError, connection
+
+logger = logging.getLogger(__name__)
+
+
+class VisitBuffer:
+    """
+    Per-process in-memory queue of page visits.
+
+    Visits are handed to `writer` in one batch once `max_size` of them are
+    pending or `max_age` seconds have passed since the last flush, so a busy
+    worker does one write per batch instead of one per request. The age is
+    only checked when a visit is added, an idle worker holds its visits
+    until the next one unless `start_flush_thread` is used.
+
+    Args:
+        writer (callable): Receives the list of queued items and persists them.
+        max_size (int): Number of pending visits that triggers a flush.
+        max_age (float): Seconds after the last flush that trigger a flush.
+        max_pending (int): Upper bound on visits kept in memory. When the
+                           writer keeps failing, the oldest visits beyond this
+                           bound are dropped, which caps how many visits a
+                           worker can lose.
+    """
+
+    def __init__(self, writer, max_size=50, max_age=10.0, max_pending=1000):
+        self.writer = writer
+        self.max_size = max(1, max_size)
+        self.max_age = max_age
+        self.max_pending = max(self.max_size, max_pending)
+        self.flushes = 0
+        self.written = 0
+        self.dropped = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, item):
+        """Queue a visit and flush when the size or age threshold is reached."""
+        with self._lock:
+            self._pending.append(item)
+            ready = (
+                len(self._pending) >= self.max_size
+                or time.monotonic() - self._last_flush >= self.max_age
+            )
+        if ready:
+            self.flush()
+
+    def flush(self):
+        """
+        Write every pending visit in a single batch.
+
+        Returns:
+            int: The number of visits written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._last_flush = time.monotonic()
+            if not batch:
+                return 0
+            try:
+                self.writer(batch)
+            except DatabaseError:
+                logger.exception("Failed to flush %s page visits", len(batch))
+                self._requeue(batch)
+                return 0
+            self.flushes += 1
+            self.written += len(batch)
+            return len(batch)
+
+    def _requeue(self, batch):
+        with self._lock:
+            pending = batch + self._pending
+            overflow = len(pending) - self.max_pending
+            if overflow > 0:
+                # keep the newest visits, the loss is bounded by `max_pending`
+                pending = pending[overflow:]
+                self.dropped += overflow
+            self._pending = pending
+
+    def start_flush_thread(self):
+        """
+        Flush from a daemon thread once `max_age` seconds have passed since
+        the last flush, so visits never wait longer for lack of traffic.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._flush_periodically, name="visit-buffer", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop_flush_thread(self):
+        """Stop the flush thread, pending visits are kept."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._stopped.clear()
+
+    def _flush_periodically(self):
+        while True:
+            delay = self._last_flush + self.max_age - time.monotonic()
+            if self._stopped.wait(max(delay, 0.1)):
+                return
+            if time.monotonic() - self._last_flush >= self.max_age:
+                self.flush()
+                # the thread's own connection, not kept open between flushes
+                connection.close()
+
+    def register_shutdown_flush(self):
+        """Flush whatever is left when the worker process exits."""
+        atexit.register(self.flush)
+        return self
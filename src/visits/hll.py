@@ -0,0 +1,72 @@
+import hashlib
+import math
+
+DEFAULT_PRECISION = 12
+
+
+def hash_value(value):
+    """Returns a stable 64 bit hash of `value` (str or bytes)."""
+    if isinstance(value, str):
+        value = value.encode()
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """
+    HyperLogLog sketch for approximate distinct counting.
+
+    Uses `2 ** precision` one byte registers, so the memory per sketch is fixed
+    (4 KiB at the default precision) and the standard error is about
+    `1.04 / sqrt(2 ** precision)` (1.6% at the default precision).
+    Sketches of the same precision can be merged to count the union.
+    """
+
+    def __init__(self, registers=None, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            self.registers = bytearray(self.size)
+        else:
+            if len(registers) != self.size:
+                raise ValueError(
+                    f"Expected {self.size} registers, got {len(registers)}."
+                )
+            self.registers = bytearray(registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        precision = int(math.log2(len(data)))
+        return cls(registers=data, precision=precision)
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    def add(self, value):
+        self.add_hash(hash_value(value))
+
+    def add_hash(self, hashed):
+        """Adds an already hashed 64 bit value."""
+        index = hashed >> (64 - self.precision)
+        remaining_bits = 64 - self.precision
+        remaining = hashed & ((1 << remaining_bits) - 1)
+        rank = remaining_bits - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Merges `other` into this sketch in place and returns it."""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches of different precision.")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """Returns the estimated number of distinct values added."""
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # small range correction (linear counting)
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
@@ -0,0 +1,83 @@
+import time
+import threading
+from typing import Any
+from django.core.management.base import BaseCommand, CommandParser
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from visits.buffer import VisitBuffer
+from visits.models import PageVisitRollup, PageVisits, VisitorSketch
+from visits import utils as visits_utils
+
+BENCH_PATH = "/__bench_visits__/"
+
+
+class Command(BaseCommand):
+    help = "Compare direct and buffered page visit recording under concurrent load."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--threads", default=8, type=int)
+        parser.add_argument("--visits", default=500, type=int, help="Visits per thread")
+        parser.add_argument("--batch-size", default=50, type=int)
+        return super().add_arguments(parser)
+
+    def run_threads(self, threads, visits, record):
+        def worker():
+            try:
+                for _ in range(visits):
+                    record()
+            finally:
+                connection.close()
+
+        pool = [threading.Thread(target=worker) for _ in range(threads)]
+        start = time.perf_counter()
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        return time.perf_counter() - start
+
+    def report(self, label, total, elapsed, writes):
+        self.stdout.write(
+            f"{label:<10} {total} visits in {elapsed:.2f}s "
+            f"({total / elapsed:,.0f} visits/s, {writes} writes)"
+        )
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        threads = options.get("threads")
+        visits = options.get("visits")
+        batch_size = options.get("batch_size")
+        total = threads * visits
+
+        def record_direct():
+            visits_utils.write_visits([PageVisits(path=BENCH_PATH)])
+
+        elapsed = self.run_threads(threads, visits, record_direct)
+        self.report("direct", total, elapsed, total)
+
+        buffer = VisitBuffer(
+            visits_utils.write_visits,
+            max_size=batch_size,
+            max_age=60,
+            max_pending=total,
+        )
+
+        def record_buffered():
+            buffer.add(PageVisits(path=BENCH_PATH))
+
+        elapsed = self.run_threads(threads, visits, record_buffered)
+        start = time.perf_counter()
+        buffer.flush()
+        elapsed += time.perf_counter() - start
+        self.report("buffered", total, elapsed, buffer.flushes)
+
+        self.cleanup()
+
+    def cleanup(self):
+        """Deletes the bench visits and everything derived from them."""
+        with transaction.atomic():
+            PageVisits.objects.filter(path=BENCH_PATH).delete()
+            PageVisitRollup.objects.filter(path=BENCH_PATH).delete()
+            VisitorSketch.objects.filter(path=BENCH_PATH).delete()
+        visits_utils.clear_cached_counts()
+        cache.delete(visits_utils.path_visits_cache_key(BENCH_PATH))
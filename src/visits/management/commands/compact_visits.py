@@ -0,0 +1,27 @@
+from typing import Any
+from django.core.management.base import BaseCommand, CommandParser
+
+from visits import utils as visits_utils
+
+
+class Command(BaseCommand):
+    help = "Delete raw page visits older than --days, their rollups are kept."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--days", default=30, type=int)
+        parser.add_argument("--batch-size", default=5000, type=int)
+        parser.add_argument(
+            "--pause", default=0.0, type=float, help="Seconds to sleep between batches"
+        )
+        return super().add_arguments(parser)
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        days = options.get("days")
+        self.stdout.write(f"Compacting page visits older than {days} days ...")
+        deleted = visits_utils.compact_visits(
+            days=days,
+            batch_size=options.get("batch_size"),
+            pause=options.get("pause"),
+            stdout=self.stdout if options.get("verbosity") > 1 else None,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} raw page visits."))
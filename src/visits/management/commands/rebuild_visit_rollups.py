@@ -0,0 +1,13 @@
+from typing import Any
+from django.core.management.base import BaseCommand
+
+from visits import utils as visits_utils
+
+
+class Command(BaseCommand):
+    help = "Rebuild the hourly page visit rollups from the raw PageVisits rows."
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        self.stdout.write("Rebuilding page visit rollups ...")
+        count = visits_utils.rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} rollup rows."))
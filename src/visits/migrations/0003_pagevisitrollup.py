@@ -0,0 +1,30 @@
+# Generated by Django 5.0.14 on 2026-10-18 15:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visits', '0002_alter_pagevisits_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageVisitRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.TextField(blank=True, default='')),
+                ('bucket', models.DateTimeField(help_text='Start of the hour the visits fall in')),
+                ('count', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Page Visit Rollup',
+                'verbose_name_plural': 'Page Visit Rollups',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='pagevisitrollup',
+            constraint=models.UniqueConstraint(fields=('path', 'bucket'), name='visits_rollup_path_bucket_unique'),
+        ),
+    ]
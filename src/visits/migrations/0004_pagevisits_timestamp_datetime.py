@@ -0,0 +1,61 @@
+# Generated by Django 5.0.14 on 2026-10-18 15:52
+
+import datetime
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def copy_time_of_day(apps, schema_editor):
+    """
+    The old column only stored the time of day, so every visit is dated to
+    the most recent occurrence of that time before the migration runs.
+    """
+    PageVisits = apps.get_model("visits", "PageVisits")
+    now = django.utils.timezone.now()
+    batch = []
+    for obj in PageVisits.objects.only("id", "timestamp").iterator(chunk_size=2000):
+        value = datetime.datetime.combine(now.date(), obj.timestamp, tzinfo=datetime.UTC)
+        if value > now:
+            value -= datetime.timedelta(days=1)
+        obj.recorded = value
+        batch.append(obj)
+        if len(batch) >= 2000:
+            PageVisits.objects.bulk_update(batch, ["recorded"])
+            batch = []
+    if batch:
+        PageVisits.objects.bulk_update(batch, ["recorded"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visits', '0003_pagevisitrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pagevisits',
+            name='recorded',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(copy_time_of_day, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='pagevisits',
+            name='timestamp',
+        ),
+        migrations.RenameField(
+            model_name='pagevisits',
+            old_name='recorded',
+            new_name='timestamp',
+        ),
+        migrations.AlterField(
+            model_name='pagevisits',
+            name='timestamp',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='pagevisits',
+            index=models.Index(fields=['path', 'timestamp'], name='visits_path_timestamp_idx'),
+        ),
+    ]
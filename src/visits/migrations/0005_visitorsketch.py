@@ -0,0 +1,36 @@
+# Generated by Django 5.0.14 on 2026-10-18 15:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visits', '0004_pagevisits_timestamp_datetime'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitorSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.TextField(blank=True, default='')),
+                ('day', models.DateField()),
+                ('registers', models.BinaryField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Visitor Sketch',
+                'verbose_name_plural': 'Visitor Sketches',
+            },
+        ),
+        migrations.AddField(
+            model_name='pagevisits',
+            name='visitor',
+            field=models.CharField(blank=True, help_text='Hashed visitor id', max_length=16, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='visitorsketch',
+            constraint=models.UniqueConstraint(fields=('path', 'day'), name='visits_sketch_path_day_unique'),
+        ),
+    ]
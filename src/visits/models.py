@@ -1,14 +1,69 @@
 from django.db import models
+from django.utils import timezone
 
 
 class PageVisits(models.Model):
     path = models.TextField(blank=True,null=True)
-    timestamp = models.TimeField(auto_now_add=True)
+    # set when the visit happens, not when a buffered batch is written
+    timestamp = models.DateTimeField(default=timezone.now, db_index=True)
+    visitor = models.CharField(
+        max_length=16, blank=True, null=True, help_text="Hashed visitor id"
+    )
 
     class Meta:
         verbose_name_plural = "Page Visits"
         verbose_name = "Page Visit"
+        indexes = [
+            models.Index(fields=["path", "timestamp"], name="visits_path_timestamp_idx"),
+        ]
 
     def __str__(self) -> str:
         return self.path
 
+
+
+class PageVisitRollup(models.Model):
+    """
+    Number of page visits per path and per hour, maintained as visits are written.
+    Daily numbers are the sum of the hourly buckets.
+    """
+
+    path = models.TextField(blank=True, default="")
+    bucket = models.DateTimeField(help_text="Start of the hour the visits fall in")
+    count = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "Page Visit Rollups"
+        verbose_name = "Page Visit Rollup"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["path", "bucket"], name="visits_rollup_path_bucket_unique"
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.path} @ {self.bucket:%Y-%m-%d %H:00} ({self.count})"
+
+
+class VisitorSketch(models.Model):
+    """
+    HyperLogLog sketch of the distinct visitors of a path on a day.
+    See `visits.hll.HyperLogLog`.
+    """
+
+    path = models.TextField(blank=True, default="")
+    day = models.DateField()
+    registers = models.BinaryField()
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "Visitor Sketches"
+        verbose_name = "Visitor Sketch"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["path", "day"], name="visits_sketch_path_day_unique"
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.path} @ {self.day}"
@@ -1,3 +1,147 @@
+import datetime
+import random
+import time
+from io import StringIO
+
+from django.core.cache import cache
+from django.db import DatabaseError
 from django.test import TestCase
+from django.utils import timezone
+
+from visits.buffer import VisitBuffer
+from visits.hll import HyperLogLog, hash_value
+from visits.models import PageVisits, PageVisitRollup, VisitorSketch
+from visits import utils as visits_utils
+
+
+class VisitBufferTestCase(TestCase):
+    def test_flushes_on_size(self):
+        buffer = VisitBuffer(visits_utils.write_visits, max_size=3, max_age=60)
+        buffer.add(PageVisits(path="/a/"))
+        buffer.add(PageVisits(path="/a/"))
+        self.assertEqual(PageVisits.objects.count(), 0)
+        buffer.add(PageVisits(path="/a/"))
+        self.assertEqual(PageVisits.objects.count(), 3)
+        self.assertEqual(buffer.flushes, 1)
+
+    def test_flushes_on_age(self):
+        buffer = VisitBuffer(visits_utils.write_visits, max_size=100, max_age=0)
+        buffer.add(PageVisits(path="/a/"))
+        self.assertEqual(PageVisits.objects.count(), 1)
+
+    def test_flush_thread_flushes_idle_buffers(self):
+        batches = []
+        buffer = VisitBuffer(batches.append, max_size=100, max_age=0.05)
+        buffer.add("visit")
+        buffer.start_flush_thread()
+        try:
+            deadline = time.monotonic() + 5
+            while not batches and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            buffer.stop_flush_thread()
+        self.assertEqual(batches, [["visit"]])
+
+    def test_loss_is_bounded(self):
+        def failing_writer(batch):
+            raise DatabaseError("down")
+
+        buffer = VisitBuffer(failing_writer, max_size=2, max_age=60, max_pending=4)
+        for _ in range(10):
+            buffer.add(PageVisits(path="/a/"))
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(buffer.dropped, 6)
+
+
+class PageVisitRollupTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_write_visits_updates_rollups(self):
+        visits_utils.write_visits([PageVisits(path="/a/"), PageVisits(path="/b/")])
+        visits_utils.write_visits([PageVisits(path="/a/")])
+        rollups = dict(PageVisitRollup.objects.values_list("path", "count"))
+        self.assertEqual(rollups, {"/a/": 2, "/b/": 1})
+
+    def test_cached_counts_follow_writes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            visits_utils.write_visits([PageVisits(path="/a/")])
+        self.assertEqual(visits_utils.get_total_visits(), 1)
+        self.assertEqual(visits_utils.get_path_visits("/a/"), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            visits_utils.write_visits([PageVisits(path="/a/"), PageVisits(path="/b/")])
+        with self.assertNumQueries(0):
+            self.assertEqual(visits_utils.get_total_visits(), 3)
+            self.assertEqual(visits_utils.get_path_visits("/a/"), 2)
+
+    def test_rebuild_rollups(self):
+        PageVisits.objects.bulk_create([PageVisits(path="/a/") for _ in range(3)])
+        visits_utils.rebuild_rollups()
+        self.assertEqual(visits_utils.get_total_visits(), 3)
+        self.assertEqual(visits_utils.get_path_visits("/a/"), 3)
+
+    def test_compact_visits_keeps_totals(self):
+        old = timezone.now() - datetime.timedelta(days=40)
+        visits_utils.write_visits(
+            [PageVisits(path="/a/", timestamp=old) for _ in range(5)]
+            + [PageVisits(path="/a/")]
+        )
+        stdout = StringIO()
+        deleted = visits_utils.compact_visits(days=30, batch_size=2, stdout=stdout)
+        self.assertEqual(deleted, 5)
+        self.assertIn("Deleted 5 visits", stdout.getvalue())
+        self.assertEqual(PageVisits.objects.count(), 1)
+        self.assertEqual(visits_utils.get_path_visits("/a/"), 6)
+        # rebuilding from the remaining raw rows keeps the compacted buckets
+        visits_utils.rebuild_rollups()
+        self.assertEqual(visits_utils.get_path_visits("/a/"), 6)
+
+
+class HyperLogLogTestCase(TestCase):
+    # 4 standard errors at the default precision (1.04 / sqrt(4096) ~= 1.6%)
+    MAX_ERROR = 0.065
+
+    def assertWithinError(self, estimate, exact):
+        self.assertLessEqual(abs(estimate - exact) / exact, self.MAX_ERROR)
+
+    def test_estimate_against_exact_counts(self):
+        rng = random.Random(42)
+        for exact in [10, 500, 5_000, 50_000]:
+            sketch = HyperLogLog()
+            values = [f"visitor-{exact}-{i}" for i in range(exact)]
+            # repeat visits must not change the estimate
+            for value in values + rng.choices(values, k=exact):
+                sketch.add(value)
+            self.assertWithinError(sketch.count(), exact)
+
+    def test_merge_counts_union(self):
+        rng = random.Random(7)
+        population = [f"visitor-{i}" for i in range(20_000)]
+        days = [set(rng.sample(population, 6_000)) for _ in range(5)]
+        merged = HyperLogLog()
+        for visitors in days:
+            sketch = HyperLogLog()
+            for value in visitors:
+                sketch.add(value)
+            merged.merge(HyperLogLog.from_bytes(sketch.to_bytes()))
+        self.assertWithinError(merged.count(), len(set().union(*days)))
 
-# Create your tests here.
+    def test_unique_visitors_query(self):
+        today = timezone.localdate()
+        now = timezone.now()
+        yesterday = now - datetime.timedelta(days=1)
+        visitors = [hash_value(f"v{i}") for i in range(3_000)]
+        visits = [
+            PageVisits(path="/a/", timestamp=now, visitor=f"{v:016x}")
+            for v in visitors[:2_000]
+        ] + [
+            PageVisits(path="/b/", timestamp=yesterday, visitor=f"{v:016x}")
+            for v in visitors[1_000:]
+        ]
+        visits_utils.write_visits(visits)
+        self.assertWithinError(visits_utils.unique_visitors(start=today), 2_000)
+        self.assertWithinError(
+            visits_utils.unique_visitors(paths=["/b/"]), 2_000
+        )
+        self.assertWithinError(visits_utils.unique_visitors(), 3_000)
+        self.assertEqual(VisitorSketch.objects.count(), 2)
@@ -0,0 +1,333 @@
+import datetime
+import hashlib
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Min, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from visits.buffer import VisitBuffer
+from visits.hll import HyperLogLog
+from visits.models import PageVisits, PageVisitRollup, VisitorSketch
+
+TOTAL_VISITS_CACHE_KEY = "visits:total"
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def hour_bucket(value):
+    """Truncates a datetime to the start of its hour."""
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def path_visits_cache_key(path):
+    digest = hashlib.md5((path or "").encode()).hexdigest()
+    return f"visits:path:{digest}"
+
+
+def increment_rollups(counts):
+    """
+    Adds visit counts to the hourly rollups.
+
+    Args:
+        counts (dict): Maps `(path, bucket)` to the number of new visits.
+    """
+    for (path, bucket), count in counts.items():
+        lookup = {"path": path, "bucket": bucket}
+        qs = PageVisitRollup.objects.filter(**lookup)
+        if qs.update(count=F("count") + count):
+            continue
+        try:
+            with transaction.atomic():
+                PageVisitRollup.objects.create(count=count, **lookup)
+        except IntegrityError:
+            # another worker created the bucket in the meantime
+            qs.update(count=F("count") + count)
+
+
+def visitor_id(request):
+    """
+    Returns a hashed, non reversible id of the visitor of `request`.
+    Signed in users are identified by their id, anonymous visitors by their
+    session, or by IP address and user agent when there is no session.
+    """
+    if request.user.is_authenticated:
+        raw = f"user:{request.user.pk}"
+    elif request.session.session_key:
+        raw = f"session:{request.session.session_key}"
+    else:
+        ip = request.META.get("REMOTE_ADDR", "")
+        agent = request.META.get("HTTP_USER_AGENT", "")
+        raw = f"anon:{ip}:{agent}"
+    key = settings.SECRET_KEY.encode()[:64]
+    return hashlib.blake2b(raw.encode(), digest_size=8, key=key).hexdigest()
+
+
+def update_sketches(visitors):
+    """
+    Adds visitors to the daily HyperLogLog sketches.
+
+    Args:
+        visitors (dict): Maps `(path, day)` to a list of hashed visitor ids.
+    """
+    for (path, day), ids in visitors.items():
+        with transaction.atomic():
+            obj = (
+                VisitorSketch.objects.select_for_update()
+                .filter(path=path, day=day)
+                .first()
+            )
+            sketch = HyperLogLog() if obj is None else HyperLogLog.from_bytes(obj.registers)
+            for value in ids:
+                sketch.add_hash(int(value, 16))
+            if obj is None:
+                try:
+                    with transaction.atomic():
+                        VisitorSketch.objects.create(
+                            path=path, day=day, registers=sketch.to_bytes()
+                        )
+                    continue
+                except IntegrityError:
+                    # another worker created the sketch in the meantime
+                    obj = VisitorSketch.objects.select_for_update().get(
+                        path=path, day=day
+                    )
+                    sketch.merge(HyperLogLog.from_bytes(obj.registers))
+            obj.registers = sketch.to_bytes()
+            obj.save(update_fields=["registers", "updated"])
+
+
+def unique_visitors(start=None, end=None, paths=None):
+    """
+    Estimates the number of distinct visitors by merging daily sketches.
+
+    Args:
+        start (date, optional): First day to include. Defaults to no lower bound.
+        end (date, optional): Last day to include. Defaults to no upper bound.
+        paths (list, optional): Paths to include. Defaults to every path.
+
+    Returns:
+        int: The estimated number of distinct visitors in the range.
+    """
+    qs = VisitorSketch.objects.all()
+    if start is not None:
+        qs = qs.filter(day__gte=start)
+    if end is not None:
+        qs = qs.filter(day__lte=end)
+    if paths is not None:
+        qs = qs.filter(path__in=paths)
+    sketch = HyperLogLog()
+    for registers in qs.values_list("registers", flat=True).iterator():
+        sketch.merge(HyperLogLog.from_bytes(registers))
+    return sketch.count()
+
+
+def unique_visitors_summary():
+    """Unique visitors of today and of the last 7 and 30 days."""
+    today = timezone.localdate()
+    return {
+        "today": unique_visitors(start=today),
+        "last_7_days": unique_visitors(start=today - datetime.timedelta(days=6)),
+        "last_30_days": unique_visitors(start=today - datetime.timedelta(days=29)),
+    }
+
+
+def increment_cached_counts(counts):
+    """Keeps the cached totals in step with the rollups, if they are cached."""
+    path_counts = Counter()
+    for (path, _), count in counts.items():
+        path_counts[path] += count
+    keys = [TOTAL_VISITS_CACHE_KEY] + [path_visits_cache_key(p) for p in path_counts]
+    amounts = [sum(path_counts.values())] + list(path_counts.values())
+    for key, amount in zip(keys, amounts):
+        try:
+            cache.incr(key, amount)
+        except ValueError:
+            # not cached, the next read computes it from the rollups
+            pass
+
+
+def write_visits(visits):
+    """
+    Persist a batch of unsaved `PageVisits` with a single INSERT and add
+    them to the hourly rollups and the daily visitor sketches in the same
+    transaction.
+    """
+    counts = Counter(
+        (visit.path or "", hour_bucket(visit.timestamp)) for visit in visits
+    )
+    visitors = defaultdict(list)
+    for visit in visits:
+        if visit.visitor:
+            visitors[(visit.path or "", timezone.localdate(visit.timestamp))].append(visit.visitor)
+    with transaction.atomic():
+        PageVisits.objects.bulk_create(visits)
+        increment_rollups(counts)
+        update_sketches(visitors)
+        transaction.on_commit(lambda: increment_cached_counts(counts))
+
+
+def get_total_visits():
+    """Returns the number of recorded visits, read from the cache when possible."""
+    total = cache.get(TOTAL_VISITS_CACHE_KEY)
+    if total is None:
+        total = PageVisitRollup.objects.aggregate(total=Sum("count"))["total"] or 0
+        cache.set(
+            TOTAL_VISITS_CACHE_KEY, total, settings.VISITS_COUNT_CACHE_TIMEOUT
+        )
+    return total
+
+
+def get_path_visits(path):
+    """Returns the number of recorded visits of `path`, read from the cache when possible."""
+    key = path_visits_cache_key(path)
+    total = cache.get(key)
+    if total is None:
+        qs = PageVisitRollup.objects.filter(path=path or "")
+        total = qs.aggregate(total=Sum("count"))["total"] or 0
+        cache.set(key, total, settings.VISITS_COUNT_CACHE_TIMEOUT)
+    return total
+
+
+def clear_cached_counts():
+    paths = PageVisitRollup.objects.values_list("path", flat=True).distinct()
+    keys = [TOTAL_VISITS_CACHE_KEY] + [path_visits_cache_key(p) for p in paths]
+    cache.delete_many(keys)
+
+
+def lock_rollups():
+    """
+    Blocks `write_visits` of other connections until the current transaction
+    ends. Only needed on PostgreSQL, SQLite already allows a single writer.
+    """
+    if connection.vendor == "postgresql":
+        table = connection.ops.quote_name(PageVisitRollup._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+
+
+def rebuild_rollups(start=None, end=None):
+    """
+    Recomputes the hourly rollups from the raw `PageVisits` rows.
+
+    Only buckets from the oldest raw visit onwards are replaced, so rollups
+    of visits that were already compacted away are kept.
+
+    The raw rows are counted and the rollups replaced in one transaction,
+    with the rollups locked against `write_visits` throughout: a batch
+    committed between the count and the replace would otherwise be lost
+    from the rollups. Writers wait for the rebuild to commit.
+
+    Args:
+        start (datetime, optional): Start of the range to rebuild. Defaults to
+                                    the hour of the oldest raw visit.
+        end (datetime, optional): End of the range to rebuild (exclusive).
+                                  Defaults to no upper bound.
+
+    Returns:
+        int: The number of rollup rows written.
+    """
+    with transaction.atomic():
+        lock_rollups()
+        raw_qs = PageVisits.objects.all()
+        if start is None:
+            oldest = raw_qs.aggregate(oldest=Min("timestamp"))["oldest"]
+            if oldest is None:
+                return 0
+            start = oldest
+        start = hour_bucket(start)
+        raw_qs = raw_qs.filter(timestamp__gte=start)
+        rollup_qs = PageVisitRollup.objects.filter(bucket__gte=start)
+        if end is not None:
+            raw_qs = raw_qs.filter(timestamp__lt=end)
+            rollup_qs = rollup_qs.filter(bucket__lt=end)
+
+        rows = (
+            raw_qs.annotate(bucket=TruncHour("timestamp"))
+            .values("path", "bucket")
+            .annotate(count=Count("id"))
+            .order_by()
+        )
+        counts = Counter()
+        for row in rows:
+            counts[(row["path"] or "", row["bucket"])] += row["count"]
+
+        rollups = [
+            PageVisitRollup(path=path, bucket=bucket, count=count)
+            for (path, bucket), count in counts.items()
+        ]
+        clear_cached_counts()
+        rollup_qs.delete()
+        PageVisitRollup.objects.bulk_create(rollups, batch_size=1000)
+        transaction.on_commit(clear_cached_counts)
+    return len(rollups)
+
+
+def compact_visits(days=30, batch_size=5000, pause=0.0, stdout=None):
+    """
+    Deletes raw visits older than `days`, in batches of `batch_size` by
+    primary key, each in its own short transaction.
+
+    The rollups already count these visits, `write_visits` adds every batch
+    to them, so nothing is recomputed and writers are never blocked. Visits
+    recorded before the rollups existed must be folded in once with the
+    `rebuild_visit_rollups` command before the first compaction. The cutoff
+    is aligned to the hour, so a later `rebuild_rollups` never replaces a
+    bucket that is only partly backed by raw rows.
+
+    Args:
+        stdout (optional): Receives a progress line per batch, i.e. the
+                           `stdout` of the management command.
+
+    Returns:
+        int: The number of raw visits deleted.
+    """
+    cutoff = hour_bucket(timezone.now() - datetime.timedelta(days=days))
+    qs = PageVisits.objects.filter(timestamp__lt=cutoff).order_by("id")
+    deleted = 0
+    while True:
+        ids = list(qs.values_list("id", flat=True)[:batch_size])
+        if not ids:
+            break
+        count, _ = PageVisits.objects.filter(id__in=ids).delete()
+        deleted += count
+        if stdout is not None:
+            stdout.write(f"Deleted {deleted} visits older than {cutoff}")
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+def get_visit_buffer():
+    """Returns the visit buffer of the current worker process, creating it once."""
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = VisitBuffer(
+                    write_visits,
+                    max_size=settings.VISITS_BUFFER_SIZE,
+                    max_age=settings.VISITS_BUFFER_MAX_AGE,
+                    max_pending=settings.VISITS_BUFFER_MAX_PENDING,
+                ).register_shutdown_flush().start_flush_thread()
+    return _buffer
+
+
+def record_visit(path, visitor=None):
+    """
+    Records a page visit, `visitor` is a hashed id from `visitor_id`.
+
+    With `VISITS_BUFFER_ENABLED` the visit is queued in the worker's buffer and
+    written later as part of a batch, otherwise it is inserted right away.
+    """
+    visit = PageVisits(path=path, visitor=visitor)
+    if not settings.VISITS_BUFFER_ENABLED:
+        write_visits([visit])
+        return
+    get_visit_buffer().add(visit)